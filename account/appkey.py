@@ -0,0 +1,106 @@
+import threading
+import time
+from collections import OrderedDict
+
+from utils.cache import cache
+from utils.constants import CacheKey
+
+from .models import User, hash_appkey
+
+
+class AppkeyCache:
+    """
+    Users of the open api appkeys, read through a bounded LRU of the process and then redis.
+    Unknown or disabled appkeys are cached too, as False.
+    Invalidating drops the redis entry and the entry of the current process,
+    other processes drop theirs after local_timeout seconds.
+    Changes of a user made outside the invalidating apis are seen after timeout seconds at most.
+    Only the values of fields are cached, the other fields of the user are deferred and read when used,
+    so the password, the 2fa token and the sessions never reach the cache.
+    Appkeys created before the hash column are looked up by the unindexed plaintext column, only while
+    some are left, hash_open_api_appkeys hashes them all and turns the lookup off.
+    """
+    fields = ("id", "username", "email", "admin_type", "problem_permission", "open_api", "is_disabled")
+    timeout = 60
+    legacy_timeout = 60 * 60
+    local_timeout = 5
+    size = 1024
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # appkey hash: (expire time, values of fields or False)
+        self._local = OrderedDict()
+
+    @staticmethod
+    def _key(appkey_hash):
+        return f"{CacheKey.open_api_appkey}:{appkey_hash}"
+
+    def _get_local(self, appkey_hash):
+        with self._lock:
+            item = self._local.get(appkey_hash)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self._local[appkey_hash]
+                return None
+            self._local.move_to_end(appkey_hash)
+            return item[1]
+
+    def _set_local(self, appkey_hash, value):
+        with self._lock:
+            self._local[appkey_hash] = (time.monotonic() + self.local_timeout, value)
+            self._local.move_to_end(appkey_hash)
+            while len(self._local) > self.size:
+                self._local.popitem(last=False)
+
+    def has_legacy_appkeys(self) -> bool:
+        has_legacy = cache.get(CacheKey.open_api_legacy_appkeys)
+        if has_legacy is None:
+            # uses the index of the hash column
+            has_legacy = User.objects.filter(open_api_appkey_hash__isnull=True,
+                                             open_api_appkey__isnull=False).exists()
+            cache.set(CacheKey.open_api_legacy_appkeys, has_legacy, self.legacy_timeout)
+        return has_legacy
+
+    @staticmethod
+    def legacy_appkeys_hashed():
+        # appkeys are hashed when they are created, none comes back once all are hashed
+        cache.set(CacheKey.open_api_legacy_appkeys, False, None)
+
+    def _load(self, appkey, appkey_hash):
+        users = User.objects.filter(open_api=True, is_disabled=False)
+        values = users.filter(open_api_appkey_hash=appkey_hash).values_list(*self.fields).first()
+        if values is None and self.has_legacy_appkeys():
+            # appkeys created before the hash column, hashed on first use
+            legacy = users.filter(open_api_appkey=appkey, open_api_appkey_hash__isnull=True)
+            values = legacy.values_list(*self.fields).first()
+            if values is not None:
+                legacy.update(open_api_appkey_hash=appkey_hash)
+        return values or False
+
+    def get(self, appkey):
+        """
+        :return: the enabled open api user of the appkey, None if there is not any
+        """
+        appkey_hash = hash_appkey(appkey)
+        values = self._get_local(appkey_hash)
+        if values is None:
+            values = cache.get(self._key(appkey_hash))
+            if values is None:
+                values = self._load(appkey, appkey_hash)
+                cache.set(self._key(appkey_hash), values, self.timeout)
+            self._set_local(appkey_hash, values)
+        # every request gets its own user
+        return User.from_db(None, self.fields, values) if values else None
+
+    def invalidate(self, *appkey_hashes):
+        appkey_hashes = [item for item in appkey_hashes if item]
+        if not appkey_hashes:
+            return
+        cache.delete_many([self._key(item) for item in appkey_hashes])
+        with self._lock:
+            for item in appkey_hashes:
+                self._local.pop(item, None)
+
+
+appkey_cache = AppkeyCache()
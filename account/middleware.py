@@ -4,33 +4,43 @@ from django.utils.timezone import now
 from django.utils.deprecation import MiddlewareMixin
 
 from utils.api import JSONResponse
-from account.models import User
+from account.appkey import appkey_cache
 
 
 class APITokenAuthMiddleware(MiddlewareMixin):
     def process_request(self, request):
         appkey = request.META.get("HTTP_APPKEY")
         if appkey:
-            try:
-                request.user = User.objects.get(open_api_appkey=appkey, open_api=True, is_disabled=False)
+            user = appkey_cache.get(appkey)
+            if user:
+                request.user = user
                 request.csrf_processing_done = True
                 request.auth_method = "api_key"
-            except User.DoesNotExist:
-                pass
 
 
 class SessionRecordMiddleware(MiddlewareMixin):
+    """
+    record ip, user agent and activity of the session, the session is only written when the ip or the user agent
+    changes or the last activity is older than SESSION_ACTIVITY_INTERVAL seconds, not on every request,
+    requests authenticated with an api key have no session to record
+    """
     def process_request(self, request):
         request.ip = request.META.get(settings.IP_HEADER, request.META.get("REMOTE_ADDR"))
-        if request.user.is_authenticated:
+        if request.user.is_authenticated and getattr(request, "auth_method", "") != "api_key":
             session = request.session
-            session["user_agent"] = request.META.get("HTTP_USER_AGENT", "")
+            user_agent = request.META.get("HTTP_USER_AGENT", "")
+            current = now()
+            last_activity = session.get("last_activity")
+            if (session.get("ip") == request.ip and session.get("user_agent") == user_agent and last_activity and
+                    (current - last_activity).total_seconds() < settings.SESSION_ACTIVITY_INTERVAL):
+                return
+            session["user_agent"] = user_agent
             session["ip"] = request.ip
-            session["last_activity"] = now()
+            session["last_activity"] = current
             user_sessions = request.user.session_keys
             if session.session_key not in user_sessions:
                 user_sessions.append(session.session_key)
-                request.user.save()
+                request.user.save(update_fields=["session_keys"])
 
 
 class AdminRoleRequiredMiddleware(MiddlewareMixin):
@@ -1,3 +1,4 @@
+import hashlib
 import uuid
 
 from django.db import models
@@ -17,6 +18,11 @@ class ProblemPermission(object):
     OWN = "Own"
     ALL = "All"
 
+
+def hash_appkey(appkey):
+    return hashlib.sha256(appkey.encode("utf-8")).hexdigest()
+
+
 class UserManager(models.Manager):
     use_in_migrations = True
 
@@ -42,6 +48,8 @@ class User(AbstractBaseUser):
     # open api key
     open_api = models.BooleanField(default=False)
     open_api_appkey = models.TextField(null=True)
+    # sha256 of open_api_appkey, the api key auth looks users up by it
+    open_api_appkey_hash = models.TextField(null=True, db_index=True)
     is_disabled = models.BooleanField(default=False)
 
 
@@ -50,6 +58,10 @@ class User(AbstractBaseUser):
 
     objects = UserManager() #
 
+    def set_open_api_appkey(self, appkey):
+        self.open_api_appkey = appkey
+        self.open_api_appkey_hash = hash_appkey(appkey) if appkey else None
+
     def is_admin(self):
         return self.admin_type == AdminType.ADMIN
 
@@ -70,7 +82,8 @@ class User(AbstractBaseUser):
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
-    # dict of problem.id:max_grade
+    # replaced by problem.ProblemStatus, read only by the migrate_problems_status command,
+    # UserProfileSerializer builds the field from ProblemStatus
     problems_status = JSONField(default=dict)
     real_name = models.TextField(null=True)
     blog = models.URLField(null=True)
@@ -1,5 +1,6 @@
 from django import forms
 
+from problem.models import ProblemStatus
 from utils.api import serializers, UsernameSerializer
 
 from .models import AdminType, ProblemPermission, User, UserProfile
@@ -69,6 +70,8 @@ class UserSerializer(serializers.ModelSerializer):
 class UserProfileSerializer(serializers.ModelSerializer):
     user = UserSerializer()
     real_name = serializers.SerializerMethodField()
+    # built from problem.ProblemStatus, the column is not written anymore
+    problems_status = serializers.SerializerMethodField()
 
     class Meta:
         model = UserProfile
@@ -81,6 +84,18 @@ class UserProfileSerializer(serializers.ModelSerializer):
     def get_real_name(self, obj):
         return obj.real_name if self.show_real_name else None
 
+    def get_problems_status(self, obj):
+        """
+        the layout of the former column, {"problems": {id: {status, _id, score}}, "contest_problems": {...}}
+        """
+        result = {"problems": {}, "contest_problems": {}}
+        rows = ProblemStatus.objects.filter(user_id=obj.user_id) \
+            .values_list("problem_id", "problem___id", "problem__contest_id", "status", "score")
+        for problem_id, display_id, contest_id, status, score in rows:
+            key = "contest_problems" if contest_id else "problems"
+            result[key][str(problem_id)] = {"status": status, "_id": display_id, "score": score}
+        return result
+
 
 class EditUserSerializer(serializers.Serializer):
     id = serializers.IntegerField()
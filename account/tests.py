@@ -1,6 +1,10 @@
-from django.test import TestCase
+from django.contrib.sessions.backends.cache import SessionStore as CacheSessionStore
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
 # Create your tests here.
+import io
 import time
 
 from unittest import mock
@@ -8,15 +12,20 @@ from datetime import timedelta
 from copy import deepcopy
 
 from django.contrib import auth
+from django.core.management import call_command
 from django.utils.timezone import now
 from otpauth import OtpAuth
 
-from utils.api.tests import APIClient, APITestCase
+from utils.api.tests import APIClient, APITestCase, create_problem
+from utils.cache import cache
 from utils.shortcuts import rand_str
 from options.options import SysOptions
+from problem.models import ProblemStatus
+from submission.models import JudgeStatus
 
-from .models import AdminType, ProblemPermission, User
-from utils.constants import ContestRuleType
+from .appkey import appkey_cache
+from .models import AdminType, ProblemPermission, User, UserProfile, hash_appkey
+from utils.constants import CacheKey, ContestRuleType
 
 
 class PermissionDecoratorTest(APITestCase):
@@ -220,6 +229,118 @@ class SessionManagementAPITest(APITestCase):
         self.assertDictEqual(resp.data, {"error": "error", "data": "Invalid session_key"})
 
 
+class SessionRecordMiddlewareTest(APITestCase):
+    def setUp(self):
+        self.user = self.create_user("test", "test123", login=False)
+        self.client.post(self.reverse("user_login_api"), data={"username": "test", "password": "test123"})
+        self.url = self.reverse("user_profile_api")
+
+    def _page_views(self, count, **headers):
+        with mock.patch("django.contrib.sessions.backends.cache.SessionStore.save", autospec=True,
+                        side_effect=CacheSessionStore.save) as save, CaptureQueriesContext(connection) as ctx:
+            for _ in range(count):
+                self.client.get(self.url, **headers)
+        user_updates = [q for q in ctx.captured_queries if q["sql"].startswith('UPDATE "user"')]
+        return save.call_count, len(user_updates)
+
+    def test_coalesced_writes(self):
+        # the first request records the new session
+        self.assertEqual(self._page_views(10), (1, 1))
+        self.assertEqual(self.client.session["ip"], "127.0.0.1")
+        self.assertEqual(self._page_views(10), (0, 0))
+        self.assertEqual(self._page_views(10, HTTP_USER_AGENT="other"), (1, 0))
+        self.assertEqual(User.objects.get(id=self.user.id).session_keys, [self.client.session.session_key])
+
+    @override_settings(SESSION_ACTIVITY_INTERVAL=0)
+    def test_activity_interval(self):
+        self.assertEqual(self._page_views(3), (3, 1))
+
+
+class APITokenAuthMiddlewareTest(APITestCase):
+    def setUp(self):
+        self.user = self.create_user("test", "test123", login=False)
+        self.user.open_api = True
+        self.user.set_open_api_appkey(rand_str())
+        self.user.save()
+        self.appkey = self.user.open_api_appkey
+        self.url = self.reverse("user_profile_api")
+        cache.delete(CacheKey.open_api_legacy_appkeys)
+
+    def tearDown(self):
+        appkey_cache.invalidate(hash_appkey(self.appkey))
+        cache.delete(CacheKey.open_api_legacy_appkeys)
+
+    def _username(self, appkey):
+        data = self.client.get(self.url, HTTP_APPKEY=appkey).data["data"]
+        return data["user"]["username"] if data else None
+
+    def _lookups(self, count):
+        with CaptureQueriesContext(connection) as ctx:
+            for _ in range(count):
+                self.assertEqual(self._username(self.appkey), "test")
+        return len([q for q in ctx.captured_queries if "open_api_appkey_hash" in q["sql"]])
+
+    def test_cached_lookup(self):
+        self.assertEqual(self._lookups(10), 1)
+        # the redis entry serves the other processes
+        appkey_cache._local.clear()
+        self.assertEqual(self._lookups(10), 0)
+
+    def test_unknown_appkey(self):
+        self.assertIsNone(self._username("unknown"))
+        self.assertIsNone(self._username(self.appkey.upper()))
+
+    def test_cached_fields(self):
+        self._username(self.appkey)
+        cached = cache.get(appkey_cache._key(hash_appkey(self.appkey)))
+        self.assertEqual(len(cached), len(appkey_cache.fields))
+        self.assertNotIn(self.user.password, cached)
+        user = appkey_cache.get(self.appkey)
+        self.assertEqual(user.get_deferred_fields(), {"password", "tfa_token", "session_keys", "open_api_appkey",
+                                                      "open_api_appkey_hash", "reset_password_token",
+                                                      "reset_password_token_expire_time", "auth_token",
+                                                      "two_factor_auth", "create_time", "last_login"})
+        # deferred fields are read when used
+        self.assertTrue(user.check_password("test123"))
+
+    def test_legacy_appkey(self):
+        appkey_cache.invalidate(hash_appkey(self.appkey))
+        User.objects.filter(id=self.user.id).update(open_api_appkey_hash=None)
+        self.assertEqual(self._username(self.appkey), "test")
+        self.assertEqual(User.objects.get(id=self.user.id).open_api_appkey_hash, hash_appkey(self.appkey))
+
+    def _plaintext_lookups(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertIsNone(self._username(rand_str()))
+        return len([q for q in ctx.captured_queries if '"open_api_appkey" =' in q["sql"]])
+
+    def test_no_legacy_lookup(self):
+        self.assertEqual(self._plaintext_lookups(), 0)
+        # left by an upgrade, until hash_open_api_appkeys runs
+        User.objects.filter(id=self.user.id).update(open_api_appkey_hash=None)
+        cache.delete(CacheKey.open_api_legacy_appkeys)
+        self.assertEqual(self._plaintext_lookups(), 1)
+        call_command("hash_open_api_appkeys", stdout=io.StringIO())
+        self.assertEqual(self._plaintext_lookups(), 0)
+        self.assertEqual(self._username(self.appkey), "test")
+
+    def test_reset_appkey(self):
+        self._username(self.appkey)
+        self.client.login(username="test", password="test123")
+        appkey = self.client.post(self.reverse("open_api_appkey_api"), data={}).data["data"]["appkey"]
+        self.client.logout()
+        self.assertIsNone(self._username(self.appkey))
+        self.assertEqual(self._username(appkey), "test")
+        self.appkey = appkey
+
+    def test_delete_user(self):
+        self._username(self.appkey)
+        self.create_super_admin()
+        self.assertSuccess(self.client.delete(self.reverse("user_admin_api") + "?id=" + str(self.user.id)))
+        self.client.logout()
+        self.assertIsNone(self._username(self.appkey))
+
+
 class UserProfileAPITest(APITestCase):
     def setUp(self):
         self.url = self.reverse("user_profile_api")
@@ -244,6 +365,18 @@ class UserProfileAPITest(APITestCase):
         self.assertEqual(data["accepted_number"], 0)
         self.assertEqual(data["language"], "en-US")
 
+    def test_problems_status(self):
+        user = self.create_user("test", "test123")
+        problem = create_problem(user)
+        ProblemStatus.record(user.id, problem.id, JudgeStatus.SOME_PASSED, 60)
+        # the frozen column is not served anymore
+        UserProfile.objects.filter(user=user).update(problems_status={"problems": {"1": {"status": 0}}})
+        resp = self.client.get(self.url)
+        self.assertSuccess(resp)
+        self.assertEqual(resp.data["data"]["problems_status"], {
+            "problems": {str(problem.id): {"status": JudgeStatus.SOME_PASSED, "_id": "A-1", "score": 60}},
+            "contest_problems": {}})
+
 
 class TwoFactorAuthAPITest(APITestCase):
     def setUp(self):
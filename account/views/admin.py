@@ -13,6 +13,7 @@ from submission.models import Submission
 from utils.api import APIView, validate_serializer
 from utils.shortcuts import rand_str
 
+from ..appkey import appkey_cache
 from ..decorators import super_admin_required
 from ..models import AdminType, ProblemPermission, User, UserProfile
 
@@ -76,12 +77,13 @@ class UserAdminAPI(APIView):
         if data["password"]:
             user.set_password(data["password"])
 
+        old_appkey_hash = user.open_api_appkey_hash
         if data["open_api"]:
             # Avoid reset user appkey after saving changes
             if not user.open_api:
-                user.open_api_appkey = rand_str()
+                user.set_open_api_appkey(rand_str())
         else:
-            user.open_api_appkey = None
+            user.set_open_api_appkey(None)
         user.open_api = data["open_api"]
         #Token
         if data["two_factor_auth"]:
@@ -94,6 +96,8 @@ class UserAdminAPI(APIView):
         user.two_factor_auth = data["two_factor_auth"]
 
         user.save()
+        # the cached user of the appkey is stale after any change
+        appkey_cache.invalidate(old_appkey_hash, user.open_api_appkey_hash)
         #用户改名之后之前任务的信息更新
         if pre_username != user.username:
             Submission.objects.filter(username=pre_username).update(username=user.username)
@@ -132,7 +136,10 @@ class UserAdminAPI(APIView):
         ids = id.split(",")
         if str(request.user.id) in ids:
             return self.error("Current user can not be deleted")
-        User.objects.filter(id__in=ids).delete()
+        users = User.objects.filter(id__in=ids)
+        appkey_hashes = list(users.exclude(open_api_appkey_hash=None).values_list("open_api_appkey_hash", flat=True))
+        users.delete()
+        appkey_cache.invalidate(*appkey_hashes)
         return self.success()
 
 class GenerateUserAPI(APIView):
@@ -11,11 +11,13 @@ from django.utils.timezone import now
 from django.views.decorators.csrf import ensure_csrf_cookie, csrf_exempt
 from otpauth import OtpAuth
 
+from judge.stats import stats
 from problem.models import Problem
 from utils.constants import ContestRuleType
 from options.options import SysOptions
 from utils.api import APIView, validate_serializer, CSRFExemptAPIView
 from utils.shortcuts import rand_str, img2base64, datetime2str
+from ..appkey import appkey_cache
 from ..decorators import login_required
 from ..models import User, UserProfile, AdminType
 from ..serializers import (ApplyResetPasswordSerializer, ResetPasswordSerializer,
@@ -47,7 +49,9 @@ class UserProfileAPI(APIView):
                 show_real_name = True
         except User.DoesNotExist:
             return self.error("User does not exist")
-        return self.success(UserProfileSerializer(user.userprofile, show_real_name=show_real_name).data)
+        data = UserProfileSerializer(user.userprofile, show_real_name=show_real_name).data
+        stats.merge_pending("profile", data, key=lambda row: row["user"]["id"])
+        return self.success(data)
 
     @validate_serializer(EditUserProfileSerializer)
     @login_required
@@ -346,7 +350,7 @@ class SessionManagementAPI(APIView):
             s["session_key"] = key
             result.append(s)
         if modified:
-            request.user.save()
+            request.user.save(update_fields=["session_keys"])
         return self.success(result)
 
     @login_required
@@ -357,7 +361,7 @@ class SessionManagementAPI(APIView):
         request.session.delete(session_key)
         if session_key in request.user.session_keys:
             request.user.session_keys.remove(session_key)
-            request.user.save()
+            request.user.save(update_fields=["session_keys"])
             return self.success("Succeeded")
         else:
             return self.error("Invalid session_key")
@@ -389,8 +393,10 @@ class OpenAPIAppkeyAPI(APIView):
         if not user.open_api:
             return self.error("OpenAPI function is truned off for you")
         api_appkey = rand_str()
-        user.open_api_appkey = api_appkey
+        old_appkey_hash = user.open_api_appkey_hash
+        user.set_open_api_appkey(api_appkey)
         user.save()
+        appkey_cache.invalidate(old_appkey_hash, user.open_api_appkey_hash)
         return self.success({"appkey": api_appkey})
 
 
@@ -17,12 +17,16 @@ from requests.exceptions import RequestException
 from account.decorators import super_admin_required
 from account.models import User
 from contest.models import Contest
+from judge.client import judge_client
 from judge.dispatcher import process_pending_task
+from judge.ports import port_allocator
+from judge.queue import judge_queue
 from options.options import SysOptions
 from problem.models import Problem
 from submission.models import Submission
 from utils.api import APIView, CSRFExemptAPIView, validate_serializer
 from utils.shortcuts import send_email, get_env
+from utils.throttling import rejected_counts
 from utils.xss_filter import XSSHtml
 from .models import JudgeServer
 from .serializers import (CreateEditWebsiteConfigSerializer,
@@ -111,12 +115,15 @@ class JudgeServerAPI(APIView):
     def get(self, request):
         servers = JudgeServer.objects.all().order_by("id")
         return self.success({"token": SysOptions.judge_server_token,
-                             "servers": JudgeServerSafeSerializer(servers, many=True).data})
+                             "servers": JudgeServerSafeSerializer(servers, many=True).data,
+                             "queue": judge_queue.depth()})
 
     @super_admin_required
     def delete(self, request):
         hostname = request.GET.get("hostname")
         if hostname:
+            for server_id in JudgeServer.objects.filter(hostname=hostname).values_list("id", flat=True):
+                port_allocator.remove(server_id)
             JudgeServer.objects.filter(hostname=hostname).delete()
         return self.success()
 
@@ -147,15 +154,17 @@ class JudgeServerHeartbeatAPI(CSRFExemptAPIView):
             server = JudgeServer.objects.get(ip=request.ip)
             # tls renew
             if "c_cert" in data:
-                server.ca_pem = data["ca_pem"],
-                server.c_cert = data["c_cert"],
-                server.c_key = data["c_key"],
+                server.ca_pem = data["ca_pem"]
+                server.c_cert = data["c_cert"]
+                server.c_key = data["c_key"]
                 server.save(update_fields=["ca_pem", "c_cert", "c_key"])
+                if server.service_url:
+                    judge_client.invalidate(server.service_url)
 
             server.cpu_core = data["cpu_core"]
             server.using_ports = data["using_ports"]
             server.available_ports = list(set(data["available_ports"]) - set(data["using_ports"]))
-            server.available_ports_num = len(data["available_ports"]) - len(data["using_ports"])
+            server.available_ports_num = port_allocator.reconcile(server.id, server.available_ports)
             server.location = data["location"]
             server.memory_usage = data["memory_usage"]
             server.cpu_usage = data["cpu_usage"]
@@ -182,6 +191,8 @@ class JudgeServerHeartbeatAPI(CSRFExemptAPIView):
                                        last_heartbeat=timezone.now(),
                                        is_ready=data["ready"],
                                        )
+            server.available_ports_num = port_allocator.reconcile(server.id, server.available_ports)
+            server.save(update_fields=["available_ports_num"])
         # 新server上线 处理队列中的，防止没有新的提交而导致一直waiting
         process_pending_task()
 
@@ -260,6 +271,7 @@ class DashboardInfoAPI(APIView):
             "recent_contest_count": recent_contest_count,
             "today_submission_count": today_submission_count,
             "judge_server_count": judge_server_count,
+            "throttled_requests": rejected_counts(),
             "env": {
                 "FORCE_HTTPS": get_env("FORCE_HTTPS", default=False),
                 "STATIC_CDN_HOST": get_env("STATIC_CDN_HOST", default="")
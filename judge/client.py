@@ -0,0 +1,245 @@
+import asyncio
+import atexit
+import hashlib
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join
+from urllib.parse import urlparse
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from conf.models import JudgeServer
+from options.options import SysOptions
+
+logger = logging.getLogger(__name__)
+
+# err of the response of an endpoint the judge server does not implement (http 404)
+NOT_FOUND = "NotFound"
+
+
+class CircuitBreaker:
+    """
+    stop calling a judge server after failure_threshold failures in a row,
+    one trial call is let through every reset_timeout seconds until a call succeeds again
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # half open, the next failure opens it for another reset_timeout
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class JudgeServerConnection:
+    """
+    keep-alive connection pool and circuit breaker of one judge server,
+    the tls material of https servers is written to private files once and reused by every request
+    """
+    def __init__(self, base_url: str, server: JudgeServer = None):
+        self.base_url = base_url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.JUDGE_POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.breaker = CircuitBreaker(settings.JUDGE_CIRCUIT_FAILURES, settings.JUDGE_CIRCUIT_RESET)
+        self._tls_dir = None
+        if base_url.startswith("https://") and server and server.ca_pem and server.c_cert and server.c_key:
+            self._load_tls(server)
+
+    def _load_tls(self, server: JudgeServer):
+        self._tls_dir = tempfile.mkdtemp(prefix="judge_tls_")
+        paths = {}
+        for name in ("ca_pem", "c_cert", "c_key"):
+            paths[name] = join(self._tls_dir, name)
+            with open(os.open(paths[name], os.O_WRONLY | os.O_CREAT, 0o600), "w") as fp:
+                fp.write(getattr(server, name))
+        self.session.verify = paths["ca_pem"]
+        self.session.cert = (paths["c_cert"], paths["c_key"])
+
+    def close(self):
+        self.session.close()
+        if self._tls_dir:
+            for name in os.listdir(self._tls_dir):
+                os.remove(join(self._tls_dir, name))
+            os.rmdir(self._tls_dir)
+
+
+class JudgeClient:
+    """
+    HTTP client of the judge servers, shared by the dispatcher and the submission status polling.
+    The core is asyncio, post_many() fans out to many servers at once. Every process has one event loop,
+    run by a daemon thread and started on first use, the blocking requests run on the pooled sessions
+    in the threads of its executor, post() and post_many() are the sync entries.
+     - idempotent calls are retried on connection errors and timeouts, others only when the connection
+       could not be made, with exponential backoff and jitter
+     - a server failing again and again is skipped by its circuit breaker instead of waiting for timeouts
+     - the tls files of the servers are removed when the process exits
+    """
+    def __init__(self, retries: int = None, backoff: float = None):
+        self.retries = settings.JUDGE_RETRIES if retries is None else retries
+        self.backoff = settings.JUDGE_RETRY_BACKOFF if backoff is None else backoff
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._token = None
+        self._loop = None
+        self._pid = os.getpid()
+        atexit.register(self.close)
+
+    def _check_fork(self):
+        # call with the lock held, the connections and the loop thread of the parent are not used in a child,
+        # the parent removes the tls files of its connections itself
+        if self._pid != os.getpid():
+            self._connections = {}
+            self._loop = None
+            self._pid = os.getpid()
+
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            self._check_fork()
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                loop.set_default_executor(ThreadPoolExecutor(thread_name_prefix="judge_client"))
+                threading.Thread(target=loop.run_forever, name="judge_client", daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop()).result()
+
+    def close(self):
+        """
+        close every connection and remove its tls files, stop the event loop
+        """
+        with self._lock:
+            self._check_fork()
+            connections, self._connections = list(self._connections.values()), {}
+            loop, self._loop = self._loop, None
+        for connection in connections:
+            connection.close()
+        if loop:
+            loop.call_soon_threadsafe(loop.stop)
+
+    @staticmethod
+    def base_url(url: str) -> str:
+        parsed = urlparse(url)
+        return f"{parsed.scheme}://{parsed.netloc}"
+
+    def connection(self, url: str) -> JudgeServerConnection:
+        base_url = self.base_url(url)
+        with self._lock:
+            self._check_fork()
+            if base_url not in self._connections:
+                server = JudgeServer.objects.filter(service_url__startswith=base_url).first()
+                self._connections[base_url] = JudgeServerConnection(base_url, server)
+            return self._connections[base_url]
+
+    def invalidate(self, url: str):
+        """
+        drop the pool of a server, the next request loads its certificates again
+        """
+        with self._lock:
+            connection = self._connections.pop(self.base_url(url), None)
+        if connection:
+            connection.close()
+
+    @property
+    def headers(self) -> dict:
+        token = SysOptions.judge_server_token
+        if not self._token or self._token[0] != token:
+            self._token = (token, hashlib.sha256(token.encode("utf-8")).hexdigest())
+        return {"X-Judge-Server-Token": self._token[1]}
+
+    def prepare(self, url: str, data: dict = None):
+        """
+        resolve the connection and the request arguments, models and options can not be read in the event loop
+        """
+        kwargs = {"headers": self.headers,
+                  "timeout": (settings.JUDGE_CONNECT_TIMEOUT, settings.JUDGE_READ_TIMEOUT)}
+        if data:
+            kwargs["json"] = data
+        return self.connection(url), url, kwargs
+
+    @staticmethod
+    def _post(connection, url, kwargs):
+        resp = connection.session.post(url, **kwargs)
+        if resp.status_code == 404:
+            # the server is up, an older judge server without this endpoint
+            return {"err": NOT_FOUND, "data": url}
+        return resp.json()
+
+    async def apost(self, connection, url, kwargs, idempotent: bool = False):
+        """
+        send a prepared request
+        :return: the decoded json response, None if the server can not be reached
+        """
+        retryable = (requests.ConnectionError, requests.Timeout) if idempotent else (requests.ConnectTimeout,)
+        for attempt in range(self.retries + 1):
+            if not connection.breaker.allow():
+                logger.warning(f"circuit of {connection.base_url} is open, skip {url}")
+                return None
+            try:
+                resp = await asyncio.to_thread(self._post, connection, url, kwargs)
+                connection.breaker.record_success()
+                return resp
+            except retryable as e:
+                connection.breaker.record_failure()
+                if attempt == self.retries:
+                    logger.exception(e)
+                    return None
+                await asyncio.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+            except Exception as e:
+                connection.breaker.record_failure()
+                logger.exception(e)
+                if isinstance(e, requests.exceptions.SSLError):
+                    # certificates renewed by the heartbeat in another process, reload them
+                    self.invalidate(url)
+                return None
+
+    def post(self, url: str, data: dict = None, idempotent: bool = False):
+        return self._run(self.apost(*self.prepare(url, data), idempotent=idempotent))
+
+    def post_many(self, calls, idempotent: bool = False) -> list:
+        """
+        send [(url, data)] concurrently, requests are started in the given order
+        :return: responses in the same order
+        """
+        prepared = [self.prepare(url, data) for url, data in calls]
+
+        async def gather():
+            return await asyncio.gather(*[self.apost(*item, idempotent=idempotent) for item in prepared])
+        return self._run(gather())
+
+
+judge_client = JudgeClient()
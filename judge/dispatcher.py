@@ -1,33 +1,84 @@
-import hashlib
-import json
 import logging
 from urllib.parse import urljoin
 
-import requests
-from django.db import transaction, IntegrityError
+from django.db import IntegrityError
 from django.db.models import F
 
 from account.models import User
 from conf.models import JudgeServer
 from contest.models import ContestStatus
-from options.options import SysOptions
 from problem.models import Problem
 from submission.models import JudgeStatus, Submission
+from submission.status import status_cache
 from utils.cache import cache
 from utils.constants import CacheKey
+from .client import NOT_FOUND, judge_client
+from .placement import get_strategy
+from .ports import port_allocator
+from .queue import judge_queue
+from .stats import stats
 
 logger = logging.getLogger(__name__)
 
 
 # 继续处理在队列中的问题
 def process_pending_task():
-    if cache.llen(CacheKey.waiting_queue):
-        # 防止循环引入
-        from judge.tasks import judge_task
-        tmp_data = cache.rpop(CacheKey.waiting_queue)
-        if tmp_data:
-            data = json.loads(tmp_data.decode("utf-8"))
-            judge_task.send(**data)
+    """
+    dispatch queued submissions until the head of the queue can not be placed.
+    Only one process drains at a time, a caller that finds the lock taken leaves a request flag,
+    the holder drains again after releasing, so freed resources are never left idle.
+    """
+    cache.set(CacheKey.waiting_queue_drain_requested, 1)
+    while cache.get(CacheKey.waiting_queue_drain_requested):
+        lock = cache.lock(CacheKey.waiting_queue_lock, timeout=60)
+        if not lock.acquire(blocking=False):
+            return
+        try:
+            cache.delete(CacheKey.waiting_queue_drain_requested)
+            drain_pending_tasks()
+        finally:
+            lock.release()
+
+
+def fail_unjudged(submission_id, err_info):
+    """
+    a waiting submission which is never dispatched, mark it failed instead of leaving it pending
+    """
+    logger.info(f"submission {submission_id} is not judged: {err_info}")
+    Submission.objects.filter(id=submission_id).update(result=JudgeStatus.SYSTEM_ERROR,
+                                                       failed_info=[{"err_info": err_info}])
+    status_cache.publish(submission_id, JudgeStatus.SYSTEM_ERROR)
+
+
+def drain_pending_tasks() -> int:
+    """
+    :return: number of submissions dispatched
+    """
+    # 防止循环引入
+    from judge.tasks import judge_task
+    # placement is checked against a snapshot updated in memory, judge_task claims the resources itself
+    servers = JudgeServerSelector.load_servers()
+    dispatched = 0
+    while True:
+        item = judge_queue.pop()
+        if not item:
+            break
+        try:
+            problem = Problem.objects.get(id=item["problem_id"])
+        except Problem.DoesNotExist:
+            fail_unjudged(item["submission_id"], "problem does not exist")
+            continue
+        chosen = JudgeServerSelector.place(servers, problem.vm_num, problem.port_num)
+        if chosen is None:
+            if not judge_queue.push_front(item):
+                fail_unjudged(item["submission_id"], "replaced by a newer submission")
+            break
+        for server, port_num in zip(chosen, problem.port_num):
+            server.task_number += 1
+            server.available_ports_num -= port_num
+        judge_task.send(submission_id=item["submission_id"], problem_id=item["problem_id"], queued=True)
+        dispatched += 1
+    return dispatched
 
 
 # 选择运行节点
@@ -38,36 +89,39 @@ class JudgeServerSelector:
         self.available_server = list()
         self.available_ports = list()
 
+    @staticmethod
+    def place(servers, vm_num, ports):
+        """
+        :return: the server of every vm, or None if the submission can not be placed
+        """
+        return get_strategy().place(servers, vm_num, ports)
+
+    @staticmethod
+    def load_servers():
+        """
+        :return: judge servers with the number of free ports in the port allocator
+        """
+        servers = list(JudgeServer.objects.all())
+        counts = port_allocator.counts([server.id for server in servers])
+        for server in servers:
+            server.available_ports_num = counts[server.id]
+        return servers
+
     def __enter__(self) -> [dict, None]:
-        # 保持一致性
-        print("Enter")
-        with transaction.atomic():
-            # 根据可用端口数量排序
-            servers: list[JudgeServer] = JudgeServer.objects.select_for_update().order_by(
-                "available_ports_num")
-            servers = [s for s in servers if s.is_ready == True]
-            print(servers)
-            index = 0
-            for server in servers:
-                if server.task_number <= server.cpu_core * 8 and index < self.vm_num and self.ports[
-                    index] < server.available_ports_num:
-                    port_item = server.available_ports[0: self.ports[index]]
-                    index = index + 1
-                    self.available_server.append(server)
-                    self.available_ports.append(port_item)
-                    if index == self.vm_num:
-                        break
-            if index == self.vm_num:
-                index = 0
-                for server in self.available_server:
-                    server.task_number = F("task_number") + 1
-                    server.available_ports_num = F("available_ports_num") - self.ports[index]
-                    server.available_ports = server.available_ports[self.ports[index]:]
-                    server.using_ports = server.using_ports + self.available_ports[index]
-                    server.save(update_fields=["task_number", "available_ports_num", "available_ports", "using_ports"])
-                    index += 1
-                return {"servers": self.available_server, "ports": self.available_ports}
-        return None
+        # ports are claimed atomically in redis, the judge server rows are not locked
+        chosen = self.place(self.load_servers(), self.vm_num, self.ports)
+        if chosen is None:
+            return None
+        ports = port_allocator.allocate([server.id for server in chosen], self.ports[:self.vm_num])
+        # taken by a concurrent dispatch since the counts were read
+        if ports is None:
+            return None
+        for index, server in enumerate(chosen):
+            JudgeServer.objects.filter(id=server.id).update(
+                task_number=F("task_number") + 1, available_ports_num=F("available_ports_num") - self.ports[index])
+        self.available_server = chosen
+        self.available_ports = ports
+        return {"servers": self.available_server, "ports": self.available_ports}
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if len(self.available_server) == self.vm_num:
@@ -76,25 +130,23 @@ class JudgeServerSelector:
 
 
 class DispatcherBase(object):
-    def __init__(self):
-        self.token = hashlib.sha256(SysOptions.judge_server_token.encode("utf-8")).hexdigest()
-
     def _request(self, url, data=None):
-        kwargs = {"headers": {"X-Judge-Server-Token": self.token}}
-        if data:
-            kwargs["json"] = data
-        try:
-            return requests.post(url, **kwargs).json()
-        except Exception as e:
-            logger.exception(e)
+        return judge_client.post(url, data)
+
+    def _request_all(self, calls, idempotent=False):
+        """
+        send [(url, data)] concurrently
+        :return: responses in the same order
+        """
+        return judge_client.post_many(calls, idempotent=idempotent)
 
 
 class JudgeDispatcher(DispatcherBase):
     def __init__(self, submission_id, problem_id):
-        super().__init__()
         self.submission = Submission.objects.get(id=submission_id)
         self.contest_id = self.submission.contest_id
-        self.last_result = self.submission.result if self.submission.info else None
+        # dispatched before, a rejudge
+        self.last_result = self.submission.result if self.submission.server_list else None
         if self.contest_id:
             self.problem = Problem.objects.select_related("contest").get(id=problem_id, contest_id=self.contest_id)
             self.contest = self.problem.contest
@@ -102,26 +154,97 @@ class JudgeDispatcher(DispatcherBase):
             self.problem = Problem.objects.get(id=problem_id)
 
     def resource_fetch(self):
-        vm_index = 0
-        submission = self.submission
-        ports_list = submission.ports_list
-
-        with transaction.atomic():
-            for server_url in submission.server_list:
-                try:
-                    server = JudgeServer.objects.get(service_url=server_url)
-                    server.available_ports = server.available_ports + ports_list[vm_index]
-                    server.using_ports = list(set(server.using_ports) - set(ports_list[vm_index]))
-                    server.available_ports_num = server.available_ports_num + len(ports_list[vm_index])
-                    server.save(update_fields=["available_ports", "using_ports", "available_ports_num"])
-                except JudgeServer.DoesNotExist:
-                    return False
-                vm_index += 1
+        if not port_allocator.release_submission(self.submission.server_list, self.submission.ports_list):
+            return False
         # 资源释放处理队列中的任务防止等待
         process_pending_task()
         return True
 
-    def judge(self):
+    def _send_judge(self, servers, data):
+        """
+        send /judge to the vm of every server, vm 0 is told last, after every other vm accepted its part,
+        the other vms are called concurrently, submitted from the highest vm_index down
+        :return: (None if every vm accepted, else the response of the first failed vm, {"err": None} when unreachable,
+                  vm indexes which accepted)
+        """
+        def call(vm_index):
+            # change to a ONL_judgeProxy
+            return urljoin(servers[vm_index].service_url, "/judge"), {**data, "vm_index": vm_index}
+
+        def failure(resp):
+            if not resp:
+                return {"err": None}
+            if resp["err"]:
+                return resp
+
+        vm_indexes = list(range(len(servers) - 1, 0, -1))
+        responses = self._request_all([call(vm_index) for vm_index in vm_indexes])
+        accepted = [vm_index for vm_index, resp in zip(vm_indexes, responses) if not failure(resp)]
+        for resp in responses:
+            if failure(resp):
+                return failure(resp), accepted
+        failed = failure(self._request(*call(0)))
+        if not failed:
+            accepted.append(0)
+        return failed, accepted
+
+    def _cancel_judge(self, servers, vm_indexes):
+        """
+        tell the vms which accepted their part of a failed submission to stop it,
+        POST /cancel {"submission_id", "vm_index"} with the token header of /judge, the judge server answers
+        {"err": None} once the vm stopped the submission or never had it, so the call can be repeated.
+        Judge servers without /cancel answer 404, their vms run the submission to the end.
+        :return: vm indexes which confirmed
+        """
+        if not vm_indexes:
+            return []
+        calls = [(urljoin(servers[vm_index].service_url, "/cancel"),
+                  {"submission_id": self.submission.id, "vm_index": vm_index}) for vm_index in vm_indexes]
+        responses = self._request_all(calls, idempotent=True)
+        confirmed = []
+        for vm_index, resp in zip(vm_indexes, responses):
+            if resp and resp["err"] == NOT_FOUND:
+                logger.warning(f"{servers[vm_index].service_url} does not support /cancel, "
+                               f"submission {self.submission.id} runs on vm {vm_index} to the end")
+            elif resp and not resp["err"]:
+                confirmed.append(vm_index)
+            else:
+                logger.error(f"failed to cancel submission {self.submission.id} on vm {vm_index}: {resp}")
+        return confirmed
+
+    def release_failed(self, servers, accepted):
+        """
+        give back the ports of a submission which some vms failed to accept
+        the ports of a vm which accepted and did not confirm the cancel are kept, that vm may still use them,
+        the heartbeat takes them back once its server reports them available
+        """
+        running = set(accepted) - set(self._cancel_judge(servers, accepted))
+        if running:
+            logger.info(f"submission {self.submission.id} may still run on vms {sorted(running)}")
+        vm_indexes = [vm_index for vm_index in range(len(servers)) if vm_index not in running]
+        port_allocator.release_submission([self.submission.server_list[i] for i in vm_indexes],
+                                          [self.submission.ports_list[i] for i in vm_indexes])
+        # 资源释放处理队列中的任务防止等待
+        process_pending_task()
+
+    def _enqueue(self):
+        replaced = judge_queue.push(self.submission.id, self.problem.id, self.submission.user_id, self.contest_id)
+        if replaced:
+            # the user submitted the same problem again, the waiting submission is never judged
+            fail_unjudged(replaced["submission_id"], f"replaced by submission {self.submission.id}")
+
+    def _requeue(self):
+        """
+        put a submission popped from the queue back to its head, it keeps its turn
+        """
+        item = judge_queue.item(self.submission.id, self.problem.id, self.submission.user_id, self.contest_id)
+        if not judge_queue.push_front(item):
+            fail_unjudged(self.submission.id, "replaced by a newer submission")
+
+    def judge(self, queued=False):
+        """
+        :param queued: the submission was popped from the waiting queue, else it is placed only if nothing is waiting
+        """
         language = self.submission.language
         code_list = self.submission.code_list
 
@@ -136,11 +259,18 @@ class JudgeDispatcher(DispatcherBase):
             data["lab_id"] = self.problem.lab_id
         else:
             data["lab_id"] = self.problem._id
+        # submissions waiting in the queue go first, contest ones before practice ones
+        if not queued and len(judge_queue):
+            self._enqueue()
+            process_pending_task()
+            return
         with JudgeServerSelector(self.problem.vm_num, self.problem.port_num) as resources:
-            # queue
+            # queue, the resources seen by the drain were taken by a concurrent dispatch
             if not resources:
-                data = {"submission_id": self.submission.id, "problem_id": self.problem.id}
-                cache.lpush(CacheKey.waiting_queue, json.dumps(data))
+                if queued:
+                    self._requeue()
+                else:
+                    self._enqueue()
                 return
             servers: list[JudgeServer] = resources["servers"]
             ports: list[int] = resources["ports"]
@@ -161,29 +291,21 @@ class JudgeDispatcher(DispatcherBase):
             Submission.objects.filter(id=self.submission.id).update(result=JudgeStatus.PENDING)
             data["ports"] = self.submission.ports_list
             data["server_list"] = self.submission.server_list
-            vm_index = len(servers) - 1
-            for server in reversed(servers):
-                # change to a ONL_judgeProxy
-                data["vm_index"] = vm_index
-
-                resp = self._request(urljoin(server.service_url, "/judge"), data=data)
-
-                if not resp:
-                    self.resource_fetch()
+            failed, accepted = self._send_judge(servers, data)
+            if failed:
+                # 回收资源
+                self.release_failed(servers, accepted)
+                if failed["err"]:
+                    logger.info(f"submission {self.submission.id} failed on the judge server: {failed['data']}")
+                    Submission.objects.filter(id=self.submission.id).update(
+                        result=JudgeStatus.ALL_FAILED, grade=0, failed_info=[{"err_info": failed["data"]}])
+                    status_cache.publish(self.submission.id, JudgeStatus.ALL_FAILED, 0)
+                else:
                     Submission.objects.filter(id=self.submission.id).update(result=JudgeStatus.SYSTEM_ERROR)
-                    return
-
-                if resp["err"]:
-                    Submission.objects.filter(id=self.submission.id).update(result=JudgeStatus.COMPILE_ERROR)
-                    print(resp["data"])
-                    self.submission.info["err_info"] = resp["data"]
-                    self.submission.info["score"] = 0
-                    # 回收资源
-                    self.resource_fetch()
-                    return
-                vm_index -= 1
-
-            Problem.objects.filter(id=self.problem.id).update(submission_number=F("submission_number") + 1)
+                    status_cache.publish(self.submission.id, JudgeStatus.SYSTEM_ERROR)
+                return
+
+            stats.incr("problem", self.problem.id, submission_number=1)
 
         # 下发完成，尝试处理任务队列中剩余的任务
         process_pending_task()
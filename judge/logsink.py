@@ -0,0 +1,201 @@
+import ctypes
+import logging
+import os
+import threading
+from collections import deque
+from os.path import join, exists
+
+logger = logging.getLogger(__name__)
+
+MAX_LOG_LINES = 1000
+MAX_LOG_BYTES = 256 * 1024
+# bytes the logs of a submission may hold on disk before their tails are moved into the ring buffers
+CAP_LOG_BYTES = 4 * 1024 * 1024
+
+# see linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+
+
+def punch_hole(fd: int, offset: int, length: int) -> bool:
+    """
+    free the disk blocks of a range of a file, the size and the offsets of its writers are kept
+    :return: False if the filesystem does not support it
+    """
+    return _libc.fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) == 0
+
+
+class LogRingBuffer:
+    """
+    keep only the last max_lines lines and at most max_bytes bytes of a log stream
+    """
+    def __init__(self, max_lines: int = MAX_LOG_LINES, max_bytes: int = MAX_LOG_BYTES):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.truncated = False
+        self._lines = deque()
+        self._size = 0
+        self._partial = b""
+
+    def write(self, data: bytes):
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self._lines.append(line + b"\n")
+            self._size += len(line) + 1
+        if len(self._partial) > self.max_bytes:
+            self._partial = self._partial[-self.max_bytes:]
+            self.truncated = True
+        # an unterminated last line counts as a line, the same as tail does
+        while self._lines and (len(self._lines) + bool(self._partial) > self.max_lines or
+                               self._size + len(self._partial) > self.max_bytes):
+            self._size -= len(self._lines.popleft())
+            self.truncated = True
+
+    def load_tail(self, file_path: str):
+        # read the tail of a regular file without loading the whole file
+        size = os.path.getsize(file_path)
+        with open(file_path, "rb") as fp:
+            if size > self.max_bytes:
+                fp.seek(size - self.max_bytes)
+                self.truncated = True
+            self.write(fp.read())
+
+    def getvalue(self) -> str:
+        content = (b"".join(self._lines) + self._partial).decode("utf-8", errors="replace")
+        if not self.truncated:
+            return content
+        if len(self._lines) + bool(self._partial) >= self.max_lines:
+            return f"log file is too long, only show the last {self.max_lines} lines:\n" + content
+        return f"log file is too long, only show the last {self.max_bytes} bytes:\n" + content
+
+
+class TestcaseLogSink:
+    """
+    Capture testcase logs written by the tester to logs/testcase<i>.log.
+    The tester writes regular files at full speed, a watcher thread keeps them small on disk:
+    once the logs of the submission hold more than cap_bytes not collected, the tail of every log goes into
+    its ring buffer and the collected bytes are punched out of the files, the disk used stays under cap_bytes
+    plus what the testers write in one interval.
+    Without hole punching the collected logs are truncated, a writer without O_APPEND goes on at its offset
+    and leaves a hole, what it wrote between the read and the truncate is lost.
+    After the tester exits the rest of every log is collected and the log files are removed.
+    """
+    def __init__(self, max_lines: int = MAX_LOG_LINES, max_bytes: int = MAX_LOG_BYTES,
+                 cap_bytes: int = CAP_LOG_BYTES, interval: float = 0.2):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.cap_bytes = cap_bytes
+        self.interval = interval
+        # testcase index (starts from 1) -> LogRingBuffer
+        self.buffers = {}
+        self._logs = []
+        # testcase index -> (st_ino, bytes collected, truncated by the sink) of its log file
+        self._collected = {}
+        self._punch_hole = True
+        self._closed = threading.Event()
+        self._thread = None
+
+    def add_log_dir(self, log_dir: str, indexes):
+        """
+        :param log_dir: logs directory of a tester
+        :param indexes: global testcase index of testcase1.log, testcase2.log ... in log_dir
+        """
+        os.makedirs(log_dir, exist_ok=True)
+        for local_idx, idx in enumerate(indexes, 1):
+            path = join(log_dir, f"testcase{local_idx}.log")
+            if exists(path):
+                os.remove(path)
+            self.buffers[idx] = LogRingBuffer(self.max_lines, self.max_bytes)
+            self._logs.append((path, idx))
+
+    def start(self):
+        self._closed.clear()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    def _watch(self):
+        while not self._closed.wait(self.interval):
+            self._collect_over_cap()
+
+    def _collect_over_cap(self):
+        pending = 0
+        for path, idx in self._logs:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            inode, offset, _ = self._collected.get(idx, (st.st_ino, 0, False))
+            pending += st.st_size - offset if inode == st.st_ino and st.st_size >= offset else st.st_size
+        if pending > self.cap_bytes:
+            for path, idx in self._logs:
+                self._collect(path, idx)
+
+    def _collect(self, path: str, idx: int, free: bool = True):
+        """
+        move the tail of what was written to path since the last collect into the ring buffer
+        :param free: give the collected bytes of the file back to the filesystem
+        """
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except (FileNotFoundError, IsADirectoryError):
+            return
+        try:
+            st = os.fstat(fd)
+            inode, offset, truncated = self._collected.get(idx, (st.st_ino, 0, False))
+            if inode != st.st_ino or st.st_size < offset:
+                # replaced or truncated by the tester, only the new content counts
+                self.buffers[idx] = LogRingBuffer(self.max_lines, self.max_bytes)
+                offset, truncated = 0, False
+            if st.st_size == offset:
+                self._collected[idx] = (st.st_ino, offset, truncated)
+                return
+            buffer = self.buffers[idx]
+            start = max(offset, st.st_size - self.max_bytes)
+            if start > offset:
+                buffer.truncated = True
+            data = os.pread(fd, st.st_size - start, start)
+            if truncated:
+                # the hole left by a writer without O_APPEND
+                data = data.lstrip(b"\0")
+            buffer.write(data)
+            if not free:
+                self._collected[idx] = (st.st_ino, st.st_size, False)
+            elif self._punch_hole and punch_hole(fd, 0, st.st_size):
+                self._collected[idx] = (st.st_ino, st.st_size, False)
+            else:
+                if self._punch_hole:
+                    logger.warning(f"hole punching is not supported on {path}: "
+                                   f"{os.strerror(ctypes.get_errno())}, the logs are truncated")
+                    self._punch_hole = False
+                os.ftruncate(fd, 0)
+                self._collected[idx] = (st.st_ino, 0, True)
+        finally:
+            os.close(fd)
+
+    def stop(self):
+        """
+        call after the tester exits, collect what is left in the logs and remove them
+        """
+        if self._thread:
+            self._closed.set()
+            self._thread.join()
+            self._thread = None
+        for path, idx in self._logs:
+            self._collect(path, idx, free=False)
+            if exists(path):
+                os.remove(path)
+        self._logs = []
+        self._collected = {}
+
+    def getvalue(self, idx: int) -> str:
+        if idx not in self.buffers:
+            return ""
+        return self.buffers[idx].getvalue()
+
+    def write_log(self, idx: int, file_path: str):
+        with open(file_path, "w") as fp:
+            fp.write(self.getvalue(idx))
@@ -0,0 +1,143 @@
+import heapq
+import json
+import random
+from collections import deque
+
+from django.core.management.base import BaseCommand
+
+from conf.models import JudgeServer
+from judge.placement import strategies
+from submission.models import Submission
+
+
+def synthetic_arrivals(count, rate, duration, rng):
+    arrivals = []
+    now = 0.0
+    for _ in range(count):
+        now += rng.expovariate(rate)
+        vm_num = rng.choice([1, 1, 1, 2, 2, 3])
+        arrivals.append({"time": now, "vm_num": vm_num,
+                         "port_num": [rng.randint(1, 4) for _ in range(vm_num)],
+                         "duration": rng.expovariate(1 / duration)})
+    return arrivals
+
+
+def recorded_arrivals(count, duration):
+    submissions = Submission.objects.select_related("problem").order_by("-create_time")[:count]
+    submissions = sorted(submissions, key=lambda s: s.create_time)
+    if not submissions:
+        return []
+    start = submissions[0].create_time
+    return [{"time": (s.create_time - start).total_seconds(), "vm_num": s.problem.vm_num,
+             "port_num": s.problem.port_num, "duration": s.execution_time or duration}
+            for s in submissions if len(s.problem.port_num) >= s.problem.vm_num]
+
+
+def synthetic_servers(count, rng):
+    return [{"cpu_core": rng.choice([4, 8, 16]), "ports": rng.randint(20, 60)} for _ in range(count)]
+
+
+class Simulator:
+    """
+    replay submission arrivals against a simulated cluster, the waiting queue is drained
+    until the head can not be placed, the same as process_pending_task does
+    """
+    def __init__(self, strategy, servers):
+        self.strategy = strategy
+        self.servers = []
+        for item in servers:
+            server = JudgeServer(cpu_core=item["cpu_core"], is_ready=True, is_disabled=False, task_number=0,
+                                 available_ports_num=item["ports"], cpu_usage=0, memory_usage=0)
+            server.total_ports = item["ports"]
+            self.servers.append(server)
+
+    def _update_metrics(self, server):
+        # heartbeat metrics grow with the tasks and ports in use
+        server.cpu_usage = min(100.0, 90.0 * server.task_number / (server.cpu_core * self.strategy.tasks_per_core))
+        server.memory_usage = 80.0 * (1 - server.available_ports_num / server.total_ports)
+
+    def run(self, arrivals):
+        events = []
+        for seq, item in enumerate(arrivals):
+            heapq.heappush(events, (item["time"], seq, "arrive", item))
+        seq = len(arrivals)
+        queue = deque()
+        waits = []
+        max_queue = 0
+        end = 0.0
+        while events:
+            now, _, kind, payload = heapq.heappop(events)
+            if kind == "arrive":
+                queue.append(payload)
+                max_queue = max(max_queue, len(queue))
+            else:
+                for server, ports in payload:
+                    server.task_number -= 1
+                    server.available_ports_num += ports
+                    self._update_metrics(server)
+                end = now
+            while queue:
+                item = queue[0]
+                chosen = self.strategy.place(self.servers, item["vm_num"], item["port_num"])
+                if chosen is None:
+                    break
+                queue.popleft()
+                for server, ports in zip(chosen, item["port_num"]):
+                    server.task_number += 1
+                    server.available_ports_num -= ports
+                    self._update_metrics(server)
+                waits.append(now - item["time"])
+                seq += 1
+                heapq.heappush(events, (now + item["duration"], seq, "finish",
+                                        list(zip(chosen, item["port_num"]))))
+        waits.sort()
+        makespan = end - arrivals[0]["time"] if arrivals else 0
+        return {
+            "completed": len(waits),
+            "unplaced": len(queue),
+            "throughput": len(waits) / makespan * 60 if makespan else 0,
+            "mean_wait": sum(waits) / len(waits) if waits else 0,
+            "p95_wait": waits[int(len(waits) * 0.95)] if waits else 0,
+            "max_queue": max_queue,
+        }
+
+
+class Command(BaseCommand):
+    help = "replay submission arrivals against a simulated cluster and compare placement strategies"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--arrivals", help="json file of [{time, vm_num, port_num, duration}]")
+        parser.add_argument("--from-db", type=int, default=0, help="replay the last N submissions")
+        parser.add_argument("--servers", help="json file of [{cpu_core, ports}]")
+        parser.add_argument("--server-num", type=int, default=6)
+        parser.add_argument("--count", type=int, default=2000)
+        parser.add_argument("--rate", type=float, default=2.0, help="synthetic arrivals per second")
+        parser.add_argument("--duration", type=float, default=20.0, help="mean judge seconds")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--strategy", nargs="+", default=list(strategies.keys()))
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        if options["arrivals"]:
+            with open(options["arrivals"]) as fp:
+                arrivals = json.load(fp)
+        elif options["from_db"]:
+            arrivals = recorded_arrivals(options["from_db"], options["duration"])
+        else:
+            arrivals = synthetic_arrivals(options["count"], options["rate"], options["duration"], rng)
+        if options["servers"]:
+            with open(options["servers"]) as fp:
+                servers = json.load(fp)
+        else:
+            servers = synthetic_servers(options["server_num"], rng)
+        arrivals.sort(key=lambda item: item["time"])
+
+        self.stdout.write(f"{len(arrivals)} submissions on {len(servers)} servers "
+                          f"({sum(s['ports'] for s in servers)} ports, {sum(s['cpu_core'] for s in servers)} cores)")
+        self.stdout.write(f"{'strategy':>14} {'done':>6} {'left':>5} {'per min':>8} "
+                          f"{'mean wait s':>12} {'p95 wait s':>11} {'max queue':>10}")
+        for name in options["strategy"]:
+            result = Simulator(strategies[name](), servers).run(arrivals)
+            self.stdout.write(f"{name:>14} {result['completed']:>6} {result['unplaced']:>5} "
+                              f"{result['throughput']:>8.1f} {result['mean_wait']:>12.2f} "
+                              f"{result['p95_wait']:>11.2f} {result['max_queue']:>10}")
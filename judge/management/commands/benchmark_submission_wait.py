@@ -0,0 +1,153 @@
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from account.models import User, UserProfile
+from problem.models import Problem
+from submission.models import JudgeStatus, Submission
+from submission.status import status_cache
+from utils.shortcuts import rand_str
+
+
+class Judge(threading.Thread):
+    """
+    finish a submission after its judge time, the same way local_judge_task does
+    """
+    def __init__(self, submission_id, delay):
+        super().__init__(daemon=True)
+        self.submission_id = submission_id
+        self.delay = delay
+        self.finished_at = None
+
+    def run(self):
+        time.sleep(self.delay)
+        self.finished_at = time.perf_counter()
+        Submission.objects.filter(id=self.submission_id).update(result=JudgeStatus.ALL_PASSED, grade=100)
+        status_cache.publish(self.submission_id, JudgeStatus.ALL_PASSED, 100)
+        connection.close()
+
+
+class Student(threading.Thread):
+    """
+    submit one by one and follow every submission until it is judged
+    """
+    def __init__(self, command, user, problem, durations, pattern, scale, interval):
+        super().__init__(daemon=True)
+        self.command = command
+        self.user = user
+        self.problem = problem
+        self.durations = durations
+        self.pattern = pattern
+        self.scale = scale
+        self.interval = interval
+        self.requests = self.queries = self.latency = self.capped = 0
+
+    def run(self):
+        client = Client()
+        client.force_login(self.user)
+        for duration in self.durations:
+            submission = Submission.objects.create(problem=self.problem, user_id=str(self.user.id),
+                                                   username=self.user.username, language="Python3", code_list=[""],
+                                                   result=JudgeStatus.JUDGING)
+            judge = Judge(submission.id, duration * self.scale)
+            judge.start()
+            with CaptureQueriesContext(connection) as ctx:
+                sent, capped, seen_at = getattr(self.command, f"_{self.pattern}")(client, submission.id,
+                                                                                  self.interval, self.scale)
+            judge.join()
+            self.requests += sent
+            self.capped += capped
+            self.latency += seen_at - judge.finished_at
+            self.queries += len(ctx.captured_queries)
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = "compare requests and queries per finished submission of polling SubmissionAPI and of the wait api, " \
+           "concurrent students run against a test database which is dropped afterwards"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=8, help="students submitting at the same time")
+        parser.add_argument("--submissions", type=int, default=10, help="submissions of every student")
+        parser.add_argument("--duration", type=float, default=30.0, help="mean judge seconds")
+        parser.add_argument("--interval", type=float, default=2.0, help="seconds between two polls of the client")
+        parser.add_argument("--scale", type=float, default=0.02, help="time scale, 0.02 runs 50 times faster")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def _poll(self, client, submission_id, interval, scale):
+        requests = 0
+        while True:
+            resp = client.get(reverse("submission_api"), {"id": submission_id}).json()
+            requests += 1
+            if resp["data"]["result"] not in (JudgeStatus.PENDING, JudgeStatus.JUDGING):
+                return requests, 0, time.perf_counter()
+            time.sleep(interval * scale)
+
+    def _wait(self, client, submission_id, interval, scale):
+        requests = capped = 0
+        while True:
+            data = client.get(reverse("submission_wait_api"), {"id": submission_id}).json()["data"]
+            requests += 1
+            if data["result"] not in (JudgeStatus.PENDING, JudgeStatus.JUDGING):
+                break
+            if "retry_after" in data:
+                # not allowed to wait, back off until a waiter leaves, no longer than a poll interval,
+                # retry_after is scaled already as the wait timeout is
+                capped += 1
+                time.sleep(min(max(data["retry_after"], 0.1 * scale), interval * scale))
+        seen_at = time.perf_counter()
+        # the client shows the judged submission
+        client.get(reverse("submission_api"), {"id": submission_id})
+        return requests + 1, capped, seen_at
+
+    def _run(self, problem, users, durations, pattern, scale, interval):
+        students = [Student(self, user, problem, durations[i::len(users)], pattern, scale, interval)
+                    for i, user in enumerate(users)]
+        for student in students:
+            student.start()
+        for student in students:
+            student.join()
+        count = len(durations)
+        return (sum(s.requests for s in students) / count, sum(s.queries for s in students) / count,
+                sum(s.latency for s in students) / count / scale, sum(s.capped for s in students) / count)
+
+    def _setup(self, clients):
+        users = []
+        for i in range(clients):
+            user = User.objects.create(username=f"benchmark_{i}_{rand_str(8)}")
+            UserProfile.objects.create(user=user)
+            users.append(user)
+        problem = Problem.objects.create(_id=f"benchmark_{rand_str(8)}", title="benchmark", description="",
+                                         timeout=30, code_num=1, code_names=["main.py"], created_by=users[0])
+        return users, problem
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        clients = options["clients"]
+        durations = [rng.expovariate(1 / options["duration"]) for _ in range(clients * options["submissions"])]
+        scale = options["scale"]
+        wait_timeout = settings.SUBMISSION_WAIT_TIMEOUT
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        settings.SUBMISSION_WAIT_TIMEOUT = wait_timeout * scale
+        try:
+            users, problem = self._setup(clients)
+            self.stdout.write(f"{clients} students, {len(durations)} submissions, mean judge {options['duration']}s, "
+                              f"poll every {options['interval']}s, wait timeout {wait_timeout}s, "
+                              f"{settings.SUBMISSION_WAIT_MAX_WAITERS} waiters at most")
+            self.stdout.write(f"{'client':>8} {'requests/sub':>13} {'queries/sub':>12} {'latency s':>10} "
+                              f"{'capped/sub':>11}")
+            for pattern in ["poll", "wait"]:
+                requests, queries, latency, capped = self._run(problem, users, durations, pattern,
+                                                               scale, options["interval"])
+                self.stdout.write(f"{pattern:>8} {requests:>13.1f} {queries:>12.1f} {latency:>10.2f} "
+                                  f"{capped:>11.1f}")
+        finally:
+            settings.SUBMISSION_WAIT_TIMEOUT = wait_timeout
+            connection.creation.destroy_test_db(old_name, verbosity=0)
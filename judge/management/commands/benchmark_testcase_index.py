@@ -0,0 +1,71 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+from os.path import join
+
+from django.core.management.base import BaseCommand
+
+from judge.testing import TESTCASE_NAME, TestcaseIndexCache
+
+
+def reparse_failed_info(file_path, failed_indexes):
+    # the failed info assembly before TestcaseIndex, testcases.json is parsed once per failed testcase
+    failed_info = []
+    for idx in failed_indexes:
+        with open(file_path) as fp:
+            testcase_json_data = json.load(fp)
+        if "config" in testcase_json_data:
+            config = testcase_json_data["config"]
+        else:
+            config = testcase_json_data["testcases"][idx - 1].get("config")
+        failed_info.append({
+            "config": config,
+            "testcase_index": idx,
+            "testcase": {
+                "input": testcase_json_data["testcases"][idx - 1]["input"],
+                "expected_output": testcase_json_data["testcases"][idx - 1]["output"],
+            },
+        })
+    return failed_info
+
+
+class Command(BaseCommand):
+    help = "compare failed info assembly with and without the cached testcase index"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--testcases", type=int, default=500)
+        parser.add_argument("--failed", type=int, nargs="+", default=[1, 20, 200])
+        parser.add_argument("--submissions", type=int, default=20)
+
+    def handle(self, *args, **options):
+        root = tempfile.mkdtemp()
+        try:
+            file_path = join(root, TESTCASE_NAME)
+            testcases = [{"input": {"seed": i, "payload": "x" * 256},
+                          "output": {"expected": i},
+                          "config": {"loss_rate": 0.01 * (i % 10)}} for i in range(options["testcases"])]
+            with open(file_path, "w") as fp:
+                json.dump({"testcases": testcases}, fp)
+            size_kb = os.path.getsize(file_path) / 1024
+            self.stdout.write(f"{options['testcases']} testcases, testcases.json {size_kb:.1f} KB, "
+                              f"{options['submissions']} submissions per run")
+            self.stdout.write(f"{'failed':>8} {'reparse ms/sub':>15} {'index ms/sub':>13}")
+            for failed_num in options["failed"]:
+                failed_indexes = list(range(1, min(failed_num, options["testcases"]) + 1))
+
+                start = time.perf_counter()
+                for _ in range(options["submissions"]):
+                    reparse_failed_info(file_path, failed_indexes)
+                reparse = (time.perf_counter() - start) / options["submissions"]
+
+                cache = TestcaseIndexCache()
+                start = time.perf_counter()
+                for _ in range(options["submissions"]):
+                    index = cache.get(1, file_path)
+                    [index.failed_entry(idx) for idx in failed_indexes]
+                cached = (time.perf_counter() - start) / options["submissions"]
+                self.stdout.write(f"{failed_num:>8} {reparse * 1000:>15.3f} {cached * 1000:>13.3f}")
+        finally:
+            shutil.rmtree(root)
@@ -0,0 +1,81 @@
+import io
+import os
+import shutil
+import tempfile
+import time
+from contextlib import redirect_stdout
+from os.path import join
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from judge.workspace import LinkMode, ProblemPackage, SubmissionWorkspace
+
+
+def disk_used(path):
+    st = os.statvfs(path)
+    return (st.f_blocks - st.f_bfree) * st.f_frsize
+
+
+class Command(BaseCommand):
+    help = "compare submission workspace setup time and disk usage of copy and link modes, " \
+           "the assets are verified against the problem package as SubmissionTester does"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100], help="asset size in MB")
+        parser.add_argument("--submissions", type=int, default=20)
+        parser.add_argument("--dir", type=str, default=settings.DATA_DIR,
+                            help="benchmark on the filesystem holding this directory")
+
+    def _make_problem(self, root, size_mb):
+        problem_dir = join(root, "problem")
+        os.makedirs(problem_dir)
+        with open(join(problem_dir, "tester"), "wb") as f:
+            f.write(os.urandom(1024 * 1024))
+        os.chmod(join(problem_dir, "tester"), 0o755)
+        with open(join(problem_dir, "testcases.json"), "w") as f:
+            f.write('{"testcases": []}')
+        with open(join(problem_dir, "dataset.bin"), "wb") as f:
+            for _ in range(max(size_mb - 1, 0)):
+                f.write(os.urandom(1024 * 1024))
+        with open(join(problem_dir, "student.py"), "w") as f:
+            f.write("# template\n")
+        return problem_dir
+
+    def _run(self, root, problem_dir, package, mode, count):
+        sub_root = join(root, mode)
+        before = disk_used(root)
+        elapsed = verify_elapsed = 0
+        used = set()
+        for i in range(count):
+            workspace = SubmissionWorkspace(problem_dir, join(sub_root, str(i)), ["student.py"], mode=mode,
+                                            package=package)
+            start = time.perf_counter()
+            with redirect_stdout(io.StringIO()):
+                workspace.build(["print('hello')\n"])
+            elapsed += time.perf_counter() - start
+            # the check after the tester run
+            start = time.perf_counter()
+            workspace.verify_assets()
+            verify_elapsed += time.perf_counter() - start
+            used.update(workspace.linked_files.values())
+        delta = disk_used(root) - before
+        shutil.rmtree(sub_root)
+        return elapsed / count, verify_elapsed / count, delta / count, ",".join(sorted(used))
+
+    def handle(self, *args, **options):
+        count = options["submissions"]
+        self.stdout.write(f"{'assets':>8} {'mode':>8} {'used':>16} {'setup ms':>10} {'verify ms':>10} "
+                          f"{'disk KB/sub':>12}")
+        for size_mb in options["sizes"]:
+            root = tempfile.mkdtemp(dir=options["dir"])
+            try:
+                problem_dir = self._make_problem(root, size_mb)
+                package = ProblemPackage(join(root, "package.zip"))
+                package.create(problem_dir)
+                for mode in [LinkMode.Copy, LinkMode.Reflink]:
+                    elapsed, verify_elapsed, delta, used = self._run(root, problem_dir, package, mode, count)
+                    self.stdout.write(f"{size_mb:>6}MB {mode:>8} {used:>16} {elapsed * 1000:>10.2f} "
+                                      f"{verify_elapsed * 1000:>10.2f} {delta / 1024:>12.1f}")
+            finally:
+                shutil.rmtree(root)
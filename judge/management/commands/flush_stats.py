@@ -0,0 +1,30 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from judge.stats import stats
+
+
+class Command(BaseCommand):
+    help = "periodically apply the aggregated submission counters to the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=settings.STATS_FLUSH_INTERVAL,
+                            help="seconds between two flushes")
+        parser.add_argument("--once", action="store_true", help="flush once and exit")
+
+    def handle(self, *args, **options):
+        if not stats.enabled:
+            self.stdout.write(self.style.WARNING("STATS_FLUSH_INTERVAL is 0, counters are written directly"))
+            return
+        while True:
+            try:
+                updated = stats.flush()
+                if updated:
+                    self.stdout.write(f"flushed counters of {updated} rows")
+            except Exception as e:
+                self.stderr.write(f"flush failed, will be replayed: {e}")
+            if options["once"]:
+                return
+            time.sleep(options["interval"])
@@ -0,0 +1,109 @@
+from django.conf import settings
+
+
+class PlacementStrategy:
+    """
+    Choose a judge server for every vm of a submission in one pass.
+    A server takes at most one vm of a submission, it is eligible when it is ready, not disabled,
+    has a free task slot, enough free ports and its heartbeat metrics are under the limits.
+    Vms are placed from the largest port demand down, each on the eligible server with the lowest score().
+    """
+    name = None
+    # task slots per cpu core
+    tasks_per_core = 8
+    # servers reporting a higher usage in the heartbeat take no new vm
+    max_cpu_usage = 95
+    max_memory_usage = 95
+
+    def capacity(self, server) -> int:
+        return (server.cpu_core or 0) * self.tasks_per_core
+
+    def load(self, server) -> float:
+        """
+        :return: the highest of task slot, cpu and memory usage, from 0 to 1
+        """
+        capacity = self.capacity(server)
+        task_load = server.task_number / capacity if capacity else 1
+        return max(task_load, (server.cpu_usage or 0) / 100, (server.memory_usage or 0) / 100)
+
+    def eligible(self, server, ports: int) -> bool:
+        return (server.is_ready and not server.is_disabled and
+                server.task_number < self.capacity(server) and
+                ports <= server.available_ports_num and
+                (server.cpu_usage or 0) <= self.max_cpu_usage and
+                (server.memory_usage or 0) <= self.max_memory_usage)
+
+    def score(self, server, ports: int):
+        raise NotImplementedError()
+
+    def place(self, servers, vm_num: int, ports: list):
+        """
+        :param ports: number of ports of every vm
+        :return: the server of every vm, or None if the submission can not be placed
+        """
+        chosen = [None] * vm_num
+        used = set()
+        for index in sorted(range(vm_num), key=lambda i: ports[i], reverse=True):
+            candidates = [s for s in servers if id(s) not in used and self.eligible(s, ports[index])]
+            if not candidates:
+                return None
+            server = min(candidates, key=lambda s: self.score(s, ports[index]))
+            chosen[index] = server
+            used.add(id(server))
+        return chosen
+
+
+class FirstFit(PlacementStrategy):
+    """
+    the placement before strategies were added, vms in order on servers sorted by free ports
+    """
+    name = "first-fit"
+
+    def place(self, servers, vm_num: int, ports: list):
+        chosen = []
+        for server in sorted(servers, key=lambda s: s.available_ports_num):
+            if len(chosen) == vm_num:
+                break
+            if self.eligible(server, ports[len(chosen)]):
+                chosen.append(server)
+        return chosen if len(chosen) == vm_num else None
+
+
+class BestFit(PlacementStrategy):
+    """
+    the server left with the fewest free ports, keeps large servers free for large labs
+    """
+    name = "best-fit"
+
+    def score(self, server, ports: int):
+        return server.available_ports_num - ports, self.load(server)
+
+
+class LeastLoaded(PlacementStrategy):
+    """
+    the server with the lowest task slot, cpu or memory usage
+    """
+    name = "least-loaded"
+
+    def score(self, server, ports: int):
+        return self.load(server), server.available_ports_num - ports
+
+
+class Spread(PlacementStrategy):
+    """
+    the server left with the most free ports, spreads vms evenly over the cluster
+    """
+    name = "spread"
+
+    def score(self, server, ports: int):
+        return ports - server.available_ports_num, server.task_number
+
+
+strategies = {cls.name: cls for cls in (FirstFit, BestFit, LeastLoaded, Spread)}
+
+
+def get_strategy(name: str = None) -> PlacementStrategy:
+    name = name or getattr(settings, "JUDGE_PLACEMENT_STRATEGY", BestFit.name)
+    if name not in strategies:
+        raise ValueError(f"unknown placement strategy {name}")
+    return strategies[name]()
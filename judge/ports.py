@@ -0,0 +1,167 @@
+import time
+
+from django.conf import settings
+from django.db.models import F
+
+from conf.models import JudgeServer
+from utils.cache import cache
+from utils.constants import CacheKey
+
+# KEYS: free and used bitmap of every server, ARGV: number of ports to take from every server
+# all or nothing, returns a list of ports for every server or false
+ALLOCATE_SCRIPT = """
+local result = {}
+local function rollback()
+    for k = 1, #result do
+        for _, port in ipairs(result[k]) do
+            redis.call('SETBIT', KEYS[2 * k - 1], port, 1)
+            redis.call('SETBIT', KEYS[2 * k], port, 0)
+        end
+    end
+end
+for i = 1, #ARGV do
+    local free, used = KEYS[2 * i - 1], KEYS[2 * i]
+    local ports = {}
+    table.insert(result, ports)
+    for j = 1, tonumber(ARGV[i]) do
+        local port = redis.call('BITPOS', free, 1)
+        if port < 0 then
+            rollback()
+            return false
+        end
+        redis.call('SETBIT', free, port, 0)
+        redis.call('SETBIT', used, port, 1)
+        table.insert(ports, port)
+    end
+end
+return result
+"""
+
+# KEYS: free and used bitmap and seen hash of a server, ARGV: ports
+RELEASE_SCRIPT = """
+local released = 0
+for _, port in ipairs(ARGV) do
+    redis.call('HDEL', KEYS[3], port)
+    if redis.call('SETBIT', KEYS[2], port, 0) == 1 then
+        redis.call('SETBIT', KEYS[1], port, 1)
+        released = released + 1
+    end
+end
+return released
+"""
+
+# KEYS: free and used bitmap and seen hash of a server
+# ARGV: now, grace seconds, then the ports the server reports available and not in use
+# seen keeps the time a used port was first reported available, the release of a port still reported
+# available after the grace seconds was lost, so it is taken back
+RECONCILE_SCRIPT = """
+local free, used, seen = KEYS[1], KEYS[2], KEYS[3]
+local now, grace = tonumber(ARGV[1]), tonumber(ARGV[2])
+local available = {}
+redis.call('DEL', free)
+for i = 3, #ARGV do
+    local port = ARGV[i]
+    available[port] = true
+    if redis.call('GETBIT', used, port) == 0 then
+        redis.call('SETBIT', free, port, 1)
+    else
+        local since = redis.call('HGET', seen, port)
+        if not since then
+            redis.call('HSET', seen, port, now)
+        elseif now - tonumber(since) >= grace then
+            redis.call('HDEL', seen, port)
+            redis.call('SETBIT', used, port, 0)
+            redis.call('SETBIT', free, port, 1)
+        end
+    end
+end
+for _, port in ipairs(redis.call('HKEYS', seen)) do
+    if not available[port] then
+        redis.call('HDEL', seen, port)
+    end
+end
+return redis.call('BITCOUNT', free)
+"""
+
+
+class PortAllocator:
+    """
+    Ports of the judge servers, kept in redis as two bitmaps per server, bit n stands for port n.
+     - free: ports reported available by the heartbeat and not handed out
+     - used: ports handed out to submissions and not released yet
+    Allocate and release are single lua scripts, atomic across all web and worker processes,
+    so claiming ports needs no lock on the judge server rows.
+    The heartbeat rebuilds the free bitmap from what the server reports, ports in use are kept out of it,
+    unless the server keeps reporting them available for JUDGE_PORT_RECLAIM_GRACE seconds, their release was lost.
+    """
+    def __init__(self, prefix: str = CacheKey.judge_ports):
+        self.prefix = prefix
+        self._allocate = cache.register_script(ALLOCATE_SCRIPT)
+        self._release = cache.register_script(RELEASE_SCRIPT)
+        self._reconcile = cache.register_script(RECONCILE_SCRIPT)
+
+    def _keys(self, server_id):
+        return [f"{self.prefix}:{server_id}:free", f"{self.prefix}:{server_id}:used",
+                f"{self.prefix}:{server_id}:seen"]
+
+    def allocate(self, server_ids: list, counts: list):
+        """
+        take counts[i] ports from server_ids[i], all or nothing
+        :return: list of ports of every server, or None if any server has not enough free ports
+        """
+        keys = []
+        for server_id in server_ids:
+            keys += self._keys(server_id)[:2]
+        result = self._allocate(keys=keys, args=counts)
+        if result:
+            return [list(ports) for ports in result]
+
+    def release(self, server_id, ports: list) -> int:
+        """
+        :return: number of ports released, ports not handed out are ignored
+        """
+        if not ports:
+            return 0
+        return self._release(keys=self._keys(server_id), args=ports)
+
+    def reconcile(self, server_id, available_ports: list, now: float = None) -> int:
+        """
+        :param available_ports: ports the server reports available and not in use
+        :return: number of free ports
+        """
+        now = time.time() if now is None else now
+        return self._reconcile(keys=self._keys(server_id),
+                               args=[now, settings.JUDGE_PORT_RECLAIM_GRACE] + list(available_ports))
+
+    def counts(self, server_ids: list) -> dict:
+        """
+        :return: {server_id: number of free ports}
+        """
+        pipe = cache.pipeline(transaction=False)
+        for server_id in server_ids:
+            pipe.bitcount(self._keys(server_id)[0])
+        return dict(zip(server_ids, pipe.execute()))
+
+    def free_ports(self, server_id) -> list:
+        data = cache.get_client(write=False).get(self._keys(server_id)[0]) or b""
+        return [i * 8 + bit for i, byte in enumerate(data) for bit in range(8) if byte & (0x80 >> bit)]
+
+    def remove(self, server_id):
+        cache.delete_many(self._keys(server_id))
+
+    def release_submission(self, server_list: list, ports_list: list) -> bool:
+        """
+        give back the ports of a submission, server_list are service urls of the servers
+        :return: False if a server does not exist anymore
+        """
+        servers = dict(JudgeServer.objects.filter(service_url__in=server_list).values_list("service_url", "id"))
+        for server_url, ports in zip(server_list, ports_list):
+            if server_url not in servers:
+                return False
+            released = self.release(servers[server_url], ports)
+            JudgeServer.objects.filter(id=servers[server_url]).update(
+                available_ports_num=F("available_ports_num") + released)
+        return True
+
+
+port_allocator = PortAllocator()
@@ -0,0 +1,139 @@
+import json
+
+from utils.cache import cache
+from utils.constants import CacheKey
+
+
+class QueueTier:
+    Contest  = "contest"
+    Practice = "practice"
+
+
+# tiers in the order they are drained
+TIERS = [QueueTier.Contest, QueueTier.Practice]
+
+# KEYS: items hash, users list of the tier, item list of the user
+# ARGV: dedup key, payload, user id
+PUSH_SCRIPT = """
+local old = redis.call('HGET', KEYS[1], ARGV[1])
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+if old then
+    return old
+end
+if redis.call('LLEN', KEYS[3]) == 0 then
+    redis.call('RPUSH', KEYS[2], ARGV[3])
+end
+redis.call('RPUSH', KEYS[3], ARGV[1])
+return false
+"""
+
+# KEYS: items hash, users list of the tier, item list of the user
+# ARGV: dedup key, payload, user id
+PUSH_FRONT_SCRIPT = """
+if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2]) == 0 then
+    return 0
+end
+redis.call('LPUSH', KEYS[3], ARGV[1])
+redis.call('LREM', KEYS[2], 0, ARGV[3])
+redis.call('LPUSH', KEYS[2], ARGV[3])
+return 1
+"""
+
+# KEYS: items hash, users list of every tier in priority order
+POP_SCRIPT = """
+for i = 2, #KEYS do
+    local user = redis.call('LPOP', KEYS[i])
+    if user then
+        local user_key = KEYS[i] .. ':' .. user
+        local item = redis.call('LPOP', user_key)
+        if redis.call('LLEN', user_key) > 0 then
+            redis.call('RPUSH', KEYS[i], user)
+        end
+        local payload = redis.call('HGET', KEYS[1], item)
+        redis.call('HDEL', KEYS[1], item)
+        return payload
+    end
+end
+return false
+"""
+
+
+class JudgeQueue:
+    """
+    Waiting queue of the remote dispatcher.
+     - tiers are drained in priority order, contest submissions go before practice ones
+     - inside a tier users take turns, one submission of each waiting user per round,
+       so a user flooding submissions only delays their own ones
+     - pushing a submission for a problem the user already has waiting replaces the waiting one in place
+    All operations are single lua scripts, safe to call from any web or worker process.
+    """
+    def __init__(self, prefix: str = CacheKey.waiting_queue):
+        self.prefix = prefix
+        self.items_key = f"{prefix}:items"
+        self._push = cache.register_script(PUSH_SCRIPT)
+        self._pop = cache.register_script(POP_SCRIPT)
+        self._push_front = cache.register_script(PUSH_FRONT_SCRIPT)
+
+    def _users_key(self, tier):
+        return f"{self.prefix}:{tier}"
+
+    @staticmethod
+    def item(submission_id, problem_id, user_id, contest_id=None) -> dict:
+        tier = QueueTier.Contest if contest_id else QueueTier.Practice
+        return {"submission_id": submission_id, "problem_id": problem_id, "user_id": str(user_id), "tier": tier}
+
+    def push(self, submission_id, problem_id, user_id, contest_id=None):
+        """
+        :return: the replaced item, or None
+        """
+        item = self.item(submission_id, problem_id, user_id, contest_id)
+        users_key = self._users_key(item["tier"])
+        old = self._push(keys=[self.items_key, users_key, f"{users_key}:{user_id}"],
+                         args=[f"{user_id}:{problem_id}", json.dumps(item), str(user_id)])
+        if old:
+            return json.loads(old)
+
+    def push_front(self, item: dict) -> bool:
+        """
+        put a popped item back to the head of the queue
+        :return: False if the user submitted the same problem again meanwhile, the item is dropped
+        """
+        users_key = self._users_key(item["tier"])
+        user_id = item["user_id"]
+        return bool(self._push_front(keys=[self.items_key, users_key, f"{users_key}:{user_id}"],
+                                     args=[f"{user_id}:{item['problem_id']}", json.dumps(item), user_id]))
+
+    def pop(self):
+        """
+        :return: the next item to dispatch, or None if the queue is empty
+        """
+        payload = self._pop(keys=[self.items_key] + [self._users_key(tier) for tier in TIERS], args=[])
+        if payload:
+            return json.loads(payload)
+
+    def depth(self) -> dict:
+        """
+        :return: number of waiting items of every tier and the number of waiting users
+        """
+        pipe = cache.pipeline(transaction=False)
+        pipe.hvals(self.items_key)
+        for tier in TIERS:
+            pipe.llen(self._users_key(tier))
+        values, *users = pipe.execute()
+        result = {tier: 0 for tier in TIERS}
+        for value in values:
+            result[json.loads(value)["tier"]] += 1
+        result["users"] = sum(users)
+        result["total"] = len(values)
+        return result
+
+    def __len__(self):
+        return cache.hlen(self.items_key)
+
+    def clear(self):
+        keys = list(cache.scan_iter(f"{self.prefix}:*"))
+        if keys:
+            cache.delete_many([key.decode("utf-8") for key in keys])
+
+
+judge_queue = JudgeQueue()
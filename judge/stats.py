@@ -0,0 +1,155 @@
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+
+from account.models import UserProfile
+from options.models import SysOptions as SysOptionsModel
+from problem.models import Problem
+from utils.cache import cache
+from utils.constants import CacheKey
+from utils.shortcuts import rand_str
+
+logger = logging.getLogger(__name__)
+
+BATCH_FIELD = "__batch__"
+# SysOptions row holding the id of the last batch applied to the database
+FLUSHED_BATCH_OPTION = "stats_flushed_batch"
+
+
+class StatsAggregator:
+    """
+    Write-behind aggregation of submission counters.
+    Judge workers add deltas to a redis hash with HINCRBY instead of updating the hot problem and profile rows,
+    flush() applies all accumulated deltas with one UPDATE per model.
+     - flush renames the pending hash, so new deltas are never lost while a batch is being applied
+     - the batch id is saved in the same transaction as the counters, a batch left by a crashed flusher
+       is replayed on the next flush and never applied twice
+     - merge_pending() adds unflushed deltas to serialized rows, so counters still look live
+    settings.STATS_FLUSH_INTERVAL = 0 disables the aggregation, deltas are applied immediately
+    """
+    # kind -> (model, lookup field, counter fields)
+    models = {
+        "problem": (Problem, "id", ("submission_number", "accepted_number")),
+        "profile": (UserProfile, "user_id", ("total_submissions", "accepted_number", "total_score")),
+    }
+
+    @property
+    def enabled(self):
+        return getattr(settings, "STATS_FLUSH_INTERVAL", 0) > 0
+
+    @staticmethod
+    def _field(kind, obj_id, name):
+        return f"{kind}:{obj_id}:{name}"
+
+    def incr(self, kind, obj_id, **deltas):
+        deltas = {k: v for k, v in deltas.items() if v}
+        if not deltas:
+            return
+        model, lookup, _ = self.models[kind]
+        if not self.enabled:
+            model.objects.filter(**{lookup: obj_id}).update(**{k: F(k) + v for k, v in deltas.items()})
+            self._changed(kind, [obj_id])
+            return
+        pipe = cache.pipeline(transaction=False)
+        for name, delta in deltas.items():
+            pipe.hincrby(CacheKey.stats_pending, self._field(kind, obj_id, name), delta)
+        pipe.execute()
+
+    def pending(self, kind, obj_ids) -> dict:
+        """
+        :return: {obj_id: {field: delta}} of the deltas not applied to the database yet
+        """
+        obj_ids = [str(obj_id) for obj_id in obj_ids]
+        if not self.enabled or not obj_ids:
+            return {}
+        _, _, names = self.models[kind]
+        fields = [self._field(kind, obj_id, name) for obj_id in obj_ids for name in names]
+        pipe = cache.pipeline(transaction=False)
+        pipe.hmget(CacheKey.stats_pending, fields)
+        pipe.hmget(CacheKey.stats_flushing, fields)
+        pending, flushing = pipe.execute()
+        result = {}
+        for i, field in enumerate(fields):
+            delta = int(pending[i] or 0) + int(flushing[i] or 0)
+            if delta:
+                _, obj_id, name = field.split(":")
+                result.setdefault(obj_id, {})[name] = delta
+        return result
+
+    def merge_pending(self, kind, rows, key="id"):
+        """
+        add unflushed deltas to serialized rows in place, rows is a dict or a list of dicts
+        :param key: field name of the object id in a row, or a function returning it
+        """
+        if isinstance(rows, dict):
+            rows = [rows]
+        get_id = key if callable(key) else (lambda row: row[key])
+        pending = self.pending(kind, [get_id(row) for row in rows])
+        for row in rows:
+            for name, delta in pending.get(str(get_id(row)), {}).items():
+                if name in row:
+                    row[name] += delta
+        return rows
+
+    def flush(self) -> int:
+        """
+        apply the accumulated deltas to the database
+        :return: number of rows updated
+        """
+        if not self.enabled:
+            return 0
+        with cache.lock(CacheKey.stats_flush_lock, timeout=60):
+            if not cache.exists(CacheKey.stats_flushing):
+                # only the flusher removes the pending hash, it can not disappear before the rename
+                if not cache.exists(CacheKey.stats_pending):
+                    return 0
+                cache.rename(CacheKey.stats_pending, CacheKey.stats_flushing)
+            cache.hsetnx(CacheKey.stats_flushing, BATCH_FIELD, rand_str())
+            data = {k.decode("utf-8"): v.decode("utf-8") for k, v in cache.hgetall(CacheKey.stats_flushing).items()}
+            batch = data.pop(BATCH_FIELD)
+
+            # kind -> field -> {obj_id: delta}
+            deltas = {}
+            for field, delta in data.items():
+                kind, obj_id, name = field.split(":")
+                if int(delta):
+                    deltas.setdefault(kind, {}).setdefault(name, {})[obj_id] = int(delta)
+
+            updated = 0
+            with transaction.atomic():
+                marker, _ = SysOptionsModel.objects.select_for_update().get_or_create(
+                    key=FLUSHED_BATCH_OPTION, defaults={"value": ""})
+                if marker.value == batch:
+                    logger.warning(f"stats batch {batch} was applied before a crash, skip it")
+                else:
+                    for kind, fields in deltas.items():
+                        updated += self._apply(kind, fields)
+                    marker.value = batch
+                    marker.save(update_fields=["value"])
+            cache.delete(CacheKey.stats_flushing)
+            for kind, fields in deltas.items():
+                self._changed(kind, {obj_id for values in fields.values() for obj_id in values})
+            return updated
+
+    @staticmethod
+    def _changed(kind, obj_ids):
+        # the cached problem payloads carry the counters
+        if kind == "problem":
+            # 防止循环引入
+            from problem.cache import problem_cache
+            problem_cache.invalidate_problems(obj_ids)
+
+    def _apply(self, kind, fields):
+        model, lookup, _ = self.models[kind]
+        obj_ids = set()
+        updates = {}
+        for name, values in fields.items():
+            obj_ids.update(values.keys())
+            whens = [When(**{lookup: obj_id}, then=Value(delta)) for obj_id, delta in values.items()]
+            updates[name] = F(name) + Case(*whens, default=Value(0), output_field=IntegerField())
+        return model.objects.filter(**{f"{lookup}__in": list(obj_ids)}).update(**updates)
+
+
+stats = StatsAggregator()
@@ -1,61 +1,47 @@
 import dramatiq
-import multiprocessing
 
-from account.models import User, UserProfile
+from account.models import User
+from problem.models import ProblemStatus
 from submission.models import Submission
-from problem.models import Problem
+from submission.status import status_cache
 from utils.shortcuts import DRAMATIQ_WORKER_ARGS
 
 from .dispatcher import JudgeDispatcher
+from .stats import stats
 from .testing import SubmissionTester
 
-lock = multiprocessing.Lock()
 
 @dramatiq.actor(**DRAMATIQ_WORKER_ARGS())
-def judge_task(submission_id, problem_id):
+def judge_task(submission_id, problem_id, queued=False):
     uid = Submission.objects.get(id=submission_id).user_id
     if User.objects.get(id=uid).is_disabled:
         return
-    JudgeDispatcher(submission_id, problem_id).judge()
-    
+    JudgeDispatcher(submission_id, problem_id).judge(queued=queued)
+
+
+def update_user_profile(user_id, problem_id, status, score):
+    """
+    record a judged submission in the problem status of the user, only the row of the problem is locked,
+    so concurrent judge workers never lose an update, counters are handed to the stats aggregator
+    """
+    deltas = {"total_submissions": 1}
+    previous = ProblemStatus.record(user_id, problem_id, status, score)
+    if previous is None or score > previous.score:
+        deltas["total_score"] = score - (previous.score if previous else 0)
+        if score == 100:
+            deltas["accepted_number"] = 1
+    stats.incr("profile", user_id, **deltas)
+
 
 @dramatiq.actor(**DRAMATIQ_WORKER_ARGS())
 def local_judge_task(submission_id, problem_id, user_id):
-    global lock
-    submission = Submission.objects.get(id=submission_id)
-
-    with lock:
-        problem = Problem.objects.get(id=problem_id)
-        problem.submission_number += 1
-        problem.save()
-    judge_res = False
-    try:
-        judge_res = SubmissionTester(submission).judge()
-    except Exception as e:
-        raise
-    with lock:
-        problem = Problem.objects.get(id=problem_id)
-        if judge_res:
-            problem.accepted_number += 1
-        problem.save()
-
-    score = submission.grade
-    user = User.objects.get(id=user_id)
-    assert user
-    with lock:
-        profile = UserProfile.objects.get(user=user)
-        assert profile
-        profile.total_submissions += 1
-        if problem._id not in profile.problems_status:
-            profile.problems_status[problem._id] = score
-            profile.total_score += score
-            if score == 100:
-                profile.accepted_number += 1
-        else:
-            prev_score = profile.problems_status[problem._id]
-            if score > prev_score:
-                profile.problems_status[problem._id] = score
-                profile.total_score += (score - prev_score)
-                if score == 100:
-                    profile.accepted_number += 1
-        profile.save()
+    submission = Submission.objects.select_related("problem").get(id=submission_id)
+
+    # counters are aggregated in redis, or single UPDATE statements, correct across worker processes
+    stats.incr("problem", problem_id, submission_number=1)
+    judge_res = SubmissionTester(submission).judge()
+    if judge_res:
+        stats.incr("problem", problem_id, accepted_number=1)
+    status_cache.publish(submission.id, submission.result, submission.grade)
+
+    update_user_profile(user_id, problem_id, submission.result, submission.grade)
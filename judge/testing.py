@@ -2,19 +2,25 @@ import json
 import zipfile
 import os
 import shutil
-import shlex
 import subprocess
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from os.path import isdir, join, exists, dirname
 from django.core.files.storage import FileSystemStorage
 
 from onl.settings import DATA_DIR
 from problem.models import Problem
 from submission.models import JudgeStatus, Submission
+from .logsink import TestcaseLogSink
+from .workspace import LinkMode, ProblemPackage, SubmissionWorkspace, link_or_copy
 
 
 PROBLEM_DIR = "problems"
 SUBMISSION_DIR = "submissions"
 ZIPFILE_DIR = "zips"
+PACKAGE_DIR = "packages"
+SHARD_DIR = "shards"
 
 TESTCASE_NAME = "testcases.json"
 TESTER_NAME = "tester"
@@ -24,6 +30,79 @@ class TestResult:
     Error   = 1
     Timeout = 2
 
+class TestcaseIndex:
+    """
+    parsed testcases.json of a problem, with the entries shown in failed_info prepared once
+    """
+    def __init__(self, data: dict):
+        self.data = data
+        self.testcases = data["testcases"]
+        global_config = data.get("config")
+        self._entries = []
+        for testcase in self.testcases:
+            if "config" in data:
+                # global config
+                config = global_config
+            else:
+                # specific config for testcase or no config
+                config = testcase.get("config")
+            self._entries.append({
+                "config": config,
+                "testcase": {
+                    "input": testcase["input"],
+                    "expected_output": testcase["output"],
+                },
+            })
+
+    def __len__(self):
+        return len(self.testcases)
+
+    def failed_entry(self, idx: int) -> dict:
+        # notice the index here, logical index starts from 1
+        entry = self._entries[idx - 1]
+        return {"config": entry["config"], "testcase_index": idx, "testcase": entry["testcase"]}
+
+
+class TestcaseIndexCache:
+    """
+    LRU of TestcaseIndex shared by all submissions judged in a worker process
+    keyed by problem id and mtime of testcases.json, so a re-uploaded lab is parsed again
+    the workspace links or copies testcases.json with its mtime, any submission of a problem shares the entry
+    """
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, problem_id: int, file_path: str) -> TestcaseIndex:
+        st = os.stat(file_path)
+        key = (problem_id, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            index = self._data.get(key)
+            if index is not None:
+                self._data.move_to_end(key)
+                return index
+        with open(file_path) as fp:
+            index = TestcaseIndex(json.load(fp))
+        with self._lock:
+            self._data[key] = index
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return index
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+testcase_index_cache = TestcaseIndexCache()
+
+
+def get_testcase_index(problem_id: int, file_path: str) -> TestcaseIndex:
+    return testcase_index_cache.get(problem_id, file_path)
+
+
 def create_new_problem_from_template(new_problem_id: int, old_problem_id: int):
     old_path = PathManager.problem_dir(old_problem_id)
     new_path = PathManager.problem_dir(new_problem_id)
@@ -33,6 +112,7 @@ def create_new_problem_from_template(new_problem_id: int, old_problem_id: int):
         if isdir(filepath):
             continue
         shutil.copy2(filepath, new_path)
+    ProblemPackage(PathManager.package_path(new_problem_id)).create(new_path)
     print(f'create problem instance {new_path}')
 
 def make_file_executable(file_path):
@@ -50,10 +130,11 @@ def make_file_executable(file_path):
         return False
 
 
-def run_command_with_timeout(command: list, timeout: float) -> int:
+def run_command_with_timeout(command: list, timeout: float, cwd: str = None) -> int:
     try:
         # Use the 'sudo' command to execute the given command with elevated privileges.
-        result = subprocess.run(["/usr/bin/python3"] + command, capture_output=True, text=True, check=True, timeout=timeout)
+        result = subprocess.run(["/usr/bin/python3"] + command, capture_output=True, text=True, check=True,
+                                timeout=timeout, cwd=cwd)
         # print("Command output:\n", result.stdout)
         return TestResult.Succeed
     except subprocess.TimeoutExpired:
@@ -65,6 +146,100 @@ def run_command_with_timeout(command: list, timeout: float) -> int:
         return TestResult.Error
 
 
+def run_tester(workdir: str, timeout: float, sink: TestcaseLogSink = None, indexes=()) -> int:
+    """
+    run the tester in workdir, testcase logs are captured by sink if it is given
+    :param indexes: global testcase index of testcase1.log, testcase2.log ... of this tester
+    """
+    if sink:
+        sink.add_log_dir(join(workdir, "logs"), indexes)
+        sink.start()
+    try:
+        return run_command_with_timeout([join(workdir, TESTER_NAME), "--log", "--json"], timeout, cwd=workdir)
+    finally:
+        if sink:
+            sink.stop()
+
+
+def run_tester_sharded(workdir: str, workers: int, timeout: float, sink: TestcaseLogSink = None,
+                       testcase_data: dict = None) -> int:
+    """
+    split testcases.json of workdir into shards, run one tester per shard concurrently,
+    then merge logs and results.json of all shards back into workdir/logs
+    every shard runs in its own directory with its own logs directory
+    """
+    if testcase_data is None:
+        with open(join(workdir, TESTCASE_NAME)) as fp:
+            testcase_data = json.load(fp)
+    testcases = testcase_data["testcases"]
+    # never more testers than testcases or cpus
+    shard_num = min(workers, len(testcases), os.cpu_count() or 1)
+    tester_cmd = ["--log", "--json"]
+    if shard_num <= 1:
+        return run_tester(workdir, timeout, sink, range(1, len(testcases) + 1))
+
+    # round robin, shards[k] holds the 0-based global indexes of the testcases in shard k
+    shards = [list(range(k, len(testcases), shard_num)) for k in range(shard_num)]
+    shard_root = join(workdir, SHARD_DIR)
+    if exists(shard_root):
+        shutil.rmtree(shard_root)
+    shard_dirs = []
+    for k, indexes in enumerate(shards):
+        shard_dir = join(shard_root, str(k))
+        os.makedirs(shard_dir)
+        for filename in os.listdir(workdir):
+            filepath = join(workdir, filename)
+            if isdir(filepath) or filename == TESTCASE_NAME:
+                continue
+            link_or_copy(filepath, join(shard_dir, filename), LinkMode.Hardlink)
+        shard_data = dict(testcase_data)
+        shard_data["testcases"] = [testcases[i] for i in indexes]
+        with open(join(shard_dir, TESTCASE_NAME), "w") as fp:
+            json.dump(shard_data, fp)
+        if sink:
+            sink.add_log_dir(join(shard_dir, "logs"), [i + 1 for i in indexes])
+        shard_dirs.append(shard_dir)
+
+    try:
+        if sink:
+            sink.start()
+        try:
+            with ThreadPoolExecutor(max_workers=shard_num) as pool:
+                results = list(pool.map(
+                    lambda shard_dir: run_command_with_timeout([join(shard_dir, TESTER_NAME)] + tester_cmd,
+                                                               timeout, cwd=shard_dir),
+                    shard_dirs))
+        finally:
+            if sink:
+                sink.stop()
+        if TestResult.Timeout in results:
+            return TestResult.Timeout
+        if TestResult.Error in results:
+            return TestResult.Error
+
+        log_path = join(workdir, "logs")
+        os.makedirs(log_path, exist_ok=True)
+        weighted_grade = 0
+        failed = []
+        for shard_dir, indexes in zip(shard_dirs, shards):
+            shard_log_path = join(shard_dir, "logs")
+            with open(join(shard_log_path, "results.json")) as fp:
+                res = json.load(fp)
+            weighted_grade += res["grade"] * len(indexes)
+            # logical index starts from 1
+            for idx in res["failed"]:
+                failed.append(indexes[idx - 1] + 1)
+            for idx in range(1, len(indexes) + 1):
+                shard_log = join(shard_log_path, f"testcase{idx}.log")
+                if exists(shard_log):
+                    os.replace(shard_log, join(log_path, f"testcase{indexes[idx - 1] + 1}.log"))
+        with open(join(log_path, "results.json"), "w") as fp:
+            json.dump({"grade": round(weighted_grade / len(testcases)), "failed": sorted(failed)}, fp)
+        return TestResult.Succeed
+    finally:
+        shutil.rmtree(shard_root, ignore_errors=True)
+
+
 class PathManager:
     @staticmethod
     def problem_dir(id: int) -> str:
@@ -78,6 +253,10 @@ class PathManager:
     def zipfile_path(problem_id: str, zipfile_name: str) -> str:
         return join(DATA_DIR, ZIPFILE_DIR, problem_id, zipfile_name)
 
+    @staticmethod
+    def package_path(id: int) -> str:
+        return join(DATA_DIR, PACKAGE_DIR, f"{id}.zip")
+
 
 class ZipFileUploader:
     def __init__(self, uploaded_file, problem: Problem):
@@ -154,6 +333,9 @@ class ZipFileUploader:
         print(f"remove {dirname(self.zip_file_path)}")
 
         make_file_executable(join(self.problem_dir_path, TESTER_NAME))
+        if valid:
+            # the pristine assets which the problem directory is restored from
+            ProblemPackage(PathManager.package_path(self.problem.id)).create(self.problem_dir_path)
 
         return valid
 
@@ -166,19 +348,13 @@ class SubmissionTester:
             os.makedirs(self.sub_dirpath, exist_ok=True)
         problem: Problem = submission.problem
         prob_dir = PathManager.problem_dir(problem.id) # use display id
-        if not exists(prob_dir):
-            raise Exception("problem dir {} not exists".format(prob_dir))
-        for filename in os.listdir(prob_dir):
-            filepath = join(prob_dir, filename)
-            if isdir(filepath):
-                continue
-            shutil.copy2(filepath, self.sub_dirpath)
-        for index, codename in enumerate(problem.code_names):
-            filecontent = submission.code_list[index]
-            codepath = join(self.sub_dirpath, codename)
-            with open(codepath, "w") as wfp:
-                print(f"substitude {codepath} with user implemented")
-                wfp.write(filecontent)
+        package = ProblemPackage(PathManager.package_path(problem.id))
+        if not package.exists():
+            # problems uploaded before the packages, trust the assets seen by the first submission
+            package.create(prob_dir)
+        # reflink problem assets when possible, only user code is written
+        self.workspace = SubmissionWorkspace(prob_dir, self.sub_dirpath, problem.code_names, package=package)
+        self.workspace.build(submission.code_list)
 
     def remove_all_logs(self):
         log_path = join(self.sub_dirpath, 'logs')
@@ -189,45 +365,28 @@ class SubmissionTester:
                 file_path = join(log_path, filename)
                 os.remove(file_path)
 
-    def remove_redudant_logs(self, failed_indexes: list):
-        log_path = join(self.sub_dirpath, 'logs')
-        ignore_files = [f"testcase{idx}.log" for idx in failed_indexes]
-        ignore_files.append("results.json")
-        for filename in os.listdir(log_path):
-            if filename in ignore_files:
-                continue
-            file_path = join(log_path, filename)
-            os.remove(file_path)
-
-    def trim_logs(self, failed_indexes: list):
-        log_path = join(self.sub_dirpath, 'logs')
-        max_lines = 1000
-        for idx in failed_indexes:
-            file_path = join(log_path, f"testcase{idx}.log")
-            temp_file_path = file_path + ".trimmed"
-            escaped_file_path = shlex.quote(file_path)
-            tail_command = f"tail -n {max_lines} {escaped_file_path} > {shlex.quote(temp_file_path)}"
-            os.system(tail_command)
-
-            with open(temp_file_path, 'r') as temp_file:
-                content = temp_file.read()
-
-            if os.path.getsize(file_path) > os.path.getsize(temp_file_path):
-                with open(temp_file_path, 'w') as temp_file:
-                    temp_file.write("log file is too long, only show the last 1000 lines:\n")
-                    temp_file.write(content)
-
-            os.remove(file_path)
-            os.rename(temp_file_path, file_path)
-
-
     def judge(self) -> bool:
         # return True if grade is 100
         tester_path = join(self.sub_dirpath, TESTER_NAME)
         if not exists(tester_path):
             raise Exception("running submission: tester {} not exists".format(tester_path))
         print(f"running {tester_path}")
-        res = run_command_with_timeout([tester_path, "--log", "--json"], self.sub.problem.timeout)
+        # testcase logs are kept in bounded ring buffers while the tester runs
+        self.sink = TestcaseLogSink()
+        testcase_index = get_testcase_index(self.sub.problem.id, join(self.sub_dirpath, TESTCASE_NAME))
+        if self.sub.problem.parallel_workers > 1:
+            res = run_tester_sharded(self.sub_dirpath, self.sub.problem.parallel_workers, self.sub.problem.timeout,
+                                     sink=self.sink, testcase_data=testcase_index.data)
+        else:
+            res = run_tester(self.sub_dirpath, self.sub.problem.timeout, self.sink,
+                             range(1, len(testcase_index) + 1))
+        modified = self.workspace.verify_assets()
+        if modified:
+            # the assets were restored, but the result of this run can not be trusted
+            print(f"submission {self.sub.id} modified problem assets {modified}")
+            self.sub.result = JudgeStatus.SYSTEM_ERROR
+            self.sub.save()
+            return False
 
         if res == TestResult.Timeout:
             self.sub.result = JudgeStatus.PROGRAM_TIMEOUT
@@ -255,40 +414,15 @@ class SubmissionTester:
             if grade == 0 or grade == 100:
                 self.remove_all_logs()
             else:
-                # clean and trim
+                # only the tails of failed testcase logs are written to disk
                 failed_indexes = res['failed']
-                self.remove_redudant_logs(failed_indexes)
-                self.trim_logs(failed_indexes)
-
-                for idx in res['failed']:
-                    log_fp = open(join(log_path, f"testcase{idx}.log"), "r")
-                    testcase_fp = open(join(self.sub_dirpath, TESTCASE_NAME), "r")
-                    testcase_json_data = json.load(testcase_fp)
-                    # notice the index here, logical index starts from 1
-                    if "config" in testcase_json_data:
-                        # global config
-                        config = testcase_json_data["config"]
-                    else:
-                        cur_data = testcase_json_data["testcases"][idx-1] 
-                        if "config" in cur_data:
-                            # specific config for testcase
-                            config = cur_data["config"]
-                        else:
-                            # no config
-                            config = None
-                    displayed_test = {
-                        "input": testcase_json_data["testcases"][idx-1]["input"],
-                        "expected_output":testcase_json_data["testcases"][idx-1]["output"],
-                    }
-                    # config, "testcase"
-                    failed_info.append({
-                        "config": config,
-                        "testcase_index": idx,
-                        "testcase": displayed_test,
-                        "log": log_fp.read()
-                    })
-                    log_fp.close()
-                    testcase_fp.close()
+                for idx in failed_indexes:
+                    self.sink.write_log(idx, join(log_path, f"testcase{idx}.log"))
+
+                for idx in failed_indexes:
+                    info = testcase_index.failed_entry(idx)
+                    info["log"] = self.sink.getvalue(idx)
+                    failed_info.append(info)
 
         self.sub.failed_info = failed_info
         if grade == 0:
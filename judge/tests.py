@@ -0,0 +1,884 @@
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+from os.path import join
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import requests
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from account.models import AdminType, User, UserProfile
+from conf.models import JudgeServer
+from options.models import SysOptions as SysOptionsModel
+from problem.models import Problem, ProblemStatus
+from submission.models import JudgeStatus, Submission
+from utils.api.tests import APITestCase, create_problem
+from utils.cache import cache
+from utils.constants import CacheKey
+
+from .client import NOT_FOUND, CircuitBreaker, JudgeClient, judge_client
+from .dispatcher import JudgeDispatcher, JudgeServerSelector, process_pending_task
+from .tasks import local_judge_task
+from .logsink import LogRingBuffer, TestcaseLogSink
+from .placement import BestFit, FirstFit, LeastLoaded, Spread
+from .ports import PortAllocator, port_allocator
+from .queue import JudgeQueue, QueueTier, judge_queue
+from .stats import BATCH_FIELD, FLUSHED_BATCH_OPTION, StatsAggregator, stats
+from .testing import (PathManager, SubmissionTester, TestcaseIndexCache, TestResult, run_command_with_timeout,
+                      run_tester, run_tester_sharded)
+from .workspace import LinkMode, ProblemPackage, SubmissionWorkspace, file_crc32
+
+FAKE_TESTER = """
+import json, os, sys
+workdir = os.path.dirname(os.path.abspath(__file__))
+with open(os.path.join(workdir, "testcases.json")) as f:
+    testcases = json.load(f)["testcases"]
+os.makedirs(os.path.join(workdir, "logs"), exist_ok=True)
+failed = []
+for idx, testcase in enumerate(testcases, 1):
+    with open(os.path.join(workdir, "logs", f"testcase{idx}.log"), "w") as f:
+        for _ in range(testcase.get("repeat", 1)):
+            f.write(testcase["input"])
+    if testcase["input"] == "fail":
+        failed.append(idx)
+with open(os.path.join(workdir, "logs", "results.json"), "w") as f:
+    json.dump({"grade": round(100 * (len(testcases) - len(failed)) / len(testcases)), "failed": failed}, f)
+"""
+
+
+class SubmissionWorkspaceTest(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.problem_dir = join(self.root, "problem")
+        os.makedirs(self.problem_dir)
+        for filename, content in [("tester", "#!/bin/sh\n"), ("testcases.json", "{}"), ("solution.py", "# template")]:
+            with open(join(self.problem_dir, filename), "w") as f:
+                f.write(content)
+        os.chmod(join(self.problem_dir, "tester"), 0o755)
+        self.sub_dir = join(self.root, "submission")
+        self.package = ProblemPackage(join(self.root, "package.zip"))
+        self.package.create(self.problem_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_build_workspace(self):
+        workspace = SubmissionWorkspace(self.problem_dir, self.sub_dir, ["solution.py"])
+        workspace.build(["print(1)"])
+        self.assertEqual(self._read(join(self.sub_dir, "solution.py")), "print(1)")
+        self.assertEqual(self._read(join(self.problem_dir, "solution.py")), "# template")
+        self.assertEqual(sorted(workspace.linked_files.keys()), ["testcases.json", "tester"])
+        self.assertNotEqual(workspace.linked_files["tester"], LinkMode.Hardlink)
+        self.assertEqual(os.stat(join(self.sub_dir, "tester")).st_nlink, 1)
+        self.assertTrue(os.stat(join(self.sub_dir, "tester")).st_mode & stat.S_IXUSR)
+        self.assertEqual(workspace.verify_assets(), [])
+
+    def test_rebuild_workspace(self):
+        SubmissionWorkspace(self.problem_dir, self.sub_dir, ["solution.py"]).build(["print(1)"])
+        SubmissionWorkspace(self.problem_dir, self.sub_dir, ["solution.py"]).build(["print(2)"])
+        self.assertEqual(self._read(join(self.sub_dir, "solution.py")), "print(2)")
+
+    def test_copy_mode(self):
+        workspace = SubmissionWorkspace(self.problem_dir, self.sub_dir, ["solution.py"], mode=LinkMode.Copy)
+        workspace.build(["print(1)"])
+        self.assertEqual(set(workspace.linked_files.values()), {LinkMode.Copy})
+        self.assertFalse(os.path.samefile(join(self.sub_dir, "tester"), join(self.problem_dir, "tester")))
+
+    def _tamper(self):
+        # what a submission can do to the problem directory through its absolute path
+        with open(join(self.problem_dir, "testcases.json"), "w") as f:
+            f.write('{"testcases": "changed"}')
+        os.chmod(join(self.problem_dir, "tester"), 0o644)
+        with open(join(self.problem_dir, "json.py"), "w") as f:
+            f.write("raise SystemExit")
+
+    def test_restore_modified_asset(self):
+        workspace = SubmissionWorkspace(self.problem_dir, self.sub_dir, ["solution.py"], package=self.package)
+        workspace.build(["print(1)"])
+        self._tamper()
+        self.assertEqual(workspace.verify_assets(), ["json.py", "testcases.json", "tester"])
+        self.assertEqual(sorted(os.listdir(self.problem_dir)), ["solution.py", "testcases.json", "tester"])
+        self.assertEqual(self._read(join(self.problem_dir, "testcases.json")), "{}")
+        self.assertTrue(os.stat(join(self.problem_dir, "tester")).st_mode & stat.S_IXUSR)
+        self.assertEqual(workspace.verify_assets(), [])
+
+    def test_build_restores_assets(self):
+        self._tamper()
+        workspace = SubmissionWorkspace(self.problem_dir, self.sub_dir, ["solution.py"], package=self.package)
+        workspace.build(["print(1)"])
+        self.assertEqual(sorted(os.listdir(self.sub_dir)), ["solution.py", "testcases.json", "tester"])
+        self.assertEqual(self._read(join(self.sub_dir, "testcases.json")), "{}")
+
+    def test_unchanged_assets_are_not_read(self):
+        with mock.patch("judge.workspace.file_crc32", wraps=file_crc32) as crc32:
+            self.assertEqual(self.package.modified_files(self.problem_dir), [])
+            crc32.assert_not_called()
+            # touched but the same content, read once
+            os.utime(join(self.problem_dir, "tester"))
+            self.assertEqual(self.package.modified_files(self.problem_dir), [])
+            self.assertEqual(self.package.modified_files(self.problem_dir), [])
+            self.assertEqual(crc32.call_count, 1)
+
+    def test_modified_asset_with_old_mtime(self):
+        file_path = join(self.problem_dir, "testcases.json")
+        st = os.stat(file_path)
+        with open(file_path, "w") as f:
+            f.write("[]")
+        os.utime(file_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(self.package.modified_files(self.problem_dir), ["testcases.json"])
+
+
+class ShardedTesterTest(SimpleTestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        with open(join(self.workdir, "tester"), "w") as f:
+            f.write(FAKE_TESTER)
+        inputs = ["ok", "fail", "ok", "ok", "fail", "ok", "ok", "ok"]
+        with open(join(self.workdir, "testcases.json"), "w") as f:
+            json.dump({"testcases": [{"input": item, "output": ""} for item in inputs]}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _results(self):
+        with open(join(self.workdir, "logs", "results.json")) as f:
+            return json.load(f)
+
+    def test_merge_shard_results(self):
+        self.assertEqual(run_tester_sharded(self.workdir, 3, 30), TestResult.Succeed)
+        self.assertEqual(self._results(), {"grade": 75, "failed": [2, 5]})
+        for idx in [2, 5]:
+            with open(join(self.workdir, "logs", f"testcase{idx}.log")) as f:
+                self.assertEqual(f.read(), "fail")
+        self.assertFalse(os.path.exists(join(self.workdir, "shards")))
+
+    def test_single_shard(self):
+        self.assertEqual(run_tester_sharded(self.workdir, 1, 30), TestResult.Succeed)
+        self.assertEqual(self._results(), {"grade": 75, "failed": [2, 5]})
+
+    def test_workers_bounded_by_cpus(self):
+        with mock.patch("os.cpu_count", return_value=2), \
+                mock.patch("judge.testing.run_command_with_timeout", wraps=run_command_with_timeout) as run:
+            self.assertEqual(run_tester_sharded(self.workdir, 100, 30), TestResult.Succeed)
+        self.assertEqual(run.call_count, 2)
+        self.assertEqual(self._results(), {"grade": 75, "failed": [2, 5]})
+
+    def test_capture_shard_logs(self):
+        sink = TestcaseLogSink()
+        self.assertEqual(run_tester_sharded(self.workdir, 3, 30, sink=sink), TestResult.Succeed)
+        self.assertEqual(sink.getvalue(2), "fail")
+        self.assertEqual(sink.getvalue(8), "ok")
+
+
+class LogSinkTest(SimpleTestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        with open(join(self.workdir, "tester"), "w") as f:
+            f.write(FAKE_TESTER)
+        testcases = [{"input": "ok\n", "output": ""}, {"input": "fail\n", "output": "", "repeat": 100000}]
+        with open(join(self.workdir, "testcases.json"), "w") as f:
+            json.dump({"testcases": testcases}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_ring_buffer(self):
+        buffer = LogRingBuffer(max_lines=3, max_bytes=1024)
+        buffer.write(b"1\n2\n3")
+        buffer.write(b"\n4\n5")
+        self.assertTrue(buffer.truncated)
+        self.assertEqual(buffer.getvalue(), "log file is too long, only show the last 3 lines:\n3\n4\n5")
+
+        buffer = LogRingBuffer(max_lines=100, max_bytes=4)
+        buffer.write(b"123456789")
+        self.assertEqual(buffer.getvalue(), "log file is too long, only show the last 4 bytes:\n6789")
+
+    def test_capture_logs(self):
+        sink = TestcaseLogSink(max_lines=10)
+        self.assertEqual(run_tester(self.workdir, 30, sink, [1, 2]), TestResult.Succeed)
+        self.assertEqual(sink.getvalue(1), "ok\n")
+        log = sink.getvalue(2).splitlines()
+        self.assertEqual(log[0], "log file is too long, only show the last 10 lines:")
+        self.assertEqual(log[1:], ["fail"] * 10)
+        # the logs are collected and removed
+        self.assertEqual(os.listdir(join(self.workdir, "logs")), ["results.json"])
+
+    def test_cap_log_on_disk(self):
+        log_dir = join(self.workdir, "logs")
+        sink = TestcaseLogSink(max_lines=10, cap_bytes=4096)
+        sink.add_log_dir(log_dir, [1])
+        path = join(log_dir, "testcase1.log")
+        with open(path, "w") as f:
+            f.write("line\n" * 100000)
+            f.flush()
+            sink._collect_over_cap()
+            # the size and the offset of the writer are kept, the collected bytes are freed
+            self.assertEqual(os.path.getsize(path), 500000)
+            self.assertLess(os.stat(path).st_blocks * 512, 500000)
+            f.write("tail\n" * 5)
+        sink.stop()
+        self.assertEqual(sink.getvalue(1).splitlines()[1:], ["line"] * 5 + ["tail"] * 5)
+        self.assertFalse(os.path.exists(path))
+
+    def test_cap_per_submission(self):
+        log_dir = join(self.workdir, "logs")
+        sink = TestcaseLogSink(max_lines=10, cap_bytes=4096)
+        sink.add_log_dir(log_dir, [1, 2])
+        for idx in [1, 2]:
+            with open(join(log_dir, f"testcase{idx}.log"), "w") as f:
+                f.write(f"{idx}\n" * 1500)
+        # under the cap each, over it together
+        sink._collect_over_cap()
+        self.assertEqual([sink._collected[idx][1] for idx in [1, 2]], [3000, 3000])
+        sink.stop()
+        for idx in [1, 2]:
+            self.assertEqual(sink.getvalue(idx).splitlines()[1:], [str(idx)] * 10)
+
+    def test_truncate_without_punch_hole(self):
+        log_dir = join(self.workdir, "logs")
+        sink = TestcaseLogSink(max_lines=10, cap_bytes=0)
+        sink.add_log_dir(log_dir, [1])
+        path = join(log_dir, "testcase1.log")
+        with open(path, "w") as f, mock.patch("judge.logsink.punch_hole", return_value=False):
+            f.write("line\n" * 100)
+            f.flush()
+            with self.assertLogs("judge.logsink", "WARNING"):
+                sink._collect_over_cap()
+            self.assertEqual(os.path.getsize(path), 0)
+            # the writer goes on at its offset
+            f.write("tail\n" * 5)
+        sink.stop()
+        self.assertEqual(sink.getvalue(1).splitlines()[1:], ["line"] * 5 + ["tail"] * 5)
+
+    def test_tester_replaces_log(self):
+        log_dir = join(self.workdir, "logs")
+        sink = TestcaseLogSink(max_lines=10, cap_bytes=0)
+        sink.add_log_dir(log_dir, [1])
+        path = join(log_dir, "testcase1.log")
+        with open(path, "w") as f:
+            f.write("old\n" * 100)
+        sink._collect(path, 1)
+        os.remove(path)
+        with open(path, "w") as f:
+            f.write("line\n" * 100)
+        sink.stop()
+        self.assertEqual(sink.getvalue(1).splitlines()[1:], ["line"] * 10)
+        self.assertFalse(os.path.exists(path))
+
+
+class TestcaseIndexTest(SimpleTestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.file_path = join(self.workdir, "testcases.json")
+        self._write({"testcases": [{"input": 1, "output": 2, "config": {"loss": 0.1}}, {"input": 3, "output": 4}]})
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _write(self, data):
+        with open(self.file_path, "w") as f:
+            json.dump(data, f)
+
+    def test_failed_entry(self):
+        index = TestcaseIndexCache().get(1, self.file_path)
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.failed_entry(1), {"config": {"loss": 0.1}, "testcase_index": 1,
+                                                 "testcase": {"input": 1, "expected_output": 2}})
+        self.assertIsNone(index.failed_entry(2)["config"])
+
+    def test_global_config(self):
+        self._write({"config": {"loss": 0.5}, "testcases": [{"input": 1, "output": 2, "config": {"loss": 0.1}}]})
+        index = TestcaseIndexCache().get(1, self.file_path)
+        self.assertEqual(index.failed_entry(1)["config"], {"loss": 0.5})
+
+    def test_cache(self):
+        cache = TestcaseIndexCache(maxsize=1)
+        index = cache.get(1, self.file_path)
+        self.assertIs(cache.get(1, self.file_path), index)
+        # re-uploaded testcases.json has a new mtime
+        self._write({"testcases": [{"input": 5, "output": 6}]})
+        st = os.stat(self.file_path)
+        os.utime(self.file_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        new_index = cache.get(1, self.file_path)
+        self.assertIsNot(new_index, index)
+        self.assertEqual(len(new_index), 1)
+        cache.get(2, self.file_path)
+        self.assertIsNot(cache.get(1, self.file_path), new_index)
+
+
+class SubmissionTesterTest(APITestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        patcher = mock.patch("judge.testing.DATA_DIR", self.data_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        user = self.create_admin(login=False)
+        self.problem = create_problem(user)
+        problem_dir = PathManager.problem_dir(self.problem.id)
+        os.makedirs(problem_dir)
+        with open(join(problem_dir, "tester"), "w") as f:
+            f.write(FAKE_TESTER)
+        with open(join(problem_dir, "solution.py"), "w") as f:
+            f.write("# template")
+        inputs = ["ok", "fail", "ok", "fail"]
+        with open(join(problem_dir, "testcases.json"), "w") as f:
+            json.dump({"testcases": [{"input": item, "output": item} for item in inputs]}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def _judge(self):
+        submission = Submission.objects.create(problem=self.problem, user_id="1", username="test",
+                                               language="Python3", code_list=["print(1)"])
+        self.assertFalse(SubmissionTester(submission).judge())
+        submission.refresh_from_db()
+        self.assertEqual(submission.result, JudgeStatus.SOME_PASSED)
+        self.assertEqual(submission.grade, 50)
+        self.assertEqual([item["testcase_index"] for item in submission.failed_info], [2, 4])
+        self.assertEqual(submission.failed_info[0]["log"], "fail")
+        self.assertEqual(submission.failed_info[0]["testcase"], {"input": "fail", "expected_output": "fail"})
+        log_path = join(PathManager.submission_dir("1", submission.id), "logs")
+        self.assertEqual(sorted(os.listdir(log_path)), ["results.json", "testcase2.log", "testcase4.log"])
+
+    def test_judge(self):
+        self._judge()
+
+    def test_parallel_judge(self):
+        self.problem.parallel_workers = 2
+        self.problem.save()
+        self._judge()
+
+    def test_modified_assets(self):
+        self._judge()
+        problem_dir = PathManager.problem_dir(self.problem.id)
+        # the tester overwrites the testcases of the problem directory
+        submission = Submission.objects.create(problem=self.problem, user_id="1", username="test",
+                                               language="Python3", code_list=["print(1)"])
+        tester = SubmissionTester(submission)
+        with open(join(tester.sub_dirpath, "tester"), "a") as f:
+            f.write(f"\nopen({json.dumps(join(problem_dir, 'testcases.json'))}, 'w').write('{{}}')\n")
+        self.assertFalse(tester.judge())
+        submission.refresh_from_db()
+        self.assertEqual(submission.result, JudgeStatus.SYSTEM_ERROR)
+        with open(join(problem_dir, "testcases.json")) as f:
+            self.assertEqual(len(json.load(f)["testcases"]), 4)
+        self._judge()
+
+
+class LocalJudgeTaskConcurrencyTest(TransactionTestCase):
+    grades = [0, 50, 100, 30]
+
+    def setUp(self):
+        user = User.objects.create(username="admin", admin_type=AdminType.ADMIN)
+        self.problem = create_problem(user)
+        self.users = []
+        for i in range(4):
+            student = User.objects.create(username=f"student{i}")
+            UserProfile.objects.create(user=student)
+            self.users.append(student)
+        cache.delete_many([CacheKey.stats_pending, CacheKey.stats_flushing])
+
+    def _judge_all(self):
+        grades = self.grades
+        submissions = []
+        for i in range(200):
+            user = self.users[i % len(self.users)]
+            submission = Submission.objects.create(problem=self.problem, user_id=str(user.id), username=user.username,
+                                                   language="Python3", code_list=["print(1)"],
+                                                   grade=grades[i % len(grades)])
+            submissions.append((submission.id, str(user.id)))
+
+        class FakeTester:
+            def __init__(self, submission):
+                self.submission = submission
+
+            def judge(self):
+                return self.submission.grade == 100
+
+        def run(item):
+            try:
+                local_judge_task(item[0], self.problem.id, item[1])
+            finally:
+                connection.close()
+
+        with mock.patch("judge.tasks.SubmissionTester", FakeTester):
+            with ThreadPoolExecutor(max_workers=16) as pool:
+                list(pool.map(run, submissions))
+
+    def _check_counters(self):
+        grades = self.grades
+        self.problem.refresh_from_db()
+        self.assertEqual(self.problem.submission_number, 200)
+        self.assertEqual(self.problem.accepted_number, 50)
+        for i, user in enumerate(self.users):
+            profile = UserProfile.objects.get(user=user)
+            self.assertEqual(profile.total_submissions, 50)
+            self.assertEqual(ProblemStatus.objects.get(user=user, problem=self.problem).score, grades[i])
+            self.assertEqual(profile.total_score, grades[i])
+            self.assertEqual(profile.accepted_number, 1 if grades[i] == 100 else 0)
+
+    @override_settings(STATS_FLUSH_INTERVAL=5)
+    def test_concurrent_judge_write_behind(self):
+        self._judge_all()
+        self.assertEqual(Problem.objects.get(id=self.problem.id).submission_number, 0)
+        stats.flush()
+        self._check_counters()
+
+    @override_settings(STATS_FLUSH_INTERVAL=0)
+    def test_concurrent_judge_direct(self):
+        self._judge_all()
+        self._check_counters()
+
+
+@override_settings(STATS_FLUSH_INTERVAL=5)
+class StatsAggregatorTest(TransactionTestCase):
+    def setUp(self):
+        cache.delete_many([CacheKey.stats_pending, CacheKey.stats_flushing])
+        user = User.objects.create(username="admin", admin_type=AdminType.ADMIN)
+        UserProfile.objects.create(user=user)
+        self.user = user
+        self.problem = create_problem(user)
+        self.stats = StatsAggregator()
+
+    def test_merge_pending(self):
+        self.stats.incr("problem", self.problem.id, submission_number=3, accepted_number=1)
+        rows = self.stats.merge_pending("problem", [{"id": self.problem.id, "submission_number": 2,
+                                                     "accepted_number": 0}, {"id": 0, "submission_number": 1}])
+        self.assertEqual(rows[0]["submission_number"], 5)
+        self.assertEqual(rows[0]["accepted_number"], 1)
+        self.assertEqual(rows[1]["submission_number"], 1)
+
+    def test_flush(self):
+        self.stats.incr("problem", self.problem.id, submission_number=2)
+        self.stats.incr("profile", self.user.id, total_submissions=1, total_score=40)
+        self.assertEqual(self.stats.flush(), 2)
+        self.problem.refresh_from_db()
+        self.assertEqual(self.problem.submission_number, 2)
+        profile = UserProfile.objects.get(user=self.user)
+        self.assertEqual((profile.total_submissions, profile.total_score), (1, 40))
+        self.assertEqual(self.stats.pending("problem", [self.problem.id]), {})
+        self.assertEqual(self.stats.flush(), 0)
+
+    def test_replay_after_crash(self):
+        self.stats.incr("problem", self.problem.id, submission_number=1)
+        self.stats.flush()
+        # a flusher crashed after commit but before deleting the batch
+        cache.hset(CacheKey.stats_flushing, f"problem:{self.problem.id}:submission_number", 1)
+        cache.hset(CacheKey.stats_flushing, BATCH_FIELD, self._last_batch())
+        self.assertEqual(self.stats.flush(), 0)
+        self.assertFalse(cache.exists(CacheKey.stats_flushing))
+        # a flusher crashed before commit, the batch is applied once
+        cache.hset(CacheKey.stats_flushing, f"problem:{self.problem.id}:submission_number", 1)
+        cache.hset(CacheKey.stats_flushing, BATCH_FIELD, "unapplied")
+        self.assertEqual(self.stats.flush(), 1)
+        self.problem.refresh_from_db()
+        self.assertEqual(self.problem.submission_number, 2)
+
+    def _last_batch(self):
+        return SysOptionsModel.objects.get(key=FLUSHED_BATCH_OPTION).value
+
+
+class JudgeQueueTest(SimpleTestCase):
+    def setUp(self):
+        self.queue = JudgeQueue(prefix="test_waiting_queue")
+        self.queue.clear()
+
+    def tearDown(self):
+        self.queue.clear()
+
+    def _drain(self):
+        items = []
+        while True:
+            item = self.queue.pop()
+            if not item:
+                return items
+            items.append(item["submission_id"])
+
+    def test_fair_share(self):
+        for i in range(4):
+            self.queue.push(f"flood{i}", problem_id=i, user_id=1)
+        self.queue.push("a", problem_id=1, user_id=2)
+        self.queue.push("b", problem_id=1, user_id=3)
+        self.assertEqual(self._drain(), ["flood0", "a", "b", "flood1", "flood2", "flood3"])
+        self.assertEqual(len(self.queue), 0)
+
+    def test_contest_first(self):
+        self.queue.push("practice", problem_id=1, user_id=1)
+        self.queue.push("contest", problem_id=2, user_id=1, contest_id=1)
+        self.assertEqual(self._drain(), ["contest", "practice"])
+
+    def test_dedup(self):
+        self.assertIsNone(self.queue.push("old", problem_id=1, user_id=1))
+        self.queue.push("other", problem_id=1, user_id=2)
+        replaced = self.queue.push("new", problem_id=1, user_id=1)
+        self.assertEqual(replaced["submission_id"], "old")
+        self.assertEqual(self.queue.depth(), {QueueTier.Contest: 0, QueueTier.Practice: 2, "users": 2, "total": 2})
+        self.assertEqual(self._drain(), ["new", "other"])
+
+    def test_push_front(self):
+        self.queue.push("a", problem_id=1, user_id=1)
+        self.queue.push("b", problem_id=1, user_id=2)
+        item = self.queue.pop()
+        self.assertTrue(self.queue.push_front(item))
+        self.assertEqual(self._drain(), ["a", "b"])
+
+        self.queue.push("a", problem_id=1, user_id=1)
+        item = self.queue.pop()
+        self.queue.push("newer", problem_id=1, user_id=1)
+        self.assertFalse(self.queue.push_front(item))
+        self.assertEqual(self._drain(), ["newer"])
+
+
+class DrainPendingTaskTest(TestCase):
+    def setUp(self):
+        judge_queue.clear()
+        cache.delete_many([CacheKey.waiting_queue_lock, CacheKey.waiting_queue_drain_requested])
+        user = User.objects.create(username="admin", admin_type=AdminType.ADMIN)
+        self.problem = create_problem(user, vm_num=1, port_num=[2])
+        self.servers = []
+        for i in range(2):
+            server = JudgeServer.objects.create(hostname=f"server{i}", cpu_core=1, is_ready=True,
+                                                available_ports=list(range(5)), last_heartbeat=timezone.now())
+            port_allocator.reconcile(server.id, server.available_ports)
+            self.servers.append(server)
+        for i in range(5):
+            judge_queue.push(f"submission{i}", self.problem.id, user_id=i)
+
+    def tearDown(self):
+        judge_queue.clear()
+        for server in self.servers:
+            port_allocator.remove(server.id)
+
+    def test_drain_until_full(self):
+        with mock.patch("judge.tasks.judge_task") as judge_task:
+            process_pending_task()
+        # every server fits two submissions
+        self.assertEqual(judge_task.send.call_count, 4)
+        self.assertEqual(judge_queue.pop()["submission_id"], "submission4")
+
+    def test_drain_requested_while_locked(self):
+        lock = cache.lock(CacheKey.waiting_queue_lock, timeout=60)
+        lock.acquire()
+        with mock.patch("judge.tasks.judge_task") as judge_task:
+            process_pending_task()
+            self.assertEqual(judge_task.send.call_count, 0)
+            self.assertTrue(cache.get(CacheKey.waiting_queue_drain_requested))
+            lock.release()
+            process_pending_task()
+            self.assertEqual(judge_task.send.call_count, 4)
+
+    def test_selector_claims_ports(self):
+        with JudgeServerSelector(2, [2, 3]) as resources:
+            self.assertEqual(sorted(len(ports) for ports in resources["ports"]), [2, 3])
+            self.assertEqual(JudgeServer.objects.get(id=resources["servers"][0].id).task_number, 1)
+        self.assertEqual(sorted(port_allocator.counts([s.id for s in self.servers]).values()), [2, 3])
+
+
+class PortAllocatorTest(SimpleTestCase):
+    def setUp(self):
+        self.allocator = PortAllocator(prefix="test_judge_ports")
+        self.allocator.reconcile(1, [4000, 4001, 4002])
+        self.allocator.reconcile(2, [5000])
+
+    def tearDown(self):
+        self.allocator.remove(1)
+        self.allocator.remove(2)
+
+    def test_allocate_and_release(self):
+        self.assertEqual(self.allocator.allocate([1, 2], [2, 1]), [[4000, 4001], [5000]])
+        self.assertEqual(self.allocator.counts([1, 2]), {1: 1, 2: 0})
+        self.assertEqual(self.allocator.release(1, [4000, 4001, 4002]), 2)
+        self.assertEqual(self.allocator.free_ports(1), [4000, 4001, 4002])
+
+    def test_all_or_nothing(self):
+        self.assertIsNone(self.allocator.allocate([1, 2], [1, 2]))
+        self.assertEqual(self.allocator.counts([1, 2]), {1: 3, 2: 1})
+
+    def test_reconcile_keeps_ports_in_use(self):
+        ports = self.allocator.allocate([1], [1])[0]
+        self.assertEqual(self.allocator.reconcile(1, [4000, 4001, 4003]), 2)
+        self.assertEqual(self.allocator.free_ports(1), [4001, 4003])
+        self.allocator.release(1, ports)
+        self.assertEqual(self.allocator.free_ports(1), [4000, 4001, 4003])
+
+    @override_settings(JUDGE_PORT_RECLAIM_GRACE=60)
+    def test_reconcile_lost_release(self):
+        self.assertEqual(self.allocator.allocate([1], [2]), [[4000, 4001]])
+        # 4001 is busy on the server, the release of 4000 never arrives
+        self.assertEqual(self.allocator.reconcile(1, [4000, 4002], now=1000), 1)
+        self.assertEqual(self.allocator.reconcile(1, [4000, 4002], now=1059), 1)
+        self.assertEqual(self.allocator.reconcile(1, [4000, 4002], now=1060), 2)
+        self.assertEqual(self.allocator.free_ports(1), [4000, 4002])
+        # a late release is ignored
+        self.assertEqual(self.allocator.release(1, [4000]), 0)
+        self.assertEqual(self.allocator.release(1, [4001]), 1)
+
+    @override_settings(JUDGE_PORT_RECLAIM_GRACE=60)
+    def test_reconcile_port_busy_again(self):
+        self.allocator.allocate([1], [1])
+        self.allocator.reconcile(1, [4000, 4001, 4002], now=1000)
+        # the judge started using the port, the grace starts over once it is reported available again
+        self.allocator.reconcile(1, [4001, 4002], now=1030)
+        self.assertEqual(self.allocator.reconcile(1, [4000, 4001, 4002], now=1070), 2)
+        self.assertEqual(self.allocator.reconcile(1, [4000, 4001, 4002], now=1130), 3)
+
+
+class PlacementStrategyTest(SimpleTestCase):
+    def setUp(self):
+        self.small = self._server("small", ports=4)
+        self.large = self._server("large", ports=20)
+        self.busy = self._server("busy", ports=30, cpu_usage=80)
+        self.servers = [self.large, self.busy, self.small]
+
+    @staticmethod
+    def _server(name, ports, cpu_usage=10, task_number=0, is_disabled=False):
+        return JudgeServer(hostname=name, cpu_core=2, is_ready=True, is_disabled=is_disabled, task_number=task_number,
+                           available_ports_num=ports, cpu_usage=cpu_usage, memory_usage=10)
+
+    def test_best_fit(self):
+        self.assertEqual(BestFit().place(self.servers, 2, [15, 3]), [self.large, self.small])
+
+    def test_least_loaded(self):
+        self.assertEqual(LeastLoaded().place(self.servers, 1, [3]), [self.small])
+
+    def test_spread(self):
+        self.assertEqual(Spread().place(self.servers, 2, [3, 3]), [self.busy, self.large])
+
+    def test_first_fit(self):
+        self.assertEqual(FirstFit().place(self.servers, 2, [3, 3]), [self.small, self.large])
+
+    def test_not_eligible(self):
+        self.servers.append(self._server("disabled", ports=100, is_disabled=True))
+        self.servers.append(self._server("overloaded", ports=100, cpu_usage=99))
+        self.servers.append(self._server("full", ports=100, task_number=16))
+        self.assertIsNone(BestFit().place(self.servers, 1, [50]))
+        self.assertIsNone(BestFit().place(self.servers, 4, [1, 1, 1, 1]))
+
+
+class JudgeFanoutTest(TestCase):
+    def setUp(self):
+        self.dispatcher = JudgeDispatcher.__new__(JudgeDispatcher)
+        self.servers = [JudgeServer(service_url=f"http://vm{i}:8080") for i in range(4)]
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        for server in self.servers:
+            judge_client.invalidate(server.service_url)
+
+    def _fake_post(self, failed_vm=None):
+        def post(connection, url, kwargs):
+            time.sleep(0.2)
+            vm_index = kwargs["json"]["vm_index"]
+            with self.lock:
+                self.calls.append(vm_index)
+            if vm_index == failed_vm:
+                return {"err": "CompileError", "data": "oops"}
+            return {"err": None, "data": None}
+        return post
+
+    def test_concurrent_and_vm0_last(self):
+        with mock.patch.object(JudgeClient, "_post", staticmethod(self._fake_post())):
+            start = time.perf_counter()
+            self.assertEqual(self.dispatcher._send_judge(self.servers, {"submission_id": "1"}), (None, [3, 2, 1, 0]))
+            elapsed = time.perf_counter() - start
+        self.assertEqual(sorted(self.calls[:3]), [1, 2, 3])
+        self.assertEqual(self.calls[3], 0)
+        # vm 1-3 in parallel, then vm 0
+        self.assertLess(elapsed, 0.6)
+
+    def test_failed_vm_stops_dispatch(self):
+        with mock.patch.object(JudgeClient, "_post", staticmethod(self._fake_post(failed_vm=2))):
+            failed, accepted = self.dispatcher._send_judge(self.servers, {"submission_id": "1"})
+        self.assertEqual(failed["data"], "oops")
+        self.assertEqual(accepted, [3, 1])
+        self.assertNotIn(0, self.calls)
+
+    def test_unreachable_vm(self):
+        with mock.patch.object(JudgeClient, "_post", side_effect=requests.ConnectionError()):
+            self.assertEqual(self.dispatcher._send_judge(self.servers[:1], {}), ({"err": None}, []))
+
+
+class JudgeDispatchTest(TestCase):
+    def setUp(self):
+        judge_queue.clear()
+        cache.delete_many([CacheKey.waiting_queue_lock, CacheKey.waiting_queue_drain_requested])
+        self.user = User.objects.create(username="test")
+        self.problem = create_problem(self.user, vm_num=2, port_num=[1, 1])
+        self.servers = []
+        for i in range(2):
+            server = JudgeServer.objects.create(hostname=f"server{i}", cpu_core=1, is_ready=True,
+                                                service_url=f"http://server{i}:8080", available_ports=list(range(2)),
+                                                last_heartbeat=timezone.now())
+            port_allocator.reconcile(server.id, server.available_ports)
+            self.servers.append(server)
+        self.calls = []
+
+    def tearDown(self):
+        judge_queue.clear()
+        for server in self.servers:
+            port_allocator.remove(server.id)
+            judge_client.invalidate(server.service_url)
+
+    def _submission(self):
+        return Submission.objects.create(problem=self.problem, user_id=str(self.user.id), username="test",
+                                         language="Python3", code_list=["print(1)"])
+
+    def _free_ports(self):
+        return sum(port_allocator.counts([server.id for server in self.servers]).values())
+
+    def _fake_post(self, failed_vm=None, cancelled=True):
+        def post(connection, url, kwargs):
+            vm_index = kwargs["json"]["vm_index"]
+            self.calls.append((url.rsplit("/", 1)[1], vm_index))
+            if url.endswith("/cancel"):
+                if cancelled == NOT_FOUND:
+                    return {"err": NOT_FOUND, "data": url}
+                return {"err": None, "data": None} if cancelled else None
+            if vm_index == failed_vm:
+                return {"err": "CompileError", "data": "oops"}
+            return {"err": None, "data": None}
+        return post
+
+    def _judge(self, submission, **kwargs):
+        with mock.patch.object(JudgeClient, "_post", staticmethod(self._fake_post(**kwargs))), \
+                mock.patch("judge.tasks.judge_task") as judge_task:
+            JudgeDispatcher(submission.id, self.problem.id).judge()
+        return judge_task
+
+    def test_queue_first(self):
+        judge_queue.push("waiting", self.problem.id, user_id="other", contest_id=1)
+        submission = self._submission()
+        judge_task = self._judge(submission)
+        self.assertEqual(self.calls, [])
+        # the waiting contest submission is dispatched before the new one
+        self.assertEqual([call.kwargs["submission_id"] for call in judge_task.send.call_args_list],
+                         ["waiting", submission.id])
+
+    def test_requeue_keeps_turn(self):
+        popped = self._submission()
+        judge_queue.push("other", self.problem.id, user_id="other")
+        # taken by a new submission since the drain placed the popped one
+        port_allocator.allocate([server.id for server in self.servers], [2, 2])
+        with mock.patch("judge.dispatcher.process_pending_task"):
+            JudgeDispatcher(popped.id, self.problem.id).judge(queued=True)
+        self.assertEqual(judge_queue.pop()["submission_id"], popped.id)
+        self.assertEqual(judge_queue.pop()["submission_id"], "other")
+
+    def test_drain_deleted_problem(self):
+        submission = self._submission()
+        judge_queue.push(submission.id, self.problem.id + 1000, user_id=str(self.user.id))
+        with mock.patch("judge.dispatcher.status_cache") as status, mock.patch("judge.tasks.judge_task") as judge_task:
+            process_pending_task()
+        judge_task.send.assert_not_called()
+        submission.refresh_from_db()
+        self.assertEqual(submission.result, JudgeStatus.SYSTEM_ERROR)
+        status.publish.assert_called_once_with(submission.id, JudgeStatus.SYSTEM_ERROR)
+
+    def test_replaced_in_queue(self):
+        old = self._submission()
+        judge_queue.push(old.id, self.problem.id, user_id=str(self.user.id))
+        new = self._submission()
+        with mock.patch("judge.dispatcher.status_cache") as status:
+            self._judge(new)
+        old.refresh_from_db()
+        self.assertEqual(old.result, JudgeStatus.SYSTEM_ERROR)
+        status.publish.assert_called_once_with(old.id, JudgeStatus.SYSTEM_ERROR)
+
+    def test_failed_vm_cancels_accepted(self):
+        submission = self._submission()
+        self._judge(submission, failed_vm=0)
+        self.assertEqual(self.calls, [("judge", 1), ("judge", 0), ("cancel", 1)])
+        self.assertEqual(self._free_ports(), 4)
+        submission.refresh_from_db()
+        self.assertEqual(submission.result, JudgeStatus.ALL_FAILED)
+
+    def test_failed_cancel_keeps_ports(self):
+        self._judge(self._submission(), failed_vm=0, cancelled=False)
+        # vm 1 may still use its port, the heartbeat takes it back later
+        self.assertEqual(self._free_ports(), 3)
+
+    def test_cancel_unsupported(self):
+        with self.assertLogs("judge.dispatcher", "WARNING") as logs:
+            self._judge(self._submission(), failed_vm=0, cancelled=NOT_FOUND)
+        self.assertIn("does not support /cancel", logs.output[0])
+        self.assertEqual(self._free_ports(), 3)
+
+
+class JudgeClientTest(TestCase):
+    def setUp(self):
+        self.client = JudgeClient(retries=2, backoff=0)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_connection_per_server(self):
+        self.assertIs(self.client.connection("http://vm0:8080/judge"), self.client.connection("http://vm0:8080/fetch"))
+        self.assertIsNot(self.client.connection("http://vm0:8080/judge"),
+                         self.client.connection("http://vm1:8080/judge"))
+
+    def test_tls_loaded_once(self):
+        JudgeServer.objects.create(service_url="https://vm2:8443", ca_pem="CA", c_cert="CERT", c_key="KEY",
+                                   last_heartbeat=timezone.now())
+        connection = self.client.connection("https://vm2:8443/judge")
+        with open(connection.session.verify) as fp:
+            self.assertEqual(fp.read(), "CA")
+        self.assertEqual(stat.S_IMODE(os.stat(connection.session.cert[1]).st_mode), 0o600)
+        self.assertIs(self.client.connection("https://vm2:8443/fetch"), connection)
+        tls_dir = os.path.dirname(connection.session.verify)
+        self.client.close()
+        self.assertFalse(os.path.exists(tls_dir))
+
+    def test_one_loop(self):
+        ok = mock.Mock(**{"json.return_value": {"err": None}})
+        connection = self.client.connection("http://vm0:8080/judge")
+        with mock.patch.object(connection.session, "post", return_value=ok):
+            self.client.post("http://vm0:8080/judge", {})
+            loop = self.client.loop()
+            self.assertEqual(self.client.post_many([("http://vm0:8080/judge", {})] * 3), [{"err": None}] * 3)
+        self.assertIs(self.client.loop(), loop)
+        self.assertTrue(loop.is_running())
+
+    def test_retry_idempotent_only(self):
+        connection = self.client.connection("http://vm0:8080/fetch")
+        with mock.patch.object(connection.session, "post", side_effect=requests.ReadTimeout()) as post:
+            self.assertIsNone(self.client.post("http://vm0:8080/fetch", {}, idempotent=True))
+            self.assertEqual(post.call_count, 3)
+            self.assertIsNone(self.client.post("http://vm0:8080/judge", {}))
+            self.assertEqual(post.call_count, 4)
+        connection.breaker.record_success()
+        ok = mock.Mock(**{"json.return_value": {"err": None}})
+        with mock.patch.object(connection.session, "post", side_effect=[requests.ConnectTimeout(), ok]):
+            self.assertEqual(self.client.post("http://vm0:8080/judge", {}), {"err": None})
+
+    def test_not_found(self):
+        connection = self.client.connection("http://vm0:8080/cancel")
+        connection.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        with mock.patch.object(connection.session, "post", return_value=mock.Mock(status_code=404)) as post:
+            self.assertEqual(self.client.post("http://vm0:8080/cancel", {}, idempotent=True),
+                             {"err": NOT_FOUND, "data": "http://vm0:8080/cancel"})
+        # answered, not retried and not a failure of the server
+        self.assertEqual(post.call_count, 1)
+        self.assertFalse(connection.breaker.is_open)
+
+    def test_circuit_breaker(self):
+        connection = self.client.connection("http://vm1:8080/judge")
+        connection.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        with mock.patch.object(connection.session, "post", side_effect=requests.ConnectionError()) as post:
+            self.client.post("http://vm1:8080/judge", {})
+            self.client.post("http://vm1:8080/judge", {})
+            self.assertTrue(connection.breaker.is_open)
+            self.client.post("http://vm1:8080/judge", {})
+            self.assertEqual(post.call_count, 2)
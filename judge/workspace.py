@@ -0,0 +1,242 @@
+import errno
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+import zlib
+from os.path import dirname, isdir, join, exists
+
+# ioctl request number of FICLONE on linux, see linux/fs.h
+FICLONE = 0x40049409
+
+
+class LinkMode:
+    Reflink  = "reflink"
+    Hardlink = "hardlink"
+    Copy     = "copy"
+
+
+def reflink_file(src: str, dst: str):
+    # copy-on-write clone, only supported by btrfs/xfs/overlayfs and friends
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        except OSError:
+            os.close(dst_fd)
+            os.remove(dst)
+            raise
+        os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    shutil.copystat(src, dst)
+
+
+def link_or_copy(src: str, dst: str, mode: str = LinkMode.Reflink) -> str:
+    """
+    share the content of src with dst in the cheapest way the filesystem allows
+    :return: the LinkMode actually used
+    """
+    if mode == LinkMode.Reflink:
+        try:
+            reflink_file(src, dst)
+            return LinkMode.Reflink
+        except OSError:
+            # never fall back to a hardlink, the copy would share the inode with src
+            mode = LinkMode.Copy
+    if mode == LinkMode.Hardlink:
+        try:
+            os.link(src, dst)
+            return LinkMode.Hardlink
+        except OSError as e:
+            # cross device or too many links, fallback to a real copy
+            if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM, errno.ENOTSUP):
+                raise
+    shutil.copy2(src, dst)
+    return LinkMode.Copy
+
+
+def file_crc32(file_path: str) -> int:
+    crc = 0
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+class ProblemPackage:
+    """
+    Pristine copy of the files of a problem directory, an uncompressed zip written when the problem is uploaded.
+    Submissions run with the uid of the worker and can reach the problem directory by its absolute path,
+    so the problem directory is checked against the package and restored from it.
+    The stat of every checked file is kept next to the package, a file is read and its crc computed
+    only when its stat changed. A write, chmod or utime always moves the ctime, which the owner can not set back.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.stat_path = path + ".stat"
+
+    def exists(self) -> bool:
+        return exists(self.path)
+
+    @staticmethod
+    def _fingerprint(st: os.stat_result) -> list:
+        return [st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_mode & 0o777]
+
+    def _load_stats(self) -> dict:
+        try:
+            with open(self.stat_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_stats(self, stats: dict):
+        fd, tmp_path = tempfile.mkstemp(dir=dirname(self.path), prefix=".stat")
+        with os.fdopen(fd, "w") as f:
+            json.dump(stats, f)
+        os.replace(tmp_path, self.stat_path)
+
+    def create(self, problem_dir: str):
+        os.makedirs(dirname(self.path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=dirname(self.path), prefix=".package")
+        os.close(fd)
+        stats = {}
+        try:
+            with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_STORED) as zf:
+                for filename in sorted(os.listdir(problem_dir)):
+                    file_path = join(problem_dir, filename)
+                    if not isdir(file_path):
+                        stats[filename] = self._fingerprint(os.stat(file_path))
+                        zf.write(file_path, filename)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self._save_stats(stats)
+
+    def remove(self):
+        for path in (self.path, self.stat_path):
+            if exists(path):
+                os.remove(path)
+
+    def filenames(self) -> list:
+        with zipfile.ZipFile(self.path) as zf:
+            return zf.namelist()
+
+    def modified_files(self, problem_dir: str) -> list:
+        """
+        :return: files of problem_dir which are changed, missing or not in the package
+        """
+        with zipfile.ZipFile(self.path) as zf:
+            members = {info.filename: info for info in zf.infolist()}
+        stats = self._load_stats()
+        changed = False
+        modified = []
+        for filename in os.listdir(problem_dir):
+            if filename not in members and not isdir(join(problem_dir, filename)):
+                modified.append(filename)
+        for filename, info in members.items():
+            file_path = join(problem_dir, filename)
+            if not exists(file_path) or os.path.islink(file_path) or isdir(file_path):
+                modified.append(filename)
+                continue
+            st = os.stat(file_path)
+            fingerprint = self._fingerprint(st)
+            if stats.get(filename) == fingerprint:
+                continue
+            # a tester which lost its exec bit fails every submission
+            if st.st_size != info.file_size or (st.st_mode & 0o777) != (info.external_attr >> 16) & 0o777 \
+                    or file_crc32(file_path) != info.CRC:
+                modified.append(filename)
+            else:
+                # touched but the same content, do not read it again
+                stats[filename] = fingerprint
+                changed = True
+        if changed:
+            self._save_stats(stats)
+        return sorted(modified)
+
+    def restore(self, problem_dir: str, filenames: list):
+        stats = self._load_stats()
+        with zipfile.ZipFile(self.path) as zf:
+            members = set(zf.namelist())
+            for filename in filenames:
+                file_path = join(problem_dir, filename)
+                if filename not in members:
+                    os.remove(file_path)
+                    continue
+                # extract aside and rename, a running tester never reads a half written file
+                tmp_dir = tempfile.mkdtemp(dir=problem_dir, prefix=".restore")
+                try:
+                    extracted = zf.extract(filename, tmp_dir)
+                    os.chmod(extracted, (zf.getinfo(filename).external_attr >> 16) & 0o777)
+                    if isdir(file_path) and not os.path.islink(file_path):
+                        shutil.rmtree(file_path)
+                    os.replace(extracted, file_path)
+                finally:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                stats[filename] = self._fingerprint(os.stat(file_path))
+        self._save_stats(stats)
+
+
+class SubmissionWorkspace:
+    """
+    Build the working directory of a submission from the problem directory.
+     - problem assets (tester, testcases, datasets) are reflinked when the filesystem supports it, copied otherwise,
+       they are never hardlinked since the submission could write through the shared inode
+     - only the files in code_names are written into the workspace
+     - with a package, only the files of the package are used, and verify_assets() restores
+       the assets of the problem directory which were changed while running the tester
+    """
+    def __init__(self, problem_dir: str, workspace_dir: str, code_names: list, mode: str = LinkMode.Reflink,
+                 package: ProblemPackage = None):
+        self.problem_dir = problem_dir
+        self.workspace_dir = workspace_dir
+        self.code_names = list(code_names)
+        self.mode = mode
+        self.package = package
+        # filename -> LinkMode
+        self.linked_files = {}
+
+    def build(self, code_list: list):
+        if not exists(self.problem_dir):
+            raise Exception("problem dir {} not exists".format(self.problem_dir))
+        os.makedirs(self.workspace_dir, exist_ok=True)
+        if self.package:
+            # a former submission may have changed the assets after its own check
+            self.verify_assets()
+            filenames = self.package.filenames()
+        else:
+            filenames = os.listdir(self.problem_dir)
+        for filename in filenames:
+            src = join(self.problem_dir, filename)
+            if isdir(src) or filename in self.code_names:
+                continue
+            dst = join(self.workspace_dir, filename)
+            # rejudge reuses the workspace directory
+            if exists(dst) or os.path.islink(dst):
+                os.remove(dst)
+            self.linked_files[filename] = link_or_copy(src, dst, self.mode)
+        for index, codename in enumerate(self.code_names):
+            codepath = join(self.workspace_dir, codename)
+            if exists(codepath):
+                os.remove(codepath)
+            with open(codepath, "w") as wfp:
+                print(f"substitude {codepath} with user implemented")
+                wfp.write(code_list[index])
+
+    def verify_assets(self) -> list:
+        """
+        restore the files of the problem directory which differ from the package
+        :return: the restored filenames, empty if nothing was changed or there is no package
+        """
+        if not self.package:
+            return []
+        modified = self.package.modified_files(self.problem_dir)
+        if modified:
+            print(f"assets {modified} of {self.problem_dir} were modified, restore them from {self.package.path}")
+            self.package.restore(self.problem_dir, modified)
+        return modified
@@ -49,6 +49,8 @@ else:
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': "onl.db",
+            # a file database, so that concurrency tests can share it between threads
+            'TEST': {'NAME': "onl_test.db"},
         }
     }
     # DATABASES = {
@@ -261,6 +263,8 @@ CACHES = {
 
 SESSION_ENGINE = "django.contrib.sessions.backends.cache"
 SESSION_CACHE_ALIAS = "default"
+# seconds between two writes of the session activity when the ip and user agent do not change
+SESSION_ACTIVITY_INTERVAL = int(get_env("SESSION_ACTIVITY_INTERVAL", "60"))
 
 DRAMATIQ_BROKER = {
     "BROKER": "dramatiq.brokers.redis.RedisBroker",
@@ -294,4 +298,33 @@ RAVEN_CONFIG = {
 
 IP_HEADER = "HTTP_X_REAL_IP"
 
+# seconds between two flushes of the aggregated submission counters, 0 updates the database immediately
+STATS_FLUSH_INTERVAL = int(get_env("STATS_FLUSH_INTERVAL", "5"))
+
+# placement strategy of the remote dispatcher, one of first-fit, best-fit, least-loaded, spread
+JUDGE_PLACEMENT_STRATEGY = get_env("JUDGE_PLACEMENT_STRATEGY", "best-fit")
+
+# requests to the judge servers, seconds
+JUDGE_CONNECT_TIMEOUT = float(get_env("JUDGE_CONNECT_TIMEOUT", "3"))
+JUDGE_READ_TIMEOUT = float(get_env("JUDGE_READ_TIMEOUT", "30"))
+# keep-alive connections per judge server in each process
+JUDGE_POOL_SIZE = int(get_env("JUDGE_POOL_SIZE", "10"))
+JUDGE_RETRIES = int(get_env("JUDGE_RETRIES", "2"))
+JUDGE_RETRY_BACKOFF = float(get_env("JUDGE_RETRY_BACKOFF", "0.2"))
+# failures in a row before a judge server is skipped, and seconds before it is tried again
+JUDGE_CIRCUIT_FAILURES = int(get_env("JUDGE_CIRCUIT_FAILURES", "5"))
+JUDGE_CIRCUIT_RESET = float(get_env("JUDGE_CIRCUIT_RESET", "30"))
+# seconds a port handed out to a submission may be reported available by its server before it is taken back
+JUDGE_PORT_RECLAIM_GRACE = float(get_env("JUDGE_PORT_RECLAIM_GRACE", "300"))
+
+# seconds a client waits in the submission wait api before it asks again
+SUBMISSION_WAIT_TIMEOUT = float(get_env("SUBMISSION_WAIT_TIMEOUT", "5"))
+# clients waiting at the same time across all gunicorn workers, each one holds a sync worker,
+# half of the workers by default, the others get the current result at once with retry_after
+SUBMISSION_WAIT_MAX_WAITERS = int(get_env("SUBMISSION_WAIT_MAX_WAITERS",
+                                          str(max(int(get_env("MAX_WORKER_NUM", str(os.cpu_count() or 2))) // 2, 1))))
+
+# seconds between two checks of the options version, in case a change notification was missed
+OPTIONS_CHECK_INTERVAL = float(get_env("OPTIONS_CHECK_INTERVAL", "10"))
+
 DEFAULT_AUTO_FIELD='django.db.models.AutoField'
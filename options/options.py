@@ -1,10 +1,15 @@
+import copy
 import functools
+import logging
 import os
 import threading
 import time
 
-from django.db import transaction, IntegrityError
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
 
+from utils.cache import cache
+from utils.constants import CacheKey
 from utils.shortcuts import rand_str
 from judge.languages import languages
 from .models import SysOptions as SysOptionsModel
@@ -86,6 +91,90 @@ class my_property:
 
 DEFAULT_SHORT_TTL = 2
 
+logger = logging.getLogger(__name__)
+
+
+class OptionsCache:
+    """
+    All options of the process, loaded in one query and kept until they change.
+    A change bumps a version in redis and is announced on a pub/sub channel, a listener thread of every process
+    drops its copy. The version is compared every OPTIONS_CHECK_INTERVAL seconds as well, so a message missed
+    while redis was unreachable delays a change by that long at most.
+    Options read inside a transaction are not kept, the transaction may be rolled back.
+    """
+    def __init__(self):
+        self._values = None
+        self._version = None
+        self._checked_at = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = cache.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CacheKey.options_changed)
+                # changes made before the subscription are not announced again
+                self.invalidate()
+                for _ in pubsub.listen():
+                    self.invalidate()
+            except Exception as e:
+                logger.warning(f"options listener failed, retrying: {e}")
+                self.invalidate()
+                time.sleep(1)
+
+    def _start_listener(self):
+        # threads do not survive the fork of gunicorn and dramatiq workers
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    threading.Thread(target=self._listen, name="options-listener", daemon=True).start()
+
+    def invalidate(self):
+        self._values = None
+
+    def _remote_version(self):
+        return cache.get(CacheKey.options_version) or 0
+
+    def load(self) -> dict:
+        keys = _SysOptionsMeta._get_keys()
+        version = self._remote_version()
+        values = dict(SysOptionsModel.objects.filter(key__in=keys).values_list("key", "value"))
+        if len(values) < len(keys):
+            _SysOptionsMeta._init_option()
+            values = dict(SysOptionsModel.objects.filter(key__in=keys).values_list("key", "value"))
+        if not connection.in_atomic_block:
+            self._values, self._version, self._checked_at = values, version, time.monotonic()
+        return values
+
+    def get(self, key):
+        self._start_listener()
+        values = self._values
+        if values is not None and time.monotonic() - self._checked_at > settings.OPTIONS_CHECK_INTERVAL:
+            self._checked_at = time.monotonic()
+            if self._remote_version() != self._version:
+                values = None
+        if values is None:
+            values = self.load()
+        value = values[key]
+        return copy.deepcopy(value) if isinstance(value, (dict, list)) else value
+
+    def changed(self):
+        """
+        drop the options of this process now, and of the other processes once the change is committed
+        """
+        self.invalidate()
+
+        def announce():
+            self.invalidate()
+            cache.redis_incr(CacheKey.options_version)
+            cache.publish(CacheKey.options_changed, "")
+        transaction.on_commit(announce)
+
+
+options_cache = OptionsCache()
+
 
 def default_token():
     token = os.environ.get("JUDGE_SERVER_TOKEN")
@@ -114,8 +203,13 @@ class OptionDefaultValue:
     submission_list_show_all = True
     smtp_config = {}
     judge_server_token = default_token
+    # buckets of the endpoints without a policy in endpoints
     throttling = {"ip": {"capacity": 100, "fill_rate": 0.1, "default_capacity": 50},
-                  "user": {"capacity": 20, "fill_rate": 0.03, "default_capacity": 10}}
+                  "user": {"capacity": 20, "fill_rate": 0.03, "default_capacity": 10},
+                  "endpoints": {
+                      "submission": {"user": {"capacity": 3, "fill_rate": 0.07, "default_capacity": 3},
+                                     "ip": {"capacity": 30, "fill_rate": 0.5, "default_capacity": 30},
+                                     "contest": {"capacity": 300, "fill_rate": 10, "default_capacity": 300}}}}
     languages = languages
 
 
@@ -138,13 +232,7 @@ class _SysOptionsMeta(type):
 
     @classmethod
     def _get_option(mcs, option_key):
-        try:
-            option = SysOptionsModel.objects.get(key=option_key)
-            value = option.value
-            return value
-        except SysOptionsModel.DoesNotExist:
-            mcs._init_option()
-            return mcs._get_option(option_key)
+        return options_cache.get(option_key)
 
     @classmethod
     def _set_option(mcs, option_key: str, option_value):
@@ -153,6 +241,7 @@ class _SysOptionsMeta(type):
                 option = SysOptionsModel.objects.select_for_update().get(key=option_key)
                 option.value = option_value
                 option.save()
+            options_cache.changed()
         except SysOptionsModel.DoesNotExist:
             mcs._init_option()
             mcs._set_option(option_key, option_value)
@@ -165,6 +254,7 @@ class _SysOptionsMeta(type):
                 value = option.value + 1
                 option.value = value
                 option.save()
+            options_cache.changed()
         except SysOptionsModel.DoesNotExist:
             mcs._init_option()
             return mcs._increment(option_key)
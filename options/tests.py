@@ -0,0 +1,54 @@
+import time
+
+from django.test import TransactionTestCase, override_settings
+
+from utils.cache import cache
+from utils.constants import CacheKey
+
+from .models import SysOptions as SysOptionsModel
+from .options import SysOptions, options_cache
+
+
+class OptionsCacheTest(TransactionTestCase):
+    def setUp(self):
+        options_cache.invalidate()
+        SysOptions.website_name = "test"
+
+    def tearDown(self):
+        options_cache.invalidate()
+
+    def _wait_for(self, name, value, seconds=2):
+        deadline = time.monotonic() + seconds
+        while getattr(SysOptions, name) != value and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return getattr(SysOptions, name)
+
+    def test_no_queries_once_loaded(self):
+        SysOptions.judge_server_token
+        with self.assertNumQueries(0):
+            for _ in range(10):
+                SysOptions.judge_server_token
+                SysOptions.throttling
+                SysOptions.smtp_config
+
+    def test_values_are_copies(self):
+        SysOptions.throttling["user"]["capacity"] = 0
+        self.assertNotEqual(SysOptions.throttling["user"]["capacity"], 0)
+
+    def test_local_change(self):
+        SysOptions.judge_server_token = "token"
+        self.assertEqual(SysOptions.judge_server_token, "token")
+
+    def test_change_of_other_process(self):
+        SysOptions.smtp_config
+        SysOptionsModel.objects.filter(key="smtp_config").update(value={"server": "smtp.example.com"})
+        cache.redis_incr(CacheKey.options_version)
+        cache.publish(CacheKey.options_changed, "")
+        self.assertEqual(self._wait_for("smtp_config", {"server": "smtp.example.com"}), {"server": "smtp.example.com"})
+
+    @override_settings(OPTIONS_CHECK_INTERVAL=0)
+    def test_missed_message(self):
+        SysOptions.smtp_config
+        SysOptionsModel.objects.filter(key="smtp_config").update(value={"server": "smtp.example.com"})
+        cache.redis_incr(CacheKey.options_version)
+        self.assertEqual(SysOptions.smtp_config, {"server": "smtp.example.com"})
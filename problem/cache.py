@@ -0,0 +1,83 @@
+from judge.stats import stats
+from utils.cache import cache
+from utils.constants import CacheKey
+
+from .models import Problem
+from .serializers import ProblemSerializer, ProblemSafeSerializer
+
+
+class ProblemPayloadCache:
+    """
+    Serialized problems of the user api, the same for every user, read through redis.
+    Keys carry the version of their contest (or of the public problems), writes in the admin api bump it,
+    old payloads are not read again and expire by themselves.
+    A payload built while a write bumps the version is stored under the old version, it is never served.
+    The counters are cached with the payload, the stats flush invalidates the payloads of the problems it updates,
+    the deltas not flushed yet are added on every request, my_status is added by the views.
+    """
+    timeout = 60 * 60
+
+    @staticmethod
+    def _scope(contest_id):
+        return contest_id or "public"
+
+    def _version_key(self, contest_id):
+        return f"{CacheKey.problem_payload_version}:{self._scope(contest_id)}"
+
+    def _key(self, contest_id, name):
+        version = cache.get(self._version_key(contest_id)) or 0
+        return f"{CacheKey.problem_payload}:{self._scope(contest_id)}:{version}:{name}"
+
+    def invalidate(self, contest_id=None):
+        cache.redis_incr(self._version_key(contest_id))
+
+    def invalidate_problems(self, problem_ids):
+        """
+        invalidate the payloads of the contests (or the public problems) holding problem_ids
+        """
+        contest_ids = Problem.objects.filter(id__in=list(problem_ids)).values_list("contest_id", flat=True).distinct()
+        for contest_id in contest_ids:
+            self.invalidate(contest_id)
+
+    def _get_or_build(self, key, build):
+        data = cache.get(key)
+        if data is None:
+            data = build()
+            if data is not None:
+                cache.set(key, data, self.timeout)
+        return data
+
+    def problem(self, _id, contest_id=None, safe=False):
+        """
+        :param safe: serialize with ProblemSafeSerializer, without the counters
+        :return: the visible problem, None if it does not exist
+        """
+        serializer = ProblemSafeSerializer if safe else ProblemSerializer
+
+        def build():
+            problem = Problem.objects.select_related("created_by") \
+                .filter(_id=_id, contest_id=contest_id, visible=True).first()
+            return serializer(problem).data if problem else None
+
+        data = self._get_or_build(self._key(contest_id, f"{serializer.__name__}:{_id}"), build)
+        if data is not None and not safe:
+            stats.merge_pending("problem", data)
+        return data
+
+    def problems(self, contest_id, safe=False):
+        """
+        :return: visible problems of a contest
+        """
+        serializer = ProblemSafeSerializer if safe else ProblemSerializer
+
+        def build():
+            problems = Problem.objects.select_related("created_by").filter(contest_id=contest_id, visible=True)
+            return serializer(problems, many=True).data
+
+        data = self._get_or_build(self._key(contest_id, serializer.__name__), build)
+        if data and not safe:
+            stats.merge_pending("problem", data)
+        return data
+
+
+problem_cache = ProblemPayloadCache()
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from utils.models import JSONField, ListFeild
 
 from account.models import User
@@ -13,6 +13,10 @@ class ProblemTag(models.Model):
     class Meta:
         db_table = "problem_tag"
 
+# upper bound of Problem.parallel_workers, the tester processes of one submission
+MAX_PARALLEL_WORKERS = 16
+
+
 class Problem(models.Model):
     # display ID
     _id = models.TextField(db_index=True)
@@ -31,6 +35,8 @@ class Problem(models.Model):
     port_num = models.JSONField(default=list)
     code_num = models.IntegerField()
     code_names = models.JSONField()
+    # run testcases in this many concurrent tester processes, 1 means serial, at most MAX_PARALLEL_WORKERS
+    parallel_workers = models.IntegerField(default=1)
     template = JSONField(null=True)
     create_time = models.DateTimeField(auto_now_add=True)
     # we can not use auto_now here
@@ -60,3 +66,40 @@ class Problem(models.Model):
         self.accepted_number = models.F("accepted_number") + 1
         self.save(update_fields=["accepted_number"])
 
+
+class ProblemStatus(models.Model):
+    """
+    best submission of a user on a problem, public and contest problems alike
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    problem = models.ForeignKey(Problem, on_delete=models.CASCADE)
+    # JudgeStatus of the best submission
+    status = models.IntegerField()
+    score = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = "problem_status"
+        unique_together = (("user", "problem"),)
+
+    @classmethod
+    def record(cls, user_id, problem_id, status, score):
+        """
+        keep the status and score of the best submission, a later submission with the same score replaces it
+        :return: the row before the update, None if the user had no result on the problem
+        """
+        rows = cls.objects.filter(user_id=user_id, problem_id=problem_id)
+        with transaction.atomic():
+            # write first, the UPDATE takes the row lock (the database lock on sqlite) before the row is read
+            rows.update(score=models.F("score"))
+            previous = rows.select_for_update().first()
+            if previous is None:
+                try:
+                    with transaction.atomic():
+                        cls.objects.create(user_id=user_id, problem_id=problem_id, status=status, score=score)
+                    return None
+                except IntegrityError:
+                    # created by a concurrent submission
+                    previous = rows.select_for_update().get()
+            if score >= previous.score:
+                rows.update(status=status, score=score)
+            return previous
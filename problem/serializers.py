@@ -8,7 +8,7 @@ from options.options import SysOptions
 from utils.api import UsernameSerializer, serializers
 from utils.serializers import LanguageNameMultiChoiceField, SPJLanguageNameChoiceField, LanguageNameChoiceField
 
-from .models import Problem, ProblemTag
+from .models import MAX_PARALLEL_WORKERS, Problem, ProblemTag
 from .utils import parse_problem_template
 
 class DockerImageUploadForm(forms.Form):
@@ -27,6 +27,7 @@ class CreateOrEditProblemSerializer(serializers.Serializer):
     description = serializers.CharField()
     code_num = serializers.IntegerField(min_value=1)
     code_names = serializers.ListField(child=serializers.CharField(), allow_empty=False)
+    parallel_workers = serializers.IntegerField(min_value=1, max_value=MAX_PARALLEL_WORKERS, required=False)
     tags = serializers.ListField(child=serializers.CharField(max_length=32), allow_empty=False)
     # hint = serializers.CharField(allow_blank=True, allow_null=True)
     # share_submission = serializers.BooleanField(default=False)
@@ -6,13 +6,19 @@ from datetime import timedelta
 from zipfile import ZipFile
 
 from django.conf import settings
+from django.core.management import call_command
+from django.test import override_settings
 
-from utils.api.tests import APITestCase
+from utils.api.tests import APITestCase, create_problem
+from .cache import problem_cache
 from .serializers import ProblemAdminSerializer
 from .models import ProblemTag
-from .models import Problem
+from .models import Problem, ProblemStatus
 from contest.models import Contest
 from contest.tests import DEFAULT_CONTEST_DATA
+from account.models import UserProfile
+from judge.stats import stats
+from submission.models import JudgeStatus, Submission
 
 from .utils import parse_problem_template
 
@@ -252,3 +258,113 @@ ddd
         self.assertEqual(ret["prepend"], "aaa\n")
         self.assertEqual(ret["template"], "")
         self.assertEqual(ret["append"], "ccc\n")
+
+
+class ProblemPayloadCacheTest(APITestCase):
+    def setUp(self):
+        self.admin = self.create_super_admin()
+        self.problem = create_problem(self.admin)
+        self.contest = Contest.objects.create(title="test", description="test", created_by=self.admin,
+                                              start_time=DEFAULT_CONTEST_DATA["start_time"] - timedelta(hours=1),
+                                              end_time=DEFAULT_CONTEST_DATA["end_time"])
+        self.contest_problem = create_problem(self.admin, _id="1", contest=self.contest)
+        problem_cache.invalidate()
+        problem_cache.invalidate(self.contest.id)
+
+    def get_problem(self):
+        return self.client.get(self.reverse("problem_api"), data={"problem_id": self.problem._id})
+
+    def get_contest_problems(self):
+        return self.client.get(self.reverse("contest_problem_api"), data={"contest_id": self.contest.id})
+
+    def test_problem_is_cached(self):
+        self.assertEqual(self.get_problem().data["data"]["title"], "test")
+        Problem.objects.filter(id=self.problem.id).update(title="changed")
+        with self.assertNumQueries(0):
+            problem_cache.problem(self.problem._id)
+        data = self.get_problem().data["data"]
+        self.assertEqual(data["title"], "test")
+        self.assertIn("my_status", data)
+
+        problem_cache.invalidate()
+        self.assertEqual(self.get_problem().data["data"]["title"], "changed")
+
+    @override_settings(STATS_FLUSH_INTERVAL=5)
+    def test_counters(self):
+        stats.flush()
+        self.get_problem()
+        stats.incr("problem", self.problem.id, submission_number=2)
+        # the deltas not flushed are added to the cached payload
+        with self.assertNumQueries(0):
+            self.assertEqual(problem_cache.problem(self.problem._id)["submission_number"], 2)
+        stats.flush()
+        # rebuilt with the flushed counters
+        with self.assertNumQueries(2):
+            self.assertEqual(problem_cache.problem(self.problem._id)["submission_number"], 2)
+        self.assertEqual(self.get_contest_problems().data["data"][0]["submission_number"], 0)
+
+    def test_make_contest_problem_public(self):
+        Problem.objects.filter(id=self.contest_problem.id).update(is_public=False)
+        keys = [problem_cache._key(self.contest.id, "problems"), problem_cache._key(None, "problems")]
+        resp = self.client.post(self.reverse("make_public_api"),
+                                data={"id": self.contest_problem.id, "display_id": "B-1"})
+        self.assertSuccess(resp)
+        self.assertNotEqual(problem_cache._key(self.contest.id, "problems"), keys[0])
+        self.assertNotEqual(problem_cache._key(None, "problems"), keys[1])
+
+    def test_contest_problems_are_cached(self):
+        self.assertEqual(len(self.get_contest_problems().data["data"]), 1)
+        create_problem(self.admin, _id="2", contest=self.contest)
+        self.assertEqual(len(self.get_contest_problems().data["data"]), 1)
+        # the public problems keep their version
+        self.get_problem()
+        problem_cache.invalidate(self.contest.id)
+        with self.assertNumQueries(0):
+            problem_cache.problem(self.problem._id)
+        self.assertEqual(len(self.get_contest_problems().data["data"]), 2)
+
+    def test_admin_writes_invalidate(self):
+        self.assertSuccess(self.get_problem())
+        self.assertSuccess(self.client.delete(self.reverse("problem_admin_api") + f"?id={self.problem.id}"))
+        self.assertFailed(self.get_problem(), "Problem does not exist")
+
+        self.assertEqual(len(self.get_contest_problems().data["data"]), 1)
+        resp = self.client.delete(self.reverse("contest_problem_admin_api") + f"?id={self.contest_problem.id}")
+        self.assertSuccess(resp)
+        self.assertEqual(self.get_contest_problems().data["data"], [])
+
+
+class ProblemStatusTest(APITestCase):
+    def setUp(self):
+        self.user = self.create_user("test", "test123")
+        self.problems = [create_problem(self.user, _id=str(i)) for i in range(3)]
+
+    def test_record_keeps_best(self):
+        problem = self.problems[0]
+        self.assertIsNone(ProblemStatus.record(self.user.id, problem.id, JudgeStatus.SOME_PASSED, 50))
+        self.assertEqual(ProblemStatus.record(self.user.id, problem.id, JudgeStatus.ALL_FAILED, 0).score, 50)
+        self.assertEqual(ProblemStatus.record(self.user.id, problem.id, JudgeStatus.ALL_PASSED, 100).score, 50)
+        row = ProblemStatus.objects.get(user=self.user, problem=problem)
+        self.assertEqual((row.status, row.score), (JudgeStatus.ALL_PASSED, 100))
+
+    def test_problem_list_status(self):
+        ProblemStatus.record(self.user.id, self.problems[1].id, JudgeStatus.ALL_PASSED, 100)
+        resp = self.client.get(self.reverse("problem_api"), data={"limit": 10})
+        self.assertSuccess(resp)
+        statuses = {item["id"]: item["my_status"] for item in resp.data["data"]["results"]}
+        self.assertEqual(statuses, {self.problems[0].id: None, self.problems[1].id: JudgeStatus.ALL_PASSED,
+                                    self.problems[2].id: None})
+
+    def test_migrate_blob(self):
+        Submission.objects.create(problem=self.problems[0], user_id=str(self.user.id), username="test",
+                                  language="Python3", code_list=[""])
+        UserProfile.objects.filter(user=self.user).update(problems_status={
+            "0": 60,
+            "problems": {str(self.problems[1].id): {"status": JudgeStatus.ALL_PASSED, "_id": "1"}},
+            "contest_problems": {"100000": {"status": JudgeStatus.ALL_FAILED, "_id": "1"}}})
+        ProblemStatus.record(self.user.id, self.problems[0].id, JudgeStatus.ALL_FAILED, 0)
+        for _ in range(2):
+            call_command("migrate_problems_status", stdout=open(os.devnull, "w"))
+        rows = {row.problem_id: (row.status, row.score) for row in ProblemStatus.objects.filter(user=self.user)}
+        self.assertEqual(rows, {self.problems[0].id: (JudgeStatus.SOME_PASSED, 60),
+                                self.problems[1].id: (JudgeStatus.ALL_PASSED, 100)})
@@ -12,9 +12,12 @@ from submission.models import Submission, JudgeStatus
 from utils.api import APIView, validate_serializer
 from utils.shortcuts import rand_str
 from utils.tasks import delete_files
+from judge.stats import stats
 from judge.testing import ZipFileUploader, create_new_problem_from_template, PathManager
+from judge.workspace import ProblemPackage
 
-from ..models import Problem, ProblemTag
+from ..cache import problem_cache
+from ..models import MAX_PARALLEL_WORKERS, Problem, ProblemTag
 from ..serializers import *
 
 class ProblemBase(APIView):
@@ -40,6 +43,8 @@ class ProblemAPI(ProblemBase):
         problem_data["code_num"] = int(request.POST.get("code_num"))
         problem_data["timeout"] = int(request.POST.get("timeout"))
         problem_data["code_names"] = request.POST.getlist("code_names")
+        problem_data["parallel_workers"] = min(max(int(request.POST.get("parallel_workers", 1)), 1),
+                                               MAX_PARALLEL_WORKERS)
         # print(problem_data)
         tags = request.POST.getlist("tags")
         problem_data["created_by"] = request.user
@@ -68,7 +73,7 @@ class ProblemAPI(ProblemBase):
             try:
                 problem = Problem.objects.get(id=problem_id)
                 ensure_created_by(problem, request.user)
-                return self.success(ProblemAdminSerializer(problem).data)
+                return self.success(stats.merge_pending("problem", ProblemAdminSerializer(problem).data)[0])
             except Problem.DoesNotExist:
                 return self.error("Problem does not exist")
 
@@ -79,7 +84,9 @@ class ProblemAPI(ProblemBase):
             problems = problems.filter(Q(title__icontains=keyword) | Q(_id__icontains=keyword))
         if not user.can_mgmt_all_problem():
             problems = problems.filter(created_by=user)
-        return self.success(self.paginate_data(request, problems, ProblemAdminSerializer))
+        data = self.paginate_data(request, problems, ProblemAdminSerializer)
+        stats.merge_pending("problem", data["results"])
+        return self.success(data)
 
     @problem_permission_required
     @validate_serializer(EditProblemSerializer)
@@ -113,6 +120,7 @@ class ProblemAPI(ProblemBase):
             except ProblemTag.DoesNotExist:
                 tag = ProblemTag.objects.create(name=tag)
             problem.tags.add(tag)
+        problem_cache.invalidate(problem.contest_id)
 
         return self.success()
 
@@ -130,7 +138,9 @@ class ProblemAPI(ProblemBase):
         if os.path.isdir(d):
             print('remove dir', d)
             shutil.rmtree(d, ignore_errors=True)
+        ProblemPackage(PathManager.package_path(problem.id)).remove()
         problem.delete()
+        problem_cache.invalidate()
         return self.success()
 
 class ContestProblemAPI(ProblemBase):
@@ -164,12 +174,14 @@ class ContestProblemAPI(ProblemBase):
         data["total_score"] = problem.total_score
         data["share_submission"] = False
         data["code_num"] = problem.code_num
+        data["parallel_workers"] = problem.parallel_workers
         tags = problem.tags.all()
         data["_id"] = data.pop("display_id")
         data["is_public"] = True
         data["submission_number"] = data["accepted_number"] = 0
         problem = Problem.objects.create(**data)
         problem.tags.set(tags)
+        problem_cache.invalidate(contest.id)
         return self.success(ProblemAdminSerializer(problem).data)
 
     def get(self, request):
@@ -182,7 +194,7 @@ class ContestProblemAPI(ProblemBase):
                 ensure_managed_by(problem.contest, user)
             except Problem.DoesNotExist:
                 return self.error("Problem does not exist")
-            return self.success(ProblemAdminSerializer(problem).data)
+            return self.success(stats.merge_pending("problem", ProblemAdminSerializer(problem).data)[0])
 
         if not contest_id:
             return self.error("Contest id is required")
@@ -195,7 +207,9 @@ class ContestProblemAPI(ProblemBase):
         keyword = request.GET.get("keyword")
         if keyword:
             problems = problems.filter(title__contains=keyword)
-        return self.success(self.paginate_data(request, problems, ProblemAdminSerializer))
+        data = self.paginate_data(request, problems, ProblemAdminSerializer)
+        stats.merge_pending("problem", data["results"])
+        return self.success(data)
 
     @validate_serializer(EditContestProblemSerializer)
     def put(self, request):
@@ -239,6 +253,7 @@ class ContestProblemAPI(ProblemBase):
             except ProblemTag.DoesNotExist:
                 tag = ProblemTag.objects.create(name=tag)
             problem.tags.add(tag)
+        problem_cache.invalidate(contest.id)
         return self.success()
 
     def delete(self, request):
@@ -258,6 +273,7 @@ class ContestProblemAPI(ProblemBase):
         # if os.path.isdir(d):
         #    shutil.rmtree(d, ignore_errors=True)
         problem.delete()
+        problem_cache.invalidate(problem.contest_id)
         return self.success()
 
 
@@ -279,6 +295,7 @@ class MakeContestProblemPublicAPIView(APIView):
             return self.error("Already be a public problem")
         problem.is_public = True
         problem.save()
+        problem_cache.invalidate(problem.contest_id)
         # https://docs.djangoproject.com/en/1.11/topics/db/queries/#copying-model-instances
         tags = problem.tags.all()
         problem.pk = None
@@ -289,6 +306,7 @@ class MakeContestProblemPublicAPIView(APIView):
         problem.statistic_info = {}
         problem.save()
         problem.tags.set(tags)
+        problem_cache.invalidate()
         return self.success()
 
 class AddContestProblemAPI(APIView):
@@ -316,12 +334,14 @@ class AddContestProblemAPI(APIView):
         data["code_num"] = old_problem.code_num
         data["code_names"] = old_problem.code_names
         data["timeout"] = old_problem.timeout
+        data["parallel_workers"] = old_problem.parallel_workers
         
         tags = old_problem.tags.all()
         data["_id"] = data.pop("display_id")
         data["submission_number"] = data["accepted_number"] = 0
         new_problem = Problem.objects.create(**data)
         new_problem.tags.set(tags)
+        problem_cache.invalidate(contest.id)
 
         create_new_problem_from_template(new_problem.id, old_problem.id)
 
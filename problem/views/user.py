@@ -2,8 +2,21 @@ import random
 from django.db.models import Q, Count
 from utils.api import APIView
 from account.decorators import check_contest_permission
-from ..models import ProblemTag, Problem
-from ..serializers import ProblemSerializer, TagSerializer, ProblemSafeSerializer
+from ..cache import problem_cache
+from ..models import ProblemTag, Problem, ProblemStatus
+from ..serializers import TagSerializer, ProblemSafeSerializer
+
+
+def add_problem_status(request, problems):
+    """
+    add my_status to serialized problems, one query for all of them
+    """
+    if not request.user.is_authenticated:
+        return
+    statuses = dict(ProblemStatus.objects.filter(user_id=request.user.id, problem_id__in=[p["id"] for p in problems])
+                    .values_list("problem_id", "status"))
+    for problem in problems:
+        problem["my_status"] = statuses.get(problem["id"])
 
 
 class ProblemTagAPI(APIView):
@@ -25,32 +38,15 @@ class PickOneAPI(APIView):
 
 #主动请求Lab运行状态(在这实现)
 class ProblemAPI(APIView):
-    @staticmethod
-    def _add_problem_status(request, queryset_values):
-        if request.user.is_authenticated:
-            profile = request.user.userprofile
-            problems_status = profile.problems_status.get("problems", {})
-            # paginate data
-            results = queryset_values.get("results")
-            if results is not None:
-                problems = results
-            else:
-                problems = [queryset_values, ]
-            for problem in problems:
-                problem["my_status"] = problems_status.get(str(problem["id"]), {}).get("status")
-
     def get(self, request):
         # 问题详情页
         problem_id = request.GET.get("problem_id")
         if problem_id:
-            try:
-                problem = Problem.objects.select_related("created_by") \
-                    .get(_id=problem_id, contest_id__isnull=True, visible=True)
-                problem_data = ProblemSerializer(problem).data
-                self._add_problem_status(request, problem_data)
-                return self.success(problem_data)
-            except Problem.DoesNotExist:
+            problem_data = problem_cache.problem(problem_id)
+            if problem_data is None:
                 return self.error("Problem does not exist")
+            add_problem_status(request, [problem_data])
+            return self.success(problem_data)
 
         limit = request.GET.get("limit")
         if not limit:
@@ -66,39 +62,25 @@ class ProblemAPI(APIView):
         keyword = request.GET.get("keyword", "").strip()
         if keyword:
             problems = problems.filter(Q(title__icontains=keyword) | Q(_id__icontains=keyword))
-        return self.success(self.paginate_data(request, problems, ProblemSafeSerializer))
+        data = self.paginate_data(request, problems, ProblemSafeSerializer)
+        add_problem_status(request, data["results"])
+        return self.success(data)
 
 class ContestProblemAPI(APIView):
-    def _add_problem_status(self, request, queryset_values):
-        if request.user.is_authenticated:
-            profile = request.user.userprofile
-
-            problems_status = profile.problems_status.get("contest_problems", {})
-            for problem in queryset_values:
-                problem["my_status"] = problems_status.get(str(problem["id"]), {}).get("status")
-
     # self.contest get by data["contest_id"] or phase from the request url
     @check_contest_permission(check_type="problems")
     def get(self, request):
         problem_id = request.GET.get("problem_id")
+        details = self.contest.problem_details_permission(request.user)
         if problem_id:
-            try:
-                problem = Problem.objects.select_related("created_by").get(_id=problem_id,
-                                                                           contest=self.contest,
-                                                                           visible=True)
-            except Problem.DoesNotExist:
+            problem_data = problem_cache.problem(problem_id, self.contest.id, safe=not details)
+            if problem_data is None:
                 return self.error("Problem does not exist.")
-            if self.contest.problem_details_permission(request.user):
-                problem_data = ProblemSerializer(problem).data
-                self._add_problem_status(request, [problem_data, ])
-            else:
-                problem_data = ProblemSafeSerializer(problem).data
+            if details:
+                add_problem_status(request, [problem_data])
             return self.success(problem_data)
 
-        contest_problems = Problem.objects.select_related("created_by").filter(contest=self.contest, visible=True)
-        if self.contest.problem_details_permission(request.user):
-            data = ProblemSerializer(contest_problems, many=True).data
-            self._add_problem_status(request, data)
-        else:
-            data = ProblemSafeSerializer(contest_problems, many=True).data
+        data = problem_cache.problems(self.contest.id, safe=not details)
+        if details:
+            add_problem_status(request, data)
         return self.success(data)
\ No newline at end of file
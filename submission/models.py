@@ -18,10 +18,48 @@ class JudgeStatus:
     PROGRAM_TIMEOUT = 6
 
 
+class SubmissionPermission:
+    """
+    Permissions of a user over submissions, the user is checked once for all the rows of a page.
+    The rows need their problem and contest, select_related("problem", "contest") loads them in the same query
+    """
+    def __init__(self, user):
+        self.user = user
+        self.authenticated = user is not None and user.is_authenticated
+        if self.authenticated:
+            self.user_id = str(user.id)
+            self.manage_all = user.is_super_admin() or user.can_mgmt_all_problem()
+        # contest id: the contest has ended
+        self._contest_ended = {}
+
+    def _contest_ended_of(self, contest):
+        if contest.id not in self._contest_ended:
+            self._contest_ended[contest.id] = contest.status == ContestStatus.CONTEST_ENDED
+        return self._contest_ended[contest.id]
+
+    def check(self, submission, check_share=True):
+        if not self.authenticated:
+            return False
+        if (
+            str(submission.user_id) == self.user_id
+            or self.manage_all
+            or submission.problem.created_by_id == self.user.id
+        ):
+            return True
+
+        if check_share:
+            if submission.contest_id and not self._contest_ended_of(submission.contest):
+                return False
+            if submission.problem.share_submission or submission.shared:
+                return True
+        return False
+
+
 class Submission(models.Model):
     id = models.TextField(default=rand_str, primary_key=True, db_index=True)
-    contest = models.ForeignKey(Contest, null=True, on_delete=models.CASCADE)
-    problem = models.ForeignKey(Problem, on_delete=models.CASCADE)
+    # indexed by the composite indexes below
+    contest = models.ForeignKey(Contest, null=True, on_delete=models.CASCADE, db_index=False)
+    problem = models.ForeignKey(Problem, on_delete=models.CASCADE, db_index=False)
     create_time = models.DateTimeField(auto_now_add=True)
     user_id = models.CharField(db_index=True, max_length=50)
     username = models.TextField()
@@ -36,21 +74,11 @@ class Submission(models.Model):
     ip = models.TextField(null=True)
     execution_time = models.FloatField(default=0.0)
 
-    def check_user_permission(self, user, check_share=True):
-        if (
-            str(self.user_id) == str(user.id)
-            or user.is_super_admin()
-            or user.can_mgmt_all_problem()
-            or self.problem.created_by_id == user.id
-        ):
-            return True
+    # keyset of the cursor pagination of the submission lists, newest first
+    cursor_fields = ("-create_time", "-id")
 
-        if check_share:
-            if self.contest and self.contest.status != ContestStatus.CONTEST_ENDED:
-                return False
-            if self.problem.share_submission or self.shared:
-                return True
-        return False
+    def check_user_permission(self, user, check_share=True):
+        return SubmissionPermission(user).check(self, check_share)
 
     def modify_permission(self, user, check_share=True):
         if user.is_super_admin() or (
@@ -62,6 +90,19 @@ class Submission(models.Model):
     class Meta:
         db_table = "submission"
         ordering = ("-create_time",)
+        # every list is read newest first, the indexes end with the keyset of cursor_fields
+        indexes = [
+            # SubmissionListAPI, the submissions of a user out of contests
+            models.Index(fields=["user_id", "-create_time", "-id"], condition=models.Q(contest__isnull=True),
+                         name="submission_user_public_idx"),
+            # ContestSubmissionListAPI of contest admins, of a user and of a username
+            models.Index(fields=["contest", "-create_time", "-id"], name="submission_contest_idx"),
+            models.Index(fields=["contest", "user_id", "-create_time", "-id"], name="submission_contest_user_idx"),
+            models.Index(fields=["contest", "username", "-create_time", "-id"], name="submission_contest_name_idx"),
+            # SubmissionAdminAPI of super admins and of a problem
+            models.Index(fields=["-create_time", "-id"], name="submission_create_time_idx"),
+            models.Index(fields=["problem", "-create_time", "-id"], name="submission_problem_idx"),
+        ]
 
     def __str__(self):
         return self.id
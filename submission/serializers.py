@@ -1,4 +1,4 @@
-from .models import Submission
+from .models import Submission, SubmissionPermission
 from utils.api import serializers
 from utils.serializers import LanguageNameChoiceField
 
@@ -38,12 +38,12 @@ class SubmissionListSerializer(serializers.ModelSerializer):
     def __init__(self, *args, **kwargs):
         self.user = kwargs.pop("user", None)
         super().__init__(*args, **kwargs)
+        # shared by the rows of a page
+        self.permission = SubmissionPermission(self.user)
 
     class Meta:
         model = Submission
         exclude = ("contest", "code_list", "ip")
 
     def get_show_link(self, obj):
-        if self.user is None or not self.user.is_authenticated:
-            return False
-        return True
+        return self.permission.check(obj)
@@ -0,0 +1,146 @@
+import json
+import time
+import uuid
+from urllib.parse import urljoin
+
+from judge.client import judge_client
+from utils.cache import cache
+from utils.constants import CacheKey
+
+from .models import JudgeStatus
+
+# KEYS: waiters sorted set, ARGV: now, deadline, waiter, max waiters
+# waiters are scored by their deadline, the ones of a killed worker expire by themselves
+ENTER_WAIT_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[4]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[3])
+return 1
+"""
+
+
+class SubmissionStatusCache:
+    """
+    Latest result of remotely judged submissions.
+    The judge servers push results through SubmissionUpdateAPI, so listing submissions reads redis
+    instead of asking a judge server for every judging row. Results missing from the cache are fetched
+    in one concurrent batch and kept for a short time only, the pushed result replaces them.
+    """
+    timeout = 24 * 60 * 60
+    fetched_timeout = 10
+
+    def __init__(self):
+        self._enter_wait = cache.register_script(ENTER_WAIT_SCRIPT)
+
+    @staticmethod
+    def _key(submission_id):
+        return f"{CacheKey.submission_status}:{submission_id}"
+
+    @staticmethod
+    def _channel(submission_id):
+        return f"{CacheKey.submission_events}:{submission_id}"
+
+    def set(self, submission_id, result, timeout=None):
+        cache.set(self._key(submission_id), result, timeout or self.timeout)
+
+    def publish(self, submission_id, result, grade=None):
+        """
+        record a new result and push it to the clients waiting in SubmissionWaitAPI
+        """
+        self.set(submission_id, result)
+        cache.publish(self._channel(submission_id),
+                      json.dumps({"id": submission_id, "result": result, "grade": grade}))
+
+    def wait(self, submission_id, timeout: float, current=None, max_waiters: int = None):
+        """
+        block until a result of the submission is published
+        :param current: called once subscribed, returns the event if the submission is judged already,
+                        a result published between reading the submission and subscribing is not lost
+        :param max_waiters: waiters allowed at the same time across all processes, None for no limit
+        :return: {id, result, grade}, None on timeout, False when max_waiters are waiting already
+        """
+        waiter = uuid.uuid4().hex
+        if max_waiters is not None:
+            now = time.time()
+            if not self._enter_wait(keys=[CacheKey.submission_waiters], args=[now, now + timeout + 1, waiter,
+                                                                             max_waiters]):
+                return False
+        pubsub = cache.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(self._channel(submission_id))
+            event = current() if current else None
+            deadline = time.monotonic() + timeout
+            while event is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                message = pubsub.get_message(timeout=remaining)
+                if message:
+                    event = json.loads(message["data"])
+            return event
+        finally:
+            pubsub.close()
+            if max_waiters is not None:
+                cache.zrem(CacheKey.submission_waiters, waiter)
+
+    @staticmethod
+    def retry_after(timeout: float) -> float:
+        """
+        :return: seconds until the first waiter leaves at the latest, timeout at most
+        """
+        first = cache.zrange(CacheKey.submission_waiters, 0, 0, withscores=True)
+        if not first:
+            return 0
+        return round(min(max(first[0][1] - time.time(), 0), timeout), 1)
+
+    def get_many(self, submission_ids) -> dict:
+        """
+        :return: {submission_id: result} of the cached submissions
+        """
+        keys = {self._key(submission_id): submission_id for submission_id in submission_ids}
+        return {keys[key]: result for key, result in cache.get_many(list(keys)).items()}
+
+    @staticmethod
+    def _fetch_data(submission):
+        data = {
+            "submission_id": submission.id,
+            "vm_index": 0
+        }
+        if submission.problem.lab_id:
+            data["lab_id"] = submission.problem.lab_id
+        else:
+            data["lab_id"] = submission.problem.id
+        return data
+
+    def fetch(self, submissions) -> dict:
+        """
+        ask the judge servers for the results of submissions, all requests are sent concurrently
+        :return: {submission_id: result} of the submissions the servers answered
+        """
+        calls = [(urljoin(s.server_list[0], "/fetch"), self._fetch_data(s)) for s in submissions]
+        results = {}
+        for submission, resp in zip(submissions, judge_client.post_many(calls, idempotent=True)):
+            if resp and not resp["err"]:
+                results[submission.id] = resp["data"]["result"]
+                self.set(submission.id, results[submission.id], self.fetched_timeout)
+        return results
+
+    def apply(self, submissions):
+        """
+        update the result of judging submissions in place, from the cache or the judge servers
+        """
+        judging = [s for s in submissions if s.result == JudgeStatus.JUDGING and s.server_list]
+        if not judging:
+            return
+        results = self.get_many([s.id for s in judging])
+        missing = [s for s in judging if s.id not in results]
+        if missing:
+            results.update(self.fetch(missing))
+        for submission in judging:
+            if submission.id in results:
+                submission.result = results[submission.id]
+
+
+status_cache = SubmissionStatusCache()
@@ -1,10 +1,26 @@
+import os
+import threading
+import time
+import uuid
 from copy import deepcopy
+from datetime import timedelta
 from unittest import mock
 import hashlib
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+from account.models import AdminType, User, UserProfile
+from conf.models import JudgeServer
+from judge.stats import stats
+from contest.models import Contest
 from options.options import SysOptions
-from problem.models import Problem, ProblemTag
-from utils.api.tests import APITestCase
-from .models import Submission
+from problem.models import Problem, ProblemStatus, ProblemTag
+from utils.api.tests import APITestCase, create_problem
+from .models import JudgeStatus, Submission
+from utils.cache import cache
+from utils.constants import CacheKey
+from .status import status_cache
 
 DEFAULT_PROBLEM_DATA = {"_id": "A-110", "title": "test", "description": "<p>test</p>",
                         "visible": True, "tags": ["test"], "languages": ["C", "C++", "Java", "Python2"], "template": {},
@@ -89,3 +105,354 @@ class SubmissionAPITest(SubmissionPrepare):
 class SubmissionDispathTest(SubmissionPrepare):
     def setUp(self):
         self._create_problem()
+
+
+class SubmissionStatusCacheTest(APITestCase):
+    def setUp(self):
+        admin = self.create_super_admin()
+        self.problem = create_problem(admin)
+        self.url = self.reverse("submission_admin_api")
+        self.submissions = []
+        for i in range(15):
+            self.submissions.append(Submission.objects.create(
+                problem=self.problem, user_id="1", username="test", language="C", code_list=["iii"],
+                server_list=[f"http://vm{i % 2}:8080"], result=JudgeStatus.JUDGING))
+        status_cache.set(self.submissions[-1].id, JudgeStatus.ALL_PASSED)
+
+    def test_list_paginates_before_fetch(self):
+        with mock.patch("submission.status.judge_client.post_many",
+                        side_effect=lambda calls, idempotent: [{"err": None, "data": {"result": JudgeStatus.ALL_FAILED}}] * len(calls)) as post_many:
+            resp = self.client.get(self.url, data={"limit": "10"})
+        self.assertSuccess(resp)
+        self.assertEqual(resp.data["data"]["total"], 15)
+        # one batch for the page, without the submission pushed by SubmissionUpdateAPI
+        post_many.assert_called_once()
+        calls = post_many.call_args[0][0]
+        page = {item["id"]: item["result"] for item in resp.data["data"]["results"]}
+        self.assertEqual(len(calls), 9 if self.submissions[-1].id in page else 10)
+        for submission_id, result in page.items():
+            expected = JudgeStatus.ALL_PASSED if submission_id == self.submissions[-1].id else JudgeStatus.ALL_FAILED
+            self.assertEqual(result, expected)
+
+    def test_fetched_status_is_cached(self):
+        with mock.patch("submission.status.judge_client.post_many",
+                        return_value=[{"err": None, "data": {"result": JudgeStatus.SOME_PASSED}}]) as post_many:
+            status_cache.apply([self.submissions[0]])
+            submission = Submission.objects.get(id=self.submissions[0].id)
+            status_cache.apply([submission])
+        post_many.assert_called_once()
+        self.assertEqual(submission.result, JudgeStatus.SOME_PASSED)
+
+
+class SubmissionWaitAPITest(APITestCase):
+    def setUp(self):
+        self.user = self.create_user("test", "test123")
+        self.problem = create_problem(self.user)
+        self.submission = Submission.objects.create(problem=self.problem, user_id=str(self.user.id), username="test",
+                                                    language="C", code_list=["iii"], result=JudgeStatus.JUDGING)
+        self.url = self.reverse("submission_wait_api")
+
+    def test_judged_submission_returns_at_once(self):
+        Submission.objects.filter(id=self.submission.id).update(result=JudgeStatus.SOME_PASSED, grade=50)
+        resp = self.client.get(self.url, data={"id": self.submission.id})
+        self.assertSuccess(resp)
+        self.assertEqual(resp.data["data"], {"id": self.submission.id, "result": JudgeStatus.SOME_PASSED, "grade": 50})
+
+    def test_published_result_is_pushed(self):
+        timer = threading.Timer(0.2, status_cache.publish, args=(self.submission.id, JudgeStatus.ALL_PASSED, 100))
+        timer.start()
+        with override_settings(SUBMISSION_WAIT_TIMEOUT=10):
+            resp = self.client.get(self.url, data={"id": self.submission.id})
+        timer.join()
+        self.assertSuccess(resp)
+        self.assertEqual(resp.data["data"], {"id": self.submission.id, "result": JudgeStatus.ALL_PASSED, "grade": 100})
+
+    @override_settings(SUBMISSION_WAIT_TIMEOUT=0.1)
+    def test_timeout(self):
+        resp = self.client.get(self.url, data={"id": self.submission.id})
+        self.assertSuccess(resp)
+        self.assertEqual(resp.data["data"]["result"], JudgeStatus.JUDGING)
+        self.assertNotIn("retry_after", resp.data["data"])
+        Submission.objects.filter(id=self.submission.id).update(result=JudgeStatus.PENDING)
+        resp = self.client.get(self.url, data={"id": self.submission.id})
+        self.assertEqual(resp.data["data"]["result"], JudgeStatus.PENDING)
+
+    @override_settings(SUBMISSION_WAIT_TIMEOUT=10, SUBMISSION_WAIT_MAX_WAITERS=1)
+    def test_max_waiters(self):
+        waiting = threading.Event()
+        with mock.patch.object(status_cache, "_channel", side_effect=lambda _: waiting.set() or "test_channel"):
+            thread = threading.Thread(target=status_cache.wait, args=(self.submission.id, 1), kwargs={"max_waiters": 1})
+            thread.start()
+            waiting.wait()
+            start = time.perf_counter()
+            resp = self.client.get(self.url, data={"id": self.submission.id})
+            elapsed = time.perf_counter() - start
+            thread.join()
+        self.assertSuccess(resp)
+        self.assertEqual(resp.data["data"]["result"], JudgeStatus.JUDGING)
+        # answered at once, not after the wait timeout, and told when the waiter leaves
+        self.assertLess(elapsed, 0.5)
+        self.assertTrue(0 < resp.data["data"]["retry_after"] <= 2)
+
+    def test_permission(self):
+        self.create_user("other", "other123")
+        resp = self.client.get(self.url, data={"id": self.submission.id})
+        self.assertFailed(resp, "No permission for this submission")
+
+
+@override_settings(STATS_FLUSH_INTERVAL=5)
+class SubmissionUpdateAPITest(APITestCase):
+    def setUp(self):
+        cache.delete_many([CacheKey.stats_pending, CacheKey.stats_flushing])
+        self.user = self.create_user("test", "test123", login=False)
+        self.problem = create_problem(self.user)
+        self.server = JudgeServer.objects.create(hostname="server", ip="127.0.0.1", service_url="http://server:8080",
+                                                 cpu_core=1, available_ports=list(range(2)), last_heartbeat=now())
+        self.submission = Submission.objects.create(problem=self.problem, user_id=str(self.user.id), username="test",
+                                                    language="C", code_list=["iii"], result=JudgeStatus.JUDGING,
+                                                    server_list=[self.server.service_url], ports_list=[[0]])
+        self.url = self.reverse("submission_update_api")
+
+    def update(self, result, info=None):
+        token = hashlib.sha256(SysOptions.judge_server_token.encode("utf-8")).hexdigest()
+        return self.client.post(self.url, data={"submission_id": self.submission.id, "result": result,
+                                                "info": info or []},
+                                format="json", HTTP_X_JUDGE_SERVER_TOKEN=token)
+
+    def test_update(self):
+        info = [{"test_case": "1", "message": "failed"}]
+        with mock.patch.object(status_cache, "publish", wraps=status_cache.publish) as publish:
+            resp = self.update(JudgeStatus.SOME_PASSED, info)
+        self.assertSuccess(resp)
+        submission = Submission.objects.get(id=self.submission.id)
+        self.assertEqual(submission.result, JudgeStatus.SOME_PASSED)
+        self.assertEqual(submission.failed_info, info)
+        publish.assert_called_once_with(self.submission.id, JudgeStatus.SOME_PASSED, submission.grade)
+        self.assertEqual(status_cache.get_many([self.submission.id]), {self.submission.id: JudgeStatus.SOME_PASSED})
+
+    def test_problem_status(self):
+        ProblemStatus.record(self.user.id, self.problem.id, JudgeStatus.ALL_FAILED, 0)
+        self.assertSuccess(self.update(JudgeStatus.JUDGING))
+        self.assertEqual(ProblemStatus.objects.get(user=self.user, problem=self.problem).status,
+                         JudgeStatus.ALL_FAILED)
+        self.assertSuccess(self.update(JudgeStatus.ALL_PASSED))
+        status = ProblemStatus.objects.get(user=self.user, problem=self.problem)
+        self.assertEqual((status.status, status.score), (JudgeStatus.ALL_PASSED, 100))
+        self.assertEqual(stats.pending("problem", [self.problem.id]), {str(self.problem.id): {"accepted_number": 1}})
+
+    def test_admin_list_reads_pushed_result(self):
+        self.assertSuccess(self.update(JudgeStatus.ALL_PASSED))
+        self.create_super_admin()
+        with mock.patch("submission.status.judge_client.post_many") as post_many:
+            resp = self.client.get(self.reverse("submission_admin_api"))
+        self.assertSuccess(resp)
+        post_many.assert_not_called()
+        self.assertEqual(resp.data["data"]["results"][0]["result"], JudgeStatus.ALL_PASSED)
+
+
+class SubmissionThrottleTest(APITestCase):
+    def setUp(self):
+        self.user = self.create_user("test", "test123")
+        throttling = SysOptions.throttling
+        throttling["endpoints"] = {"submission": {"user": {"capacity": 2, "fill_rate": 1e-6, "default_capacity": 2}}}
+        SysOptions.throttling = throttling
+        cache.delete(f"{CacheKey.throttling}:submission:user:{self.user.id}")
+
+    def test_submission_burst(self):
+        url = self.reverse("submission_api")
+        for _ in range(2):
+            self.assertFailed(self.client.post(url, data={"contest_id": 0}), "Contest not exist")
+        resp = self.client.post(url, data={"contest_id": 0})
+        self.assertFailed(resp)
+        self.assertTrue(resp.data["data"].startswith("Requests are too frequent"))
+
+
+class SubmissionCursorPaginationTest(APITestCase):
+    def setUp(self):
+        self.user = self.create_user("test", "test123")
+        self.problem = create_problem(self.user)
+        for _ in range(25):
+            Submission.objects.create(problem=self.problem, user_id=str(self.user.id), username="test",
+                                      language="C", code_list=["iii"])
+        # rows sharing a create_time are ordered by id
+        first = Submission.objects.order_by("create_time").first()
+        Submission.objects.filter(id__in=[item.id for item in Submission.objects.all()[5:15]]) \
+            .update(create_time=first.create_time)
+        self.url = self.reverse("submission_list_api")
+
+    def _counts(self, data):
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(self.url, data=data)
+        self.assertSuccess(resp)
+        return resp.data["data"], len([q for q in ctx.captured_queries if "COUNT(" in q["sql"]])
+
+    def test_pages(self):
+        expected = list(Submission.objects.order_by("-create_time", "-id").values_list("id", flat=True))
+        ids, cursor = [], ""
+        for _ in range(3):
+            resp = self.client.get(self.url, data={"limit": 10, "cursor": cursor})
+            self.assertSuccess(resp)
+            ids += [item["id"] for item in resp.data["data"]["results"]]
+            self.assertEqual(resp.data["data"]["total"], 25)
+            cursor = resp.data["data"]["next"]
+        self.assertEqual(ids, expected)
+        self.assertIsNone(cursor)
+
+    def test_invalid_cursor(self):
+        for cursor in ["abc", "W10=", "WyJhIiwgImIiXQ=="]:
+            resp = self.client.get(self.url, data={"limit": 10, "cursor": cursor})
+            self.assertFailed(resp, "Invalid cursor")
+
+    def test_estimated_count(self):
+        data, counts = self._counts({"limit": 10, "count": "estimate"})
+        self.assertEqual((data["total"], counts), (25, 1))
+        # the count is cached, deep pages do not count again
+        data, counts = self._counts({"limit": 10, "offset": 20, "count": "estimate"})
+        self.assertEqual((data["total"], len(data["results"]), counts), (25, 5, 0))
+        data, counts = self._counts({"limit": 10, "offset": 20})
+        self.assertEqual((data["total"], counts), (25, 1))
+
+
+class SubmissionQueryPlanTest(APITestCase):
+    """
+    Plans of the submission lists, every page has to be read through its index, newest first without sorting.
+    A small table is seeded by default, SUBMISSION_PLAN_ROWS=1000000 seeds a full size one
+    and checks every page against SUBMISSION_PLAN_BUDGET seconds as well
+    """
+    timed = "SUBMISSION_PLAN_ROWS" in os.environ
+    rows = int(os.environ.get("SUBMISSION_PLAN_ROWS", "1000"))
+    budget = float(os.environ.get("SUBMISSION_PLAN_BUDGET", "0.5"))
+
+    @classmethod
+    def setUpTestData(cls):
+        users = []
+        for username, admin_type in [("root", AdminType.SUPER_ADMIN), ("test", AdminType.REGULAR_USER)]:
+            user = User.objects.create(username=username, admin_type=admin_type)
+            user.set_password("test123")
+            user.save()
+            UserProfile.objects.create(user=user)
+            users.append(user)
+        cls.admin, cls.user = users
+        cls.contests = [Contest.objects.create(title=f"contest {i}", description="", contest_type="Public",
+                                               start_time=now() - timedelta(days=1), end_time=now() + timedelta(days=1),
+                                               created_by=cls.admin) for i in range(10)]
+        cls.problems = problems = [create_problem(cls.admin, _id=f"P{i}", contest=cls.contests[i % 10] if i % 2 else None)
+                                   for i in range(20)]
+        users = min(cls.rows // 50, 1000)
+        user_ids = [str(uuid.uuid4()) for _ in range(users)]
+        user_ids[0] = str(cls.user.id)
+        batch = []
+        for i in range(cls.rows):
+            problem = problems[i // 7 % 20]
+            batch.append(Submission(problem=problem, contest_id=problem.contest_id, user_id=user_ids[i % users],
+                                    username=f"user{i % users}", language="C", code_list=[], result=i % 6))
+            if len(batch) == 10000:
+                Submission.objects.bulk_create(batch)
+                batch = []
+        Submission.objects.bulk_create(batch)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def _explain(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute(f"EXPLAIN {sql}")
+                return "\n".join(row[0] for row in cursor.fetchall())
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+            return "\n".join(row[-1] for row in cursor.fetchall())
+
+    def assertIndexScan(self, url_name, data, indexes, username="test"):
+        self.client.login(username=username, password="test123")
+        with CaptureQueriesContext(connection) as ctx:
+            start = time.perf_counter()
+            resp = self.client.get(self.reverse(url_name), data=data)
+            elapsed = time.perf_counter() - start
+        self.assertSuccess(resp)
+        self.assertTrue(resp.data["data"]["results"])
+        if self.timed:
+            self.assertLess(elapsed, self.budget)
+        page = [q["sql"] for q in ctx.captured_queries
+                if 'FROM "submission"' in q["sql"] and "LIMIT" in q["sql"] and "COUNT(" not in q["sql"]]
+        self.assertEqual(len(page), 1)
+        plan = self._explain(page[0])
+        self.assertTrue(any(index in plan for index in indexes.split("|")), plan)
+        for unwanted in ["Seq Scan on submission", "SCAN submission\n", "TEMP B-TREE", "Sort"]:
+            self.assertNotIn(unwanted, plan + "\n", plan)
+        return resp.data["data"]
+
+    def test_submission_list(self):
+        # sqlite orders "contest_id IS NULL" through the composite index as well, postgresql needs the partial one
+        index = "submission_user_public_idx|submission_contest_user_idx"
+        data = self.assertIndexScan("submission_list_api", {"limit": 20, "cursor": ""}, index)
+        self.assertIndexScan("submission_list_api", {"limit": 20, "cursor": data["next"]}, index)
+        self.assertIndexScan("submission_list_api", {"limit": 10, "offset": 10}, index)
+        self.assertIndexScan("submission_list_api", {"limit": 20, "result": JudgeStatus.SOME_PASSED}, index)
+        self.assertIndexScan("submission_list_api", {"limit": 20, "problem_id": "P0"}, index)
+
+    def test_contest_submission_list(self):
+        data = {"limit": 20, "contest_id": self.contests[1].id, "myself": 1, "username": "", "problem_name": ""}
+        self.assertIndexScan("contest_submission_list_api", data, "submission_contest_user_idx")
+        data["myself"] = 0
+        self.assertIndexScan("contest_submission_list_api", data, "submission_contest_idx", username="root")
+        data["username"] = "user7"
+        self.assertIndexScan("contest_submission_list_api", data, "submission_contest_name_idx", username="root")
+
+    def test_admin_submission_list(self):
+        data = self.assertIndexScan("submission_admin_api", {"limit": 20, "cursor": ""},
+                                    "submission_create_time_idx", username="root")
+        self.assertIndexScan("submission_admin_api", {"limit": 20, "cursor": data["next"]},
+                             "submission_create_time_idx", username="root")
+        self.assertIndexScan("submission_admin_api", {"limit": 20, "contest_id": self.contests[3].id},
+                             "submission_contest_idx", username="root")
+        self.assertIndexScan("submission_admin_api", {"limit": 20, "problem_id": self.problems[4].id},
+                             "submission_problem_idx", username="root")
+
+
+class SubmissionListQueryCountTest(APITestCase):
+    def setUp(self):
+        self.admin = self.create_super_admin(login=False)
+        self.contest = Contest.objects.create(title="contest", description="", contest_type="Public",
+                                              start_time=now() - timedelta(days=1), end_time=now() + timedelta(days=1),
+                                              created_by=self.admin)
+        problems = [create_problem(self.admin, _id=f"P{i}", contest=self.contest if i % 2 else None)
+                    for i in range(10)]
+        self.user = self.create_user("test", "test123", login=False)
+        for i in range(60):
+            problem = problems[i % 10]
+            user_id, username = (str(self.user.id), "test") if i % 3 else (str(self.admin.id), "root")
+            Submission.objects.create(problem=problem, contest=problem.contest, user_id=user_id, username=username,
+                                      language="C", code_list=["iii"], shared=i % 4 == 0)
+
+    def _get(self, url_name, data):
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(self.reverse(url_name), data=data)
+        self.assertSuccess(resp)
+        return resp.data["data"]["results"], len(ctx.captured_queries)
+
+    def assertConstantQueries(self, url_name, data):
+        # the first request of a session records it
+        self._get(url_name, {**data, "limit": 1})
+        small, queries = self._get(url_name, {**data, "limit": 2})
+        results, more_queries = self._get(url_name, {**data, "limit": 20})
+        self.assertEqual((len(small), len(results)), (2, 20))
+        self.assertEqual(queries, more_queries)
+        return results
+
+    def test_submission_list(self):
+        self.client.login(username="test", password="test123")
+        results = self.assertConstantQueries("submission_list_api", {})
+        self.assertTrue(all(item["show_link"] for item in results))
+
+    def test_contest_submission_list(self):
+        data = {"contest_id": self.contest.id, "myself": 1, "username": "", "problem_name": ""}
+        self.client.login(username="test", password="test123")
+        results = self.assertConstantQueries("contest_submission_list_api", data)
+        self.assertTrue(all(item["show_link"] for item in results))
+
+        # an admin sees the submissions of the contest, but not the code of the others before it ends
+        self.create_admin()
+        results = self.assertConstantQueries("contest_submission_list_api", {**data, "myself": 0})
+        self.assertEqual({item["show_link"] for item in results}, {False})
+        self.client.login(username="root", password="root")
+        results = self.assertConstantQueries("contest_submission_list_api", {**data, "myself": 0})
+        self.assertEqual({item["show_link"] for item in results}, {True})
@@ -1,10 +1,12 @@
 from django.conf.urls import url
 
-from ..views.user import SubmissionAPI, SubmissionListAPI, ContestSubmissionListAPI, SubmissionExistsAPI, SubmissionUpdateAPI
+from ..views.user import SubmissionAPI, SubmissionListAPI, ContestSubmissionListAPI, SubmissionExistsAPI, SubmissionUpdateAPI, \
+    SubmissionWaitAPI
 
 urlpatterns = [
     url(r"^submission/update/?$", SubmissionUpdateAPI.as_view(), name="submission_update_api"),
     url(r"^submission/?$", SubmissionAPI.as_view(), name="submission_api"),
+    url(r"^submission/wait/?$", SubmissionWaitAPI.as_view(), name="submission_wait_api"),
     url(r"^submissions/?$", SubmissionListAPI.as_view(), name="submission_list_api"),
     url(r"^submission_exists/?$", SubmissionExistsAPI.as_view(), name="submission_exists"),
     url(r"^contest_submissions/?$", ContestSubmissionListAPI.as_view(), name="contest_submission_list_api"),
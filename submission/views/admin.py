@@ -1,18 +1,15 @@
-import hashlib
 from account.decorators import super_admin_required, admin_role_required, ensure_created_by, ensure_managed_by
 from judge.tasks import judge_task
 # from judge.dispatcher import JudgeDispatcher
 from utils.api import APIView
 from ..serializers import SubmissionModelSerializer
-from ..models import Submission, JudgeStatus
+from ..status import status_cache
+from ..models import Submission
 import logging
-import requests
-from urllib.parse import urljoin
 from contest.models import Contest
 from problem.models import Problem
 from conf.models import JudgeServer
 from account.models import User, UserProfile
-from options.options import SysOptions
 
 logger = logging.getLogger(__name__)
 
@@ -35,37 +32,6 @@ class SubmissionRejudgeAPI(APIView):
 
 
 class SubmissionAPI(APIView):
-
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.token = hashlib.sha256(SysOptions.judge_server_token.encode("utf-8")).hexdigest()
-
-    def _request(self, url, data=None):
-
-        kwargs = {"headers": {"X-Judge-Server-Token": self.token}}
-        if data:
-            kwargs["json"] = data
-        try:
-            return requests.post(url, **kwargs).json()
-        except Exception as e:
-            logger.exception(e)
-
-    def _update_status(self, submission):
-        service_url = submission.server_list[0]
-        data = {
-            "submission_id": submission.id,
-            "vm_index": 0
-        }
-        if submission.problem.lab_id:
-            data["lab_id"] = submission.problem.lab_id
-        else:
-            data["lab_id"] = submission.problem.id
-        resp = self._request(urljoin(service_url, "/fetch"), data=data)
-        if not resp or resp["err"]:
-            return JudgeStatus.JUDGING
-        else:
-            return resp.data["result"]
-
     @admin_role_required
     def get(self, request):
         user = request.user
@@ -78,9 +44,7 @@ class SubmissionAPI(APIView):
                 else:
                     ensure_created_by(submission.problem, user)
                 # 主动查询
-                if submission.result in [JudgeStatus.JUDGING]:
-                    result = self._update_status(submission)
-                    submission.result = result
+                status_cache.apply([submission])
                 return self.success(SubmissionModelSerializer(submission).data)
             except Submission.DoesNotExist:
                 return self.error("Submission not exist")
@@ -97,24 +61,26 @@ class SubmissionAPI(APIView):
                 contest = Contest.objects.get(id=contest_id)
             except Contest.DoesNotExist:
                 return self.error("Contest not exist")
-            submissions.filter(contest=contest)
+            submissions = submissions.filter(contest=contest)
         if problem_id:
             try:
                 problem = Problem.objects.get(id=problem_id)
             except Problem.DoesNotExist:
                 return self.error("Problem not exist")
-            submissions.filter(problem=problem)
+            submissions = submissions.filter(problem=problem)
         if find_user_id:
             try:
                 user = User.objects.get(userid=find_user_id)
             except User.DoesNotExist:
                 return self.error("User not exist")
-            submissions.filter(user_id=find_user_id)
-        # 主动查询
-        for submission in submissions:
-            if submission.result in [JudgeStatus.JUDGING]:
-                submission.result = self._update_status(submission)
-        return self.success(self.paginate_data(request, submissions, SubmissionModelSerializer))
+            submissions = submissions.filter(user_id=find_user_id)
+        data = self.paginate_data(request, submissions.select_related("problem"),
+                                  cursor_fields=Submission.cursor_fields)
+        results = list(data["results"])
+        # 主动查询, only the rows of this page
+        status_cache.apply(results)
+        data["results"] = SubmissionModelSerializer(results, many=True).data
+        return self.success(data)
 
     # 目前主要是用于分数修改
     @admin_role_required
@@ -1,24 +1,22 @@
 import ipaddress
 import hashlib
-import requests
 import logging
-import time
-from django.db import transaction
+from django.conf import settings
 from django.db.models import Q
-from django.core.cache import cache
 
 from account.decorators import login_required, check_contest_permission
-from account.models import User, UserProfile
 from conf.models import JudgeServer
 from contest.models import Contest, ContestStatus
 from options.options import SysOptions
-from problem.models import Problem
+from problem.models import Problem, ProblemStatus
+from judge.client import judge_client
 from judge.tasks import local_judge_task
 from judge.dispatcher import process_pending_task
 from judge.dispatcher import JudgeStatus
+from judge.ports import port_allocator
+from judge.stats import stats
 from utils.api import APIView, validate_serializer, CSRFExemptAPIView
-from utils.cache import cache
-from utils.throttling import TokenBucket
+from utils.throttling import throttle
 
 from ..models import Submission
 from ..serializers import (
@@ -26,6 +24,7 @@ from ..serializers import (
     ShareSubmissionSerializer,
 )
 from ..serializers import SubmissionSafeModelSerializer, SubmissionListSerializer
+from ..status import status_cache
 
 logger = logging.getLogger(__name__)
 
@@ -36,23 +35,6 @@ class SubmissionAPI(APIView):
             SysOptions.judge_server_token.encode("utf-8")
         ).hexdigest()
 
-    # redis queue buffering
-    def throttling(self, request):
-        auth_method = getattr(request, "auth_method", "")
-        if auth_method == "api_key":
-            return
-        user_bucket = TokenBucket(
-            key=str(request.user.id), redis_conn=cache, **SysOptions.throttling["user"]
-        )
-        can_consume, wait = user_bucket.consume()
-        if not can_consume:
-            return "Please wait %d seconds" % (int(wait))
-        # ip_bucket = TokenBucket(key=request.session["ip"],
-        #                         redis_conn=cache, **SysOptions.throttling["ip"])
-        # can_consume, wait = ip_bucket.consume()
-        # if not can_consume:
-        #     return "Captcha is required"
-
     @check_contest_permission(check_type="problems")
     def check_contest_permission(self, request):
         contest = self.contest
@@ -70,18 +52,8 @@ class SubmissionAPI(APIView):
 
     # @validate_serializer(CreateSubmissionSerializer)
     @login_required
+    @throttle("submission")
     def post(self, request):
-        # print(request.data)
-        user_id = request.user.id
-        last_submit_time = cache.get(f"last_submit_time_{user_id}")
-        if last_submit_time:
-            current_time = time.time()
-            time_diff = current_time - last_submit_time
-            if time_diff < 15:
-                return self.error("Submissions are too frequent, please try again later")
-
-        cache.set(f'last_submit_time_{user_id}', time.time())
-
         data = request.data
 
         # get contset and check
@@ -181,6 +153,46 @@ class SubmissionAPI(APIView):
         return self.success()
 
 
+class SubmissionWaitAPI(APIView):
+    @login_required
+    def get(self, request):
+        """
+        long poll for the result of a submission instead of polling SubmissionAPI while it is judging,
+        answers once the judge publishes a result, or with the current result after the timeout,
+        or at once when SUBMISSION_WAIT_MAX_WAITERS clients are waiting already,
+        then retry_after tells the client when to ask again
+        """
+        submission_id = request.GET.get("id")
+        if not submission_id:
+            return self.error("Parameter id doesn't exist")
+
+        def state():
+            try:
+                submission = Submission.objects.select_related("problem").get(id=submission_id)
+            except Submission.DoesNotExist:
+                return {"error": "Submission doesn't exist"}
+            if not submission.check_user_permission(request.user):
+                return {"error": "No permission for this submission"}
+            return {"id": submission.id, "result": submission.result, "grade": submission.grade}
+
+        def current():
+            event = state()
+            if "error" in event or event["result"] not in (JudgeStatus.PENDING, JudgeStatus.JUDGING):
+                return event
+
+        event = status_cache.wait(submission_id, settings.SUBMISSION_WAIT_TIMEOUT, current,
+                                  max_waiters=settings.SUBMISSION_WAIT_MAX_WAITERS)
+        if event is False:
+            event = state()
+            if "error" not in event:
+                event["retry_after"] = status_cache.retry_after(settings.SUBMISSION_WAIT_TIMEOUT)
+        elif event is None:
+            event = state()
+        if "error" in event:
+            return self.error(event["error"])
+        return self.success(event)
+
+
 class SubmissionListAPI(APIView):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -193,7 +205,8 @@ class SubmissionListAPI(APIView):
         if not request.GET.get("limit"):
             return self.error("Limit is needed")
 
-        submissions = Submission.objects.filter(contest_id__isnull=True).filter(
+        # the serializer reads the problem of every row
+        submissions = Submission.objects.select_related("problem").filter(contest_id__isnull=True).filter(
             user_id=request.user.id
         )
 
@@ -209,7 +222,7 @@ class SubmissionListAPI(APIView):
             submissions = submissions.filter(problem=problem)
         if result:
             submissions = submissions.filter(result=result)
-        data = self.paginate_data(request, submissions)
+        data = self.paginate_data(request, submissions, cursor_fields=Submission.cursor_fields)
         data["results"] = SubmissionListSerializer(
             data["results"], many=True, user=request.user
         ).data
@@ -217,20 +230,8 @@ class SubmissionListAPI(APIView):
 
 
 class ContestSubmissionListAPI(APIView):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.token = hashlib.sha256(
-            SysOptions.judge_server_token.encode("utf-8")
-        ).hexdigest()
-
     def _request(self, url, data=None):
-        kwargs = {"headers": {"X-Judge-Server-Token": self.token}}
-        if data:
-            kwargs["json"] = data
-        try:
-            return requests.post(url, **kwargs).json()
-        except Exception as e:
-            logger.exception(e)
+        return judge_client.post(url, data, idempotent=True)
 
     @check_contest_permission(check_type="submissions")
     def get(self, request):
@@ -241,13 +242,11 @@ class ContestSubmissionListAPI(APIView):
 
         # first filter by contest
         contest_id = request.GET.get("contest_id")
-        submissions = Submission.objects.filter(contest_id=contest_id)
+        # the serializer reads the problem and the contest of every row
+        submissions = Submission.objects.select_related("problem", "contest").filter(contest_id=contest_id)
 
         # filter by the request user id
-        users = User.objects.filter(id=request.user.id)
-        if len(users) == 0:
-            self.error(f"no such user id: {request.user.id}")
-        user = users[0]
+        user = request.user
 
         if not (user.is_admin_role() and int(request.GET.get('myself')) == 0):
             submissions = submissions.filter(user_id=request.user.id)
@@ -261,7 +260,7 @@ class ContestSubmissionListAPI(APIView):
             problems = Problem.objects.filter(Q(_id__icontains=problem_name))
             submissions = submissions.filter(Q(problem__in=problems))
         
-        data = self.paginate_data(request, submissions)
+        data = self.paginate_data(request, submissions, cursor_fields=Submission.cursor_fields)
         data["results"] = SubmissionListSerializer(
             data["results"], many=True, user=request.user
         ).data
@@ -285,92 +284,23 @@ class SubmissionExistsAPI(APIView):
 class SubmissionUpdateAPI(CSRFExemptAPIView):
     @staticmethod
     def resource_fetch(submission: Submission) -> bool:
-        vm_index = 0
-        ports_list = submission.ports_list
-
-        with transaction.atomic():
-            for server_url in submission.server_list:
-                try:
-                    server = JudgeServer.objects.get(service_url=server_url)
-                    server.available_ports = (
-                        server.available_ports + ports_list[vm_index]
-                    )
-                    server.using_ports = list(
-                        set(server.using_ports) - set(ports_list[vm_index])
-                    )
-                    server.available_ports_num = server.available_ports_num + len(
-                        ports_list[vm_index]
-                    )
-                    server.save(
-                        update_fields=[
-                            "available_ports",
-                            "using_ports",
-                            "available_ports_num",
-                        ]
-                    )
-                except JudgeServer.DoesNotExist:
-                    return False
-                vm_index += 1
+        if not port_allocator.release_submission(submission.server_list, submission.ports_list):
+            return False
         # 资源释放处理队列中的任务防止等待
         process_pending_task()
         return True
 
     def update_problem_status(self, submission: Submission):
-        problem = submission.problem
-        problem_id = str(problem.id)
-        with transaction.atomic():
-            # update problem status
-            if (
-                self.last_result != JudgeStatus.FINISHED
-                and submission.result == JudgeStatus.FINISHED
-            ):
-                problem.accepted_number += 1
-            problem.save(update_fields=["accepted_number"])
-            user = User.objects.select_for_update().get(id=submission.user_id)
-            user_profile = UserProfile.objects.get(user_id=user.id)
-            problem_status = user_profile.problems_status.get("problems", {})
-            if problem_id not in problem_status:
-                problem_status[problem_id] = {
-                    "status": submission.result,
-                    "_id": problem.id,
-                }
-                if submission.result == JudgeStatus.FINISHED:
-                    user_profile.accepted_number += 1
-            elif problem_status[problem_id] != JudgeStatus.FINISHED:
-                problem_status[problem_id]["status"] = submission.result
-                if submission.result == JudgeStatus.FINISHED:
-                    user_profile.accepted_number += 1
-            user_profile.problems_status["problems"] = problem_status
-            user_profile.save(update_fields=["accepted_number", "problems_status"])
-
-    def update_contest_problem_status(self, submission: Submission):
-        problem = submission.problem
-        problem_id = str(problem.id)
-        with transaction.atomic():
-            # update contest problem status
-            if (
-                self.last_result != JudgeStatus.FINISHED
-                and submission.result == JudgeStatus.FINISHED
-            ):
-                problem.accepted_number += 1
-            problem.save(update_fields=["accepted_number"])
-            user = User.objects.select_for_update().get(id=submission.user_id)
-            user_profile = UserProfile.objects.get(user_id=user.id)
-            contest_problems_status = user_profile.problems_status.get(
-                "contest_problems", {}
-            )
-            if problem_id not in contest_problems_status:
-                contest_problems_status[problem_id] = {
-                    "status": submission.result,
-                    "_id": problem._id,
-                }
-            elif contest_problems_status[problem_id]["status"] != JudgeStatus.ACCEPTED:
-                contest_problems_status[problem_id]["status"] = submission.result
-            else:
-                # 已AC不计入
-                return
-            user_profile.problems_status["contest_problems"] = contest_problems_status
-            user_profile.save(update_fields=["problems_status"])
+        if submission.result in (JudgeStatus.PENDING, JudgeStatus.JUDGING):
+            return
+        # the judge servers report no grade, a passed submission has the full score
+        score = 100 if submission.result == JudgeStatus.ALL_PASSED else submission.grade
+        previous = ProblemStatus.record(submission.user_id, submission.problem_id, submission.result, score)
+        if submission.result == JudgeStatus.ALL_PASSED and self.last_result != JudgeStatus.ALL_PASSED:
+            stats.incr("problem", submission.problem_id, accepted_number=1)
+            # contest problems are not counted in the profile
+            if not submission.contest_id and (previous is None or previous.status != JudgeStatus.ALL_PASSED):
+                stats.incr("profile", submission.user_id, accepted_number=1)
 
     def post(self, request):
         data = request.data
@@ -403,10 +333,7 @@ class SubmissionUpdateAPI(CSRFExemptAPIView):
                 return self.error("resource Fetch error")
         submission.result = result
         submission.failed_info = data["info"]
-        print("save result: ", result)
-        submission.save(update_fields=["result", "info"])
-        if submission.contest:
-            self.update_contest_problem_status(submission)
-        else:
-            self.update_problem_status(submission)
+        submission.save(update_fields=["result", "failed_info"])
+        status_cache.publish(submission.id, result, submission.grade)
+        self.update_problem_status(submission)
         return self.success(SubmissionModelSerializer(submission).data)
@@ -1,12 +1,27 @@
+import base64
+import binascii
 import functools
+import hashlib
 import json
 import logging
 
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.db.models import Q
 from django.http import HttpResponse, QueryDict
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from utils.cache import cache
+from utils.constants import CacheKey
+
 logger = logging.getLogger("")
 
 
@@ -40,23 +55,103 @@ class URLEncodedParser(object):
         return QueryDict(body)
 
 
+class JSONEncoder(object):
+    """
+    json of the standard library, datetimes, UUIDs and Decimals are encoded the way DjangoJSONEncoder does
+    """
+    @staticmethod
+    def dumps(data, pretty=False):
+        if pretty:
+            return json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False, indent=4)
+        return json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False, separators=(",", ":"))
+
+
+class ORJSONEncoder(object):
+    """
+    orjson encodes datetimes and UUIDs natively, other types fall back to DjangoJSONEncoder,
+    non str keys are turned into strings as json does.
+    Integers out of the 64 bit range (UsernameSerializer turns UUIDs into integers) are left to JSONEncoder
+    """
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z if orjson else 0
+    _default = DjangoJSONEncoder().default
+
+    @classmethod
+    def dumps(cls, data, pretty=False):
+        option = cls.option | orjson.OPT_INDENT_2 if pretty else cls.option
+        try:
+            return orjson.dumps(data, default=cls._default, option=option)
+        except orjson.JSONEncodeError as e:
+            if "64-bit" not in str(e):
+                raise
+            return JSONEncoder.dumps(data, pretty)
+
+
 class JSONResponse(object):
     content_type = ContentType.json_response
+    # compact output of orjson if it is installed
+    encoder = ORJSONEncoder if orjson else JSONEncoder
 
     @classmethod
-    def response(cls, data):
-        resp = HttpResponse(json.dumps(data, indent=4), content_type=cls.content_type)
+    def response(cls, data, pretty=False):
+        resp = HttpResponse(cls.encoder.dumps(data, pretty), content_type=cls.content_type)
         resp.data = data
         return resp
 
 
+def encode_cursor(obj, cursor_fields):
+    values = [obj._meta.get_field(field.lstrip("-")).value_to_string(obj) for field in cursor_fields]
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
+
+
+def cursor_filter(model, cursor, cursor_fields):
+    """
+    rows after the cursor in the order of cursor_fields, (a, b) descending is a < x or (a = x and b < y)
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        if not isinstance(values, list) or len(values) != len(cursor_fields):
+            raise ValueError
+        fields = [field.lstrip("-") for field in cursor_fields]
+        values = [model._meta.get_field(name).to_python(value) for name, value in zip(fields, values)]
+    except (ValueError, TypeError, binascii.Error, FieldDoesNotExist, ValidationError):
+        raise APIError("Invalid cursor")
+    condition = Q()
+    for i, field in enumerate(cursor_fields):
+        lookup = "lt" if field.startswith("-") else "gt"
+        condition |= Q(**{f"{fields[i]}__{lookup}": values[i]}, **dict(zip(fields[:i], values[:i])))
+    return condition
+
+
+def estimated_count(query_set, exact_below=10000, timeout=60):
+    """
+    the row estimate of the planner on postgresql, counted exactly when it is small,
+    other databases count once and cache the count for timeout seconds
+    """
+    query_set = query_set.order_by()
+    if connection.vendor == "postgresql":
+        sql, params = query_set.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+            rows = cursor.fetchone()[0][0]["Plan"]["Plan Rows"]
+        if rows >= exact_below:
+            return rows
+        return query_set.count()
+    key = f"{CacheKey.paginate_count}:{hashlib.sha1(str(query_set.query).encode('utf-8')).hexdigest()}"
+    count = cache.get(key)
+    if count is None:
+        count = query_set.count()
+        cache.set(key, count, timeout)
+    return count
+
+
 class APIView(View):
     """
     Django view的父类, 和django-rest-framework的用法基本一致
      - request.data获取解析之后的json或者urlencoded数据, dict类型
      - self.success, self.error和self.invalid_serializer可以根据业需求修改,
         写到父类中是为了不同的人开发写法统一,不再使用自己的success/error格式
-     - self.response 返回一个django HttpResponse, 具体在self.response_class中实现
+     - self.response 返回一个django HttpResponse, 具体在self.response_class中实现,
+        输出是紧凑的json, 请求带上?debug=1时缩进输出
      - parse请求的类需要定义在request_parser中, 目前只支持json和urlencoded的类型, 用来解析请求的数据
     """
     request_parsers = (JSONParser, URLEncodedParser)
@@ -80,7 +175,7 @@ class APIView(View):
         return request.GET
 
     def response(self, data):
-        return self.response_class.response(data)
+        return self.response_class.response(data, pretty=bool(self.request.GET.get("debug")))
 
     def success(self, data=None):
         return self.response({"error": None, "data": data})
@@ -110,11 +205,14 @@ class APIView(View):
     def server_error(self):
         return self.error(err="server-error", msg="server error")
 
-    def paginate_data(self, request, query_set, object_serializer=None):
+    def paginate_data(self, request, query_set, object_serializer=None, cursor_fields=None):
         """
         :param request: django的request
         :param query_set: django model的query set或者其他list like objects
         :param object_serializer: 用来序列化query set, 如果为None, 则直接对query set切片
+        :param cursor_fields: 支持cursor分页的query set的排序字段, 例如("-create_time", "-id"),
+            请求带上cursor参数(第一页为空)时按这些字段翻页, 返回下一页的next, total为估计值
+            请求带上count=estimate时offset分页的total也是估计值
         :return:
         """
         try:
@@ -123,6 +221,8 @@ class APIView(View):
             limit = 10
         if limit < 0 or limit > 250:
             limit = 10
+        if cursor_fields and "cursor" in request.GET:
+            return self._paginate_by_cursor(request, query_set, object_serializer, cursor_fields, limit)
         try:
             offset = int(request.GET.get("offset", "0"))
         except ValueError:
@@ -130,15 +230,33 @@ class APIView(View):
         if offset < 0:
             offset = 0
         results = query_set[offset:offset + limit]
-        if object_serializer:
-            count = query_set.count()
-            results = object_serializer(results, many=True).data
+        if request.GET.get("count") == "estimate" and hasattr(query_set, "query"):
+            count = estimated_count(query_set)
         else:
             count = query_set.count()
+        if object_serializer:
+            results = object_serializer(results, many=True).data
         data = {"results": results,
                 "total": count}
         return data
 
+    def _paginate_by_cursor(self, request, query_set, object_serializer, cursor_fields, limit):
+        page = query_set.order_by(*cursor_fields)
+        cursor = request.GET.get("cursor")
+        if cursor:
+            page = page.filter(cursor_filter(query_set.model, cursor, cursor_fields))
+        # one more row tells whether there is a next page
+        results = list(page[:limit + 1])
+        next_cursor = None
+        if len(results) > limit:
+            results = results[:limit]
+            next_cursor = encode_cursor(results[-1], cursor_fields)
+        if object_serializer:
+            results = object_serializer(results, many=True).data
+        return {"results": results,
+                "total": estimated_count(query_set),
+                "next": next_cursor}
+
     def dispatch(self, request, *args, **kwargs):
         if not (request.content_type and request.content_type.startswith(ContentType.form_data_request)):
             if self.request_parsers:
@@ -3,6 +3,16 @@ from django.test.testcases import TestCase
 from rest_framework.test import APIClient
 
 from account.models import AdminType, ProblemPermission, User, UserProfile
+from problem.models import Problem
+
+
+def create_problem(created_by, _id="A-1", **kwargs):
+    """
+    a minimal problem for the tests not about the problem itself, kwargs override the fields
+    """
+    data = {"title": "test", "description": "test", "timeout": 30, "code_num": 1, "code_names": ["solution.py"]}
+    data.update(kwargs)
+    return Problem.objects.create(_id=_id, created_by=created_by, **data)
 
 
 class APITestCase(TestCase):
@@ -23,8 +23,26 @@ class ContestRuleType(Choices):
 
 class CacheKey:
     waiting_queue = "waiting_queue"
+    waiting_queue_lock = "waiting_queue_lock"
+    waiting_queue_drain_requested = "waiting_queue_drain_requested"
+    judge_ports = "judge_ports"
+    submission_status = "submission_status"
+    submission_events = "submission_events"
+    submission_waiters = "submission_waiters"
     contest_rank_cache = "contest_rank_cache"
+    problem_payload = "problem_payload"
+    problem_payload_version = "problem_payload_version"
     website_config = "website_config"
+    open_api_appkey = "open_api_appkey"
+    open_api_legacy_appkeys = "open_api_legacy_appkeys"
+    options_version = "options_version"
+    options_changed = "options_changed"
+    paginate_count = "paginate_count"
+    throttling = "throttling"
+    throttling_rejected = "throttling_rejected"
+    stats_pending = "stats_pending"
+    stats_flushing = "stats_flushing"
+    stats_flush_lock = "stats_flush_lock"
 
 
 class Difficulty(Choices):
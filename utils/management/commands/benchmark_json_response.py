@@ -0,0 +1,87 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from account.models import User
+from problem.models import Problem
+from problem.serializers import ProblemSerializer
+from submission.models import JudgeStatus, Submission
+from submission.serializers import SubmissionListSerializer
+from utils.api.api import JSONEncoder, ORJSONEncoder, orjson
+from utils.shortcuts import rand_str
+
+
+class IndentEncoder(object):
+    """
+    the encoder of JSONResponse before
+    """
+    @staticmethod
+    def dumps(data, pretty=False):
+        return json.dumps(data, indent=4)
+
+
+class Command(BaseCommand):
+    help = "measure bytes and encode time of the api response encoders over serializer outputs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--submissions", type=int, default=250, help="submissions of a page")
+        parser.add_argument("--problems", type=int, default=50, help="problems of a contest")
+        parser.add_argument("--repeat", type=int, default=50)
+
+    def _payloads(self, options):
+        user = User.objects.create(username=f"benchmark_{rand_str(8)}")
+        Problem.objects.bulk_create([
+            Problem(_id=f"benchmark_{rand_str(8)}", title=f"题目 {i}", description="<p>描述</p>" * 20,
+                    languages=["C", "C++", "Python3"], template={"main.py": "print()"}, timeout=30,
+                    code_num=1, code_names=["main.py"], port_num=[], created_by=user,
+                    statistic_info={JudgeStatus.ALL_PASSED: 10, JudgeStatus.ALL_FAILED: 5})
+            for i in range(options["problems"])])
+        problems = list(Problem.objects.filter(created_by=user))
+        Submission.objects.bulk_create([
+            Submission(problem=problems[i % len(problems)], user_id=str(user.id), username=user.username,
+                       language="Python3", code_list=[""], result=JudgeStatus.ALL_PASSED, grade=100,
+                       failed_info=[{"test_case": "1", "message": "失败"}])
+            for i in range(options["submissions"])])
+        submissions = Submission.objects.select_related("problem").filter(user_id=str(user.id))
+        problem_rows = Problem.objects.filter(created_by=user).select_related("created_by") \
+            .prefetch_related("tags")
+        return [
+            ("submission page", {"error": None, "data": {
+                "results": SubmissionListSerializer(submissions, many=True, user=user).data,
+                "total": len(submissions)}}),
+            ("contest problems", {"error": None, "data": ProblemSerializer(problem_rows, many=True).data}),
+            # rows of values(), datetimes and UUIDs are left to the encoder
+            ("submission rows", {"error": None, "data": list(submissions.values(
+                "id", "create_time", "username", "result", "grade", "problem___id", "problem__created_by_id"))}),
+        ]
+
+    def _run(self, encoder, data, repeat, pretty):
+        body = encoder.dumps(data, pretty)
+        # HttpResponse sends str as utf-8
+        size = len(body.encode("utf-8") if isinstance(body, str) else body)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            encoder.dumps(data, pretty)
+        return size, (time.perf_counter() - start) / repeat * 1000
+
+    def handle(self, *args, **options):
+        encoders = [("indent=4", IndentEncoder, False), ("json", JSONEncoder, False),
+                    ("json debug", JSONEncoder, True)]
+        if orjson:
+            encoders += [("orjson", ORJSONEncoder, False), ("orjson debug", ORJSONEncoder, True)]
+        else:
+            self.stdout.write("orjson is not installed")
+        with transaction.atomic():
+            payloads = self._payloads(options)
+            self.stdout.write(f"{'payload':>17} {'encoder':>13} {'bytes':>9} {'ms':>8}")
+            for name, data in payloads:
+                for encoder_name, encoder, pretty in encoders:
+                    try:
+                        size, ms = self._run(encoder, data, options["repeat"], pretty)
+                    except TypeError:
+                        self.stdout.write(f"{name:>17} {encoder_name:>13} {'not serializable':>18}")
+                        continue
+                    self.stdout.write(f"{name:>17} {encoder_name:>13} {size:>9} {ms:>8.3f}")
+            transaction.set_rollback(True)
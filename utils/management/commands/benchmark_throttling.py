@@ -0,0 +1,43 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from utils.cache import cache
+from utils.shortcuts import rand_str
+from utils.throttling import TokenBucket, consume_many
+
+
+class Command(BaseCommand):
+    help = "measure consumes per second of the redis token bucket"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=5000)
+        parser.add_argument("--threads", type=int, nargs="+", default=[1, 8])
+
+    def _buckets(self, prefix):
+        return [TokenBucket(key=f"{prefix}:{name}", capacity=10 ** 9, fill_rate=1, default_capacity=10 ** 9,
+                            redis_conn=cache) for name in ("user", "ip")]
+
+    def _run(self, threads, count, consume):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(lambda _: consume(), range(count)))
+        return count / (time.perf_counter() - start)
+
+    def handle(self, *args, **options):
+        prefix = f"benchmark_throttling_{rand_str(8)}"
+        user, ip = self._buckets(prefix)
+        cases = [
+            ("consume", lambda: user.consume()),
+            ("user+ip, 2 calls", lambda: user.consume()[0] and ip.consume()),
+            ("consume_many", lambda: consume_many([user, ip])),
+        ]
+        try:
+            self.stdout.write(f"{'case':>18} {'threads':>8} {'checks/s':>10}")
+            for threads in options["threads"]:
+                for name, consume in cases:
+                    rate = self._run(threads, options["count"], consume)
+                    self.stdout.write(f"{name:>18} {threads:>8} {rate:>10.0f}")
+        finally:
+            cache.delete_many([user._key, ip._key])
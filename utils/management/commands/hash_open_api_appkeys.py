@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from account.appkey import appkey_cache
+from account.models import User, hash_appkey
+
+
+class Command(BaseCommand):
+    help = "fill User.open_api_appkey_hash of the appkeys created before it and turn off the lookup of " \
+           "the plaintext appkeys, can be run again safely"
+
+    def handle(self, *args, **options):
+        users = User.objects.filter(open_api_appkey__isnull=False, open_api_appkey_hash__isnull=True) \
+            .only("id", "open_api_appkey")
+        count = 0
+        for user in users.iterator():
+            User.objects.filter(id=user.id).update(open_api_appkey_hash=hash_appkey(user.open_api_appkey))
+            count += 1
+        # every appkey has its hash now, AppkeyCache stops looking up the plaintext column
+        appkey_cache.legacy_appkeys_hashed()
+        self.stdout.write(self.style.SUCCESS(f"hashed {count} appkeys"))
@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand
+
+from account.models import UserProfile
+from problem.models import Problem, ProblemStatus
+from submission.models import JudgeStatus, Submission
+
+
+def status_of(score):
+    if score == 100:
+        return JudgeStatus.ALL_PASSED
+    return JudgeStatus.SOME_PASSED if score else JudgeStatus.ALL_FAILED
+
+
+def blob_entries(profile):
+    """
+    :return: {problem id: (status, score)} of a problems_status blob, in either of its layouts
+     - {"problems": {id: {"status", "_id"}}, "contest_problems": {...}} written by the judge server updates
+     - {display id: score} written by the local judge, mapped to the problems the user submitted to
+    """
+    entries = {}
+    display_ids = {}
+    for key, value in profile.problems_status.items():
+        if key in ("problems", "contest_problems"):
+            for problem_id, item in value.items():
+                status = item.get("status")
+                if status is not None:
+                    entries[int(problem_id)] = (status, 100 if status == JudgeStatus.ALL_PASSED else 0)
+        elif isinstance(value, int):
+            display_ids[key] = value
+    if display_ids:
+        submitted = Submission.objects.filter(user_id=str(profile.user_id), problem___id__in=list(display_ids)) \
+            .values_list("problem_id", "problem___id").distinct()
+        for problem_id, display_id in submitted:
+            score = display_ids[display_id]
+            if problem_id not in entries or score > entries[problem_id][1]:
+                entries[problem_id] = (status_of(score), score)
+    return entries
+
+
+class Command(BaseCommand):
+    help = "move UserProfile.problems_status into the problem_status table, can be run again safely"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clear", action="store_true", help="empty the migrated blobs")
+
+    def handle(self, *args, **options):
+        users = rows = 0
+        profiles = UserProfile.objects.only("id", "user_id", "problems_status").order_by("id")
+        for profile in profiles.iterator():
+            if not profile.problems_status:
+                continue
+            entries = blob_entries(profile)
+            # problems deleted since are skipped
+            problem_ids = set(Problem.objects.filter(id__in=list(entries)).values_list("id", flat=True))
+            existing = {item.problem_id: item for item in ProblemStatus.objects.filter(user_id=profile.user_id)}
+            created = []
+            for problem_id, (status, score) in entries.items():
+                if problem_id not in problem_ids:
+                    continue
+                if problem_id not in existing:
+                    created.append(ProblemStatus(user_id=profile.user_id, problem_id=problem_id,
+                                                 status=status, score=score))
+                elif score > existing[problem_id].score:
+                    ProblemStatus.objects.filter(id=existing[problem_id].id).update(status=status, score=score)
+                    rows += 1
+            ProblemStatus.objects.bulk_create(created, ignore_conflicts=True)
+            rows += len(created)
+            users += 1
+            if options["clear"]:
+                UserProfile.objects.filter(id=profile.id).update(problems_status={})
+        self.stdout.write(self.style.SUCCESS(f"migrated {rows} problem status of {users} users"))
@@ -0,0 +1,112 @@
+import datetime
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from options.options import OptionDefaultValue, SysOptions
+
+from .api import JSONResponse
+from .api.api import JSONEncoder, ORJSONEncoder, orjson
+from .api.tests import APITestCase
+from .cache import cache
+from .constants import CacheKey
+from .throttling import TokenBucket, consume_many, rejected_counts, throttle_policy
+
+
+class TokenBucketTest(SimpleTestCase):
+    def setUp(self):
+        self.keys = ["test_bucket_user", "test_bucket_ip"]
+        cache.delete_many(self.keys)
+
+    def tearDown(self):
+        cache.delete_many(self.keys)
+
+    def bucket(self, key, capacity=3, fill_rate=0.5, default_capacity=3):
+        return TokenBucket(key=key, capacity=capacity, fill_rate=fill_rate, default_capacity=default_capacity,
+                           redis_conn=cache)
+
+    @mock.patch("utils.throttling.time.time", return_value=1000.0)
+    def test_consume_and_fill(self, now):
+        bucket = self.bucket(self.keys[0])
+        for _ in range(3):
+            self.assertEqual(bucket.consume(), (True, 0))
+        self.assertEqual(bucket.consume(), (False, 2.0))
+        now.return_value = 1003.0
+        self.assertEqual(bucket.consume(), (True, 0))
+        self.assertEqual(bucket.consume(), (False, 1.0))
+        # idle buckets expire once they are full again
+        self.assertTrue(0 < cache.ttl(self.keys[0]) <= 7)
+
+    @mock.patch("utils.throttling.time.time", return_value=1000.0)
+    def test_consume_many_all_or_nothing(self, now):
+        user, ip = self.bucket(self.keys[0]), self.bucket(self.keys[1], default_capacity=1)
+        self.assertEqual(consume_many([user, ip]), (True, 0))
+        self.assertEqual(consume_many([user, ip]), (False, 2.0))
+        # the user bucket kept its tokens
+        self.assertEqual(consume_many([user], num=2), (True, 0))
+        self.assertEqual(consume_many([]), (True, 0))
+
+    def test_concurrent_consume(self):
+        bucket = self.bucket(self.keys[0], capacity=50, fill_rate=1e-6, default_capacity=50)
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            results = list(pool.map(lambda _: bucket.consume()[0], range(200)))
+        self.assertEqual(results.count(True), 50)
+
+
+class ThrottlePolicyTest(TestCase):
+    def test_default_policy(self):
+        self.assertEqual(throttle_policy("other"), {"user": SysOptions.throttling["user"],
+                                                    "ip": SysOptions.throttling["ip"]})
+
+    def test_option_without_endpoints(self):
+        # stored before the endpoints policies
+        throttling = SysOptions.throttling
+        throttling.pop("endpoints", None)
+        SysOptions.throttling = throttling
+        self.assertEqual(throttle_policy("submission"), OptionDefaultValue.throttling["endpoints"]["submission"])
+
+    def test_rejected_counts(self):
+        cache.delete(CacheKey.throttling_rejected)
+        bucket = TokenBucket(key="test_bucket_user", capacity=1, fill_rate=1e-6, default_capacity=0, redis_conn=cache)
+        for _ in range(2):
+            consume_many([bucket], rejected_key=CacheKey.throttling_rejected, rejected_field="test")
+        self.assertEqual(rejected_counts(), {"test": 2})
+        cache.delete_many([CacheKey.throttling_rejected, "test_bucket_user"])
+
+
+class JSONResponseTest(APITestCase):
+    data = {"error": None, "data": {
+        "time": datetime.datetime(2021, 1, 1, 8, 0, tzinfo=timezone.utc),
+        "id": uuid.UUID("0b6cd9d1-0664-41fa-be2c-6fc4e5d1134a"),
+        "user_id": uuid.UUID("0b6cd9d1-0664-41fa-be2c-6fc4e5d1134a").int,
+        "status": {1: "题目"}}}
+    decoded = {"error": None, "data": {
+        "time": "2021-01-01T08:00:00Z",
+        "id": "0b6cd9d1-0664-41fa-be2c-6fc4e5d1134a",
+        "user_id": uuid.UUID("0b6cd9d1-0664-41fa-be2c-6fc4e5d1134a").int,
+        "status": {"1": "题目"}}}
+
+    def test_encoders(self):
+        encoders = [JSONEncoder, ORJSONEncoder] if orjson else [JSONEncoder]
+        for encoder in encoders:
+            compact = encoder.dumps(self.data)
+            self.assertEqual(json.loads(compact), self.decoded)
+            self.assertNotIn(b"\n", compact.encode("utf-8") if isinstance(compact, str) else compact)
+            self.assertEqual(json.loads(encoder.dumps(self.data, pretty=True)), self.decoded)
+
+    def test_response(self):
+        resp = JSONResponse.response(self.data)
+        self.assertIs(resp.data, self.data)
+        self.assertEqual(json.loads(resp.content), self.decoded)
+
+    def test_debug_flag(self):
+        url = self.reverse("website_info_api")
+        compact = self.client.get(url).content
+        pretty = self.client.get(url, {"debug": "1"}).content
+        self.assertNotIn(b"\n", compact)
+        self.assertIn(b"\n", pretty)
+        self.assertEqual(json.loads(compact), json.loads(pretty))
@@ -1,9 +1,58 @@
+import functools
+import math
 import time
 
+from options.options import OptionDefaultValue, SysOptions
+from utils.cache import cache
+from utils.constants import CacheKey
+
+# KEYS: buckets, then the hash of rejection counters if ARGV[3] is not empty
+# ARGV: now, num, counter field, then capacity, fill_rate and default_capacity of every bucket
+# all or nothing, returns {1, "0"} or {0, seconds to wait}, floats are returned as strings
+CONSUME_SCRIPT = """
+local now, num, field = tonumber(ARGV[1]), tonumber(ARGV[2]), ARGV[3]
+local count = #KEYS
+if field ~= '' then
+    count = count - 1
+end
+local tokens = {}
+local wait = 0
+for i = 1, count do
+    local capacity = tonumber(ARGV[3 * i + 1])
+    local fill_rate = tonumber(ARGV[3 * i + 2])
+    local state = redis.call('HMGET', KEYS[i], 'tokens', 'timestamp')
+    local last_tokens = tonumber(state[1]) or tonumber(ARGV[3 * i + 3])
+    local last_timestamp = tonumber(state[2]) or now
+    tokens[i] = math.min(capacity, last_tokens + math.max(0, now - last_timestamp) * fill_rate)
+    if tokens[i] < num then
+        wait = math.max(wait, (num - tokens[i]) / fill_rate)
+    end
+end
+if wait > 0 then
+    if field ~= '' then
+        redis.call('HINCRBY', KEYS[#KEYS], field, 1)
+    end
+    return {0, tostring(wait)}
+end
+for i = 1, count do
+    redis.call('HSET', KEYS[i], 'tokens', tostring(tokens[i] - num), 'timestamp', tostring(now))
+    -- an idle bucket is full again after capacity / fill_rate seconds, it starts over from default_capacity
+    local fill_rate = tonumber(ARGV[3 * i + 2])
+    if fill_rate > 0 then
+        redis.call('EXPIRE', KEYS[i], math.ceil(tonumber(ARGV[3 * i + 1]) / fill_rate) + 1)
+    end
+end
+return {1, "0"}
+"""
+
+# registered script of every redis connection
+_scripts = {}
+
 
 class TokenBucket:
     """
-    注意：对于单个key的操作不是线程安全的
+    The bucket is kept in a redis hash, a consume is one lua script, atomic across threads and processes.
+    Idle buckets expire once they are full again.
     """
     def __init__(self, key, capacity, fill_rate, default_capacity, redis_conn):
         """
@@ -18,38 +67,8 @@ class TokenBucket:
         self._default_capacity = default_capacity
         self._redis_conn = redis_conn
 
-        self._last_capacity_key = "last_capacity"
-        self._last_timestamp_key = "last_timestamp"
-
-    def _init_key(self):
-        self._last_capacity = self._default_capacity
-        now = time.time()
-        self._last_timestamp = now
-        return self._default_capacity, now
-
-    @property
-    def _last_capacity(self):
-        last_capacity = self._redis_conn.hget(self._key, self._last_capacity_key)
-        if last_capacity is None:
-            return self._init_key()[0]
-        else:
-            return float(last_capacity)
-
-    @_last_capacity.setter
-    def _last_capacity(self, value):
-        self._redis_conn.hset(self._key, self._last_capacity_key, value)
-
-    @property
-    def _last_timestamp(self):
-        return float(self._redis_conn.hget(self._key, self._last_timestamp_key))
-
-    @_last_timestamp.setter
-    def _last_timestamp(self, value):
-        self._redis_conn.hset(self._key, self._last_timestamp_key, value)
-
-    def _try_to_fill(self, now):
-        delta = self._fill_rate * (now - self._last_timestamp)
-        return min(self._last_capacity + delta, self._capacity)
+    def _args(self):
+        return [self._capacity, self._fill_rate, self._default_capacity]
 
     def consume(self, num=1):
         """
@@ -57,16 +76,85 @@ class TokenBucket:
         :param num:
         :return: result: bool, wait_time: float
         """
-        # print("capacity ", self.fill(time.time()))
-        if self._last_capacity >= num:
-            self._last_capacity -= num
-            return True, 0
-        else:
-            now = time.time()
-            cur_num = self._try_to_fill(now)
-            if cur_num >= num:
-                self._last_capacity = cur_num - num
-                self._last_timestamp = now
-                return True, 0
-            else:
-                return False, (num - cur_num) / self._fill_rate
+        return consume_many([self], num)
+
+
+def consume_many(buckets, num=1, rejected_key=None, rejected_field=None):
+    """
+    consume num tokens from every bucket in one round trip, all or nothing,
+    the buckets must share a redis connection
+    :param rejected_key: hash of counters, rejected_field is incremented in it when the buckets are short of tokens
+    :return: result: bool, wait_time: float, the longest wait of the buckets short of tokens
+    """
+    if not buckets:
+        return True, 0
+    keys, args = [], [time.time(), num, rejected_field if rejected_key else ""]
+    for bucket in buckets:
+        keys.append(bucket._key)
+        args += bucket._args()
+    if rejected_key:
+        keys.append(rejected_key)
+    redis_conn = buckets[0]._redis_conn
+    if id(redis_conn) not in _scripts:
+        _scripts[id(redis_conn)] = redis_conn.register_script(CONSUME_SCRIPT)
+    ok, wait = _scripts[id(redis_conn)](keys=keys, args=args)
+    return bool(ok), float(wait)
+
+
+def throttle_policy(scope) -> dict:
+    """
+    buckets of an endpoint from SysOptions.throttling, {"user": {...}, "ip": {...}, "contest": {...}},
+    endpoints without a policy of their own get the default user and ip buckets
+    """
+    throttling = SysOptions.throttling
+    # the option stored before the endpoints policies has none, those of OptionDefaultValue apply
+    policy = throttling.get("endpoints", {}).get(scope) or OptionDefaultValue.throttling["endpoints"].get(scope)
+    if policy is None:
+        policy = {"user": throttling["user"], "ip": throttling["ip"]}
+    return policy
+
+
+def throttle_buckets(scope, request) -> list:
+    policy = throttle_policy(scope)
+    data = getattr(request, "data", request.GET)
+    subjects = {
+        "user": request.user.id if request.user.is_authenticated else None,
+        "ip": getattr(request, "ip", None) or request.META.get("REMOTE_ADDR"),
+        "contest": data.get("contest_id") if hasattr(data, "get") else None,
+    }
+    return [TokenBucket(key=f"{CacheKey.throttling}:{scope}:{name}:{subjects[name]}", redis_conn=cache, **config)
+            for name, config in policy.items() if subjects.get(name) is not None]
+
+
+def rejected_counts() -> dict:
+    """
+    :return: {endpoint: number of requests rejected}
+    """
+    return {k.decode("utf-8"): int(v) for k, v in cache.hgetall(CacheKey.throttling_rejected).items()}
+
+
+def throttle(scope):
+    """
+    rate limit of an endpoint, every bucket of its policy is checked in one round trip
+    requests authenticated with an api key are not limited
+
+    @login_required
+    @throttle("submission")
+    def post(self, request):
+        ...
+    """
+    def decorator(view_method):
+        @functools.wraps(view_method)
+        def handle(*args, **kwargs):
+            self = args[0]
+            request = args[1]
+            if getattr(request, "auth_method", "") != "api_key":
+                ok, wait = consume_many(throttle_buckets(scope, request),
+                                        rejected_key=CacheKey.throttling_rejected, rejected_field=scope)
+                if not ok:
+                    return self.error(f"Requests are too frequent, please wait {math.ceil(wait)} seconds")
+            return view_method(*args, **kwargs)
+
+        return handle
+
+    return decorator